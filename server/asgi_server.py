@@ -0,0 +1,104 @@
+"""
+ASGI-режим для стриминговых серверов BOOOMERANGS
+Потоковые эндпоинты обслуживаются асинхронными генераторами (Starlette + uvicorn),
+поэтому открытый SSE-поток не занимает рабочий поток на все время ответа.
+Остальные маршруты Flask-приложения монтируются через WSGI-адаптер.
+
+Включается переменной окружения CHAT_SERVER_MODE=asgi или флагом --asgi.
+"""
+import asyncio
+import os
+import sys
+
+# Интервал проверки отключения клиента (секунды)
+DISCONNECT_POLL = float(os.environ.get('ASGI_DISCONNECT_POLL', '1.0'))
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'X-Accel-Buffering': 'no'
+}
+
+
+def asgi_enabled():
+    """Нужно ли запускать сервер в ASGI-режиме"""
+    return '--asgi' in sys.argv or os.environ.get('CHAT_SERVER_MODE', '').lower() == 'asgi'
+
+
+async def _until_disconnected(request):
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL)
+
+
+async def _watch_disconnect(request, events):
+    """
+    Выдает события из `events`, пока клиент подключен. При отключении клиента
+    генератор событий закрывается, что отменяет запрос к провайдеру.
+    """
+    disconnected = asyncio.ensure_future(_until_disconnected(request))
+    next_event = None
+    try:
+        while True:
+            next_event = asyncio.ensure_future(events.__anext__())
+            done, _ = await asyncio.wait({next_event, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if next_event not in done:
+                print("🔌 Клиент отключился, отменяем запрос к провайдеру")
+                return
+            try:
+                event = next_event.result()
+            except StopAsyncIteration:
+                return
+            next_event = None
+            yield event
+    finally:
+        disconnected.cancel()
+        if next_event is not None and not next_event.done():
+            next_event.cancel()
+            try:
+                await next_event
+            except BaseException:
+                pass
+        await events.aclose()
+
+
+def sse_response(request, events, media_type='text/event-stream'):
+    """SSE-ответ из асинхронного генератора строк с отслеживанием отключения клиента"""
+    from starlette.responses import StreamingResponse
+
+    return StreamingResponse(_watch_disconnect(request, events), media_type=media_type, headers=SSE_HEADERS)
+
+
+def text_response(text, status=200):
+    """Простой текстовый ответ для ошибок в ASGI-обработчиках"""
+    from starlette.responses import PlainTextResponse
+
+    return PlainTextResponse(text, status_code=status)
+
+
+def json_response(data, status=200):
+    """JSON-ответ для ошибок в ASGI-обработчиках"""
+    from starlette.responses import JSONResponse
+
+    return JSONResponse(data, status_code=status)
+
+
+def create_app(flask_app, stream_routes):
+    """
+    Создает ASGI-приложение: `stream_routes` - список (путь, async-обработчик, методы),
+    все остальные запросы передаются во Flask-приложение.
+    """
+    from starlette.applications import Starlette
+    from starlette.middleware.wsgi import WSGIMiddleware
+    from starlette.routing import Mount, Route
+
+    routes = [Route(path, endpoint, methods=methods) for path, endpoint, methods in stream_routes]
+    routes.append(Mount('/', app=WSGIMiddleware(flask_app)))
+    return Starlette(routes=routes)
+
+
+def run(flask_app, stream_routes, host='0.0.0.0', port=5000):
+    """Запускает uvicorn с ASGI-приложением"""
+    import uvicorn
+
+    print(f"Запуск ASGI-сервера (uvicorn) на порту {port}...")
+    uvicorn.run(create_app(flask_app, stream_routes), host=host, port=port, log_level='info')
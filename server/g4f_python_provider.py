@@ -1,3 +1,4 @@
+import itertools
 import time
 import json
 import traceback
@@ -6,6 +7,11 @@ import logging
 from flask import Flask, request, jsonify, Response
 import g4f  # Предполагается, что g4f импортирован корректно
 
+import asgi_server
+import provider_health
+import response_cache
+from provider_pipeline import ProviderError, ProviderPipeline, ProviderPolicy
+
 app = Flask(__name__)
 
 # Настройка логирования
@@ -14,147 +20,83 @@ logging.basicConfig(
     format='%(asctime)s [%(levelname)s] %(message)s',
 )
 
+# Политики проверенных провайдеров: модель и минимальный таймаут для больших моделей
+PROVIDER_POLICIES = [
+    ProviderPolicy("Qwen_Qwen_2_72B", "qwen-2.5-72b", min_timeout=45),  # Минимум 45 секунд для 72B модели
+    ProviderPolicy("Qwen_Qwen_2_5_Max", "qwen-max", min_timeout=30),
+    ProviderPolicy("Qwen_Qwen_2_5", "qwen-2.5", min_timeout=30),
+    ProviderPolicy("Qwen_Qwen_2_5M", "qwen-2.5"),
+    ProviderPolicy("FreeGpt", "gpt-4o-mini"),
+    ProviderPolicy("Liaobots", "gpt-4o-mini"),
+    ProviderPolicy("HuggingChat", "llama-3.1-70b"),
+    ProviderPolicy("DeepInfra", "gpt-4o-mini"),
+    ProviderPolicy("You", "gpt-4o-mini"),
+    ProviderPolicy("Blackbox", "blackbox"),
+]
+
+DEFAULT_PROVIDER = "Qwen_Qwen_2_72B"
+BACKUP_PROVIDERS = ["Qwen_Qwen_2_72B", "Qwen_Qwen_2_5_Max", "Qwen_Qwen_2_5", "Qwen_Qwen_2_5M"]
+
+# Классы провайдеров разрешаются один раз при запуске
+pipeline = ProviderPipeline(PROVIDER_POLICIES, DEFAULT_PROVIDER, BACKUP_PROVIDERS)
+
 def get_chat_response(message, specific_provider=None, use_stream=False, timeout=20):
     """
     Реальная функция получения ответа от G4F провайдеров.
+    При use_stream=True поле response_stream выдает текстовые чанки.
     """
-    import g4f
-    import time
-    # Импортируем проверенные работающие провайдеры
-    from g4f.Provider import FreeGpt, Liaobots, HuggingChat, DeepInfra, You, Qwen_Qwen_2_5_Max, Qwen_Qwen_2_5, Qwen_Qwen_2_5M, Qwen_Qwen_2_72B
-    
-    # Настройка провайдеров (только проверенные работающие)
-    provider_map = {
-        "Qwen_Qwen_2_72B": Qwen_Qwen_2_72B,
-        "Qwen_Qwen_2_5_Max": Qwen_Qwen_2_5_Max,
-        "Qwen_Qwen_2_5": Qwen_Qwen_2_5,
-        "Qwen_Qwen_2_5M": Qwen_Qwen_2_5M,
-        "FreeGpt": FreeGpt,
-        "Liaobots": Liaobots,
-        "HuggingChat": HuggingChat,
-        "DeepInfra": DeepInfra,
-        "You": You
-    }
-    
     if specific_provider is None:
-        specific_provider = "Qwen_Qwen_2_72B"
-    
-    # Выбираем провайдер
-    selected_provider = provider_map.get(specific_provider, Qwen_Qwen_2_72B)
-    
-    # Выбираем правильную модель для провайдера
-    if specific_provider == "Qwen_Qwen_2_5_Max":
-        model = "qwen-max"
-    elif specific_provider == "Qwen_Qwen_2_5":
-        model = "qwen-2.5"
-    elif specific_provider == "Qwen_Qwen_2_5M":
-        model = "qwen-2.5"
-    elif specific_provider == "Qwen_Qwen_2_72B":
-        model = "qwen-2.5-72b"
-    elif specific_provider == "You":
-        model = "gpt-4o-mini"
-    elif specific_provider == "HuggingChat":
-        model = "llama-3.1-70b"
-    elif specific_provider == "Blackbox":
-        model = "blackbox"
-    else:
-        model = "gpt-4o-mini"
+        specific_provider = DEFAULT_PROVIDER
     
-    try:
+    if use_stream:
+        # Первый чанк читается сразу: только после него известно, какой провайдер ответил
         start_time = time.time()
-        
-        # Увеличиваем таймаут для больших моделей
-        if specific_provider == "Qwen_Qwen_2_72B":
-            timeout = max(timeout, 45)  # Минимум 45 секунд для 72B модели
-        elif specific_provider in ["Qwen_Qwen_2_5_Max", "Qwen_Qwen_2_5"]:
-            timeout = max(timeout, 30)  # 30 секунд для других больших моделей
-        
-        # Создаем запрос к G4F с правильной моделью
-        response = g4f.ChatCompletion.create(
-            model=model,
-            messages=[{"role": "user", "content": message}],
-            provider=selected_provider,
-            stream=use_stream,
-            timeout=timeout
-        )
-        
-        elapsed = time.time() - start_time
-        
-        if use_stream:
-            return {
-                "streaming": True,
-                "provider": specific_provider,
-                "model": model,
-                "response_stream": response,
-                "elapsed": elapsed
-            }
-        else:
-            return {
-                "success": True,
-                "response": str(response),
-                "provider": specific_provider,
-                "model": model,
-                "elapsed": elapsed
-            }
-            
-    except Exception as e:
-        print(f"❌ Ошибка G4F провайдера {specific_provider}: {str(e)}")
-        
-        # Автоматическое переключение на другие рабочие провайдеры
-        backup_providers = ["Qwen_Qwen_2_72B", "Qwen_Qwen_2_5_Max", "Qwen_Qwen_2_5", "Qwen_Qwen_2_5M"]
-        
-        for backup_provider in backup_providers:
-            if backup_provider != specific_provider:
-                try:
-                    print(f"🔄 Пробуем резервный провайдер: {backup_provider}")
-                    backup_selected = provider_map.get(backup_provider)
-                    
-                    if backup_provider == "Qwen_Qwen_2_5_Max":
-                        backup_model = "qwen-max"
-                    elif backup_provider == "Qwen_Qwen_2_72B":
-                        backup_model = "qwen-2.5-72b"
-                    else:
-                        backup_model = "qwen-2.5"
-                    
-                    backup_response = g4f.ChatCompletion.create(
-                        model=backup_model,
-                        messages=[{"role": "user", "content": message}],
-                        provider=backup_selected,
-                        stream=use_stream,
-                        timeout=timeout
-                    )
-                    
-                    print(f"✅ Резервный провайдер {backup_provider} сработал!")
-                    
-                    if use_stream:
-                        return {
-                            "streaming": True,
-                            "provider": backup_provider,
-                            "model": backup_model,
-                            "response_stream": backup_response,
-                            "elapsed": time.time() - start_time
-                        }
-                    else:
-                        return {
-                            "success": True,
-                            "response": str(backup_response),
-                            "provider": backup_provider,
-                            "model": backup_model,
-                            "elapsed": time.time() - start_time
-                        }
-                        
-                except Exception as backup_error:
-                    print(f"❌ Резервный провайдер {backup_provider}: {str(backup_error)}")
-                    continue
-        
-        # Если все провайдеры не сработали
+        chunks = pipeline.stream(message, specific_provider, timeout)
+        try:
+            provider_name, model, first_chunk = next(chunks)
+        except ProviderError as e:
+            print(f"❌ Ни один провайдер не начал стриминг: {str(e)}")
+            return fallback_chat_response(specific_provider)
+        return {
+            "streaming": True,
+            "provider": provider_name,
+            "model": model,
+            "response_stream": itertools.chain([first_chunk], (chunk for _, _, chunk in chunks)),
+            "elapsed": time.time() - start_time
+        }
+    
+    # Повторяющиеся вопросы отдаем из кэша без обращения к провайдеру
+    cache_key = response_cache.make_key(message, '', specific_provider)
+    cached = response_cache.get(cache_key)
+    if cached:
         return {
             "success": True,
-            "response": f"Извините, возникла проблема с провайдером {specific_provider}. Попробуйте еще раз.",
-            "provider": f"{specific_provider}_fallback",
-            "model": "fallback",
-            "elapsed": 0.1
+            "response": cached['text'],
+            "provider": cached['provider'],
+            "model": cached['model'],
+            "elapsed": 0.0,
+            "cached": True
         }
+    
+    result = pipeline.run(message, specific_provider, timeout)
+    if result:
+        response_cache.put(cache_key, result['response'], provider=result['provider'], model=result['model'])
+        return result
+    
+    # Если все провайдеры не сработали
+    return fallback_chat_response(specific_provider)
+
+def fallback_chat_response(specific_provider):
+    """
+    Ответ get_chat_response, когда ни один провайдер не ответил
+    """
+    return {
+        "success": True,
+        "response": f"Извините, возникла проблема с провайдером {specific_provider}. Попробуйте еще раз.",
+        "provider": f"{specific_provider}_fallback",
+        "model": "fallback",
+        "elapsed": 0.1
+    }
 
 def get_demo_response(message):
     """
@@ -162,55 +104,105 @@ def get_demo_response(message):
     """
     return "Это демо-ответ, поскольку основной провайдер не сработал."
 
+def cached_stream_frames(cached, start_time):
+    """
+    События потокового ответа для закэшированного текста
+    """
+    return [
+        f"data: {json.dumps({'status': 'start', 'provider': cached['provider'], 'cached': True})}\n\n",
+        f"data: {json.dumps({'chunk': cached['text'], 'provider': cached['provider']})}\n\n",
+        f"data: {json.dumps({'status': 'done', 'full_text': cached['text'], 'provider': cached['provider'], 'model': cached['model'], 'elapsed': time.time() - start_time, 'cached': True})}\n\n",
+    ]
+
+def error_stream_frames(message, error, start_time):
+    """
+    События потокового ответа, когда ни один провайдер не ответил
+    """
+    demo_response = get_demo_response(message)
+    return [
+        f"data: {json.dumps({'error': str(error)})}\n\n",
+        f"data: {json.dumps({'text': demo_response, 'provider': 'BOOOMERANGS-Error'})}\n\n",
+        f"data: {json.dumps({'status': 'done', 'full_text': demo_response, 'provider': 'BOOOMERANGS-Error', 'model': 'error-mode', 'elapsed': time.time() - start_time})}\n\n",
+    ]
+
 def stream_response_generator(message, provider, timeout):
     """
     Генератор для потокового ответа в /python/chat/stream
     """
     start_time = time.time()
     try:
-        result = get_chat_response(message, specific_provider=provider, use_stream=True, timeout=timeout)
-        yield f"data: {json.dumps({'status': 'start', 'provider': result.get('provider')})}\n\n"
-
-        if result.get('streaming') and 'response_stream' in result:
-            full_response = ''
-            for chunk in result['response_stream']:
-                if "<html" in chunk.lower():
-                    error_msg = 'Провайдер вернул HTML вместо текста — возможно, заблокирован'
-                    logging.error(error_msg)
-                    yield f"data: {json.dumps({'error': error_msg})}\n\n"
-                    break
-                yield f"data: {json.dumps({'chunk': chunk, 'provider': result.get('provider')})}\n\n"
+        cache_key = response_cache.make_key(message, '', provider or DEFAULT_PROVIDER)
+        cached = response_cache.get(cache_key)
+        if cached:
+            yield from cached_stream_frames(cached, start_time)
+            return
+
+        full_response = ''
+        current_provider = None
+        current_model = None
+        for name, model, chunk in pipeline.stream(message, provider, timeout):
+            if current_provider is None:
+                current_provider, current_model = name, model
+                yield f"data: {json.dumps({'status': 'start', 'provider': name})}\n\n"
+            yield f"data: {json.dumps({'chunk': chunk, 'provider': name})}\n\n"
+            full_response += chunk
+
+        response_cache.put(cache_key, full_response, provider=current_provider, model=current_model)
+        elapsed = time.time() - start_time
+        yield f"data: {json.dumps({'status': 'done', 'full_text': full_response, 'provider': current_provider, 'model': current_model, 'elapsed': elapsed})}\n\n"
+
+    except Exception as e:
+        logging.error(f"Ошибка стриминга: {str(e)}", exc_info=True)
+        yield from error_stream_frames(message, e, start_time)
+
+async def astream_response_generator(message, provider, timeout):
+    """
+    Асинхронный генератор для /python/chat/stream в ASGI-режиме.
+    Закрытие генератора (клиент отключился) прерывает чтение из провайдера.
+    """
+    start_time = time.time()
+    try:
+        cache_key = response_cache.make_key(message, '', provider or DEFAULT_PROVIDER)
+        cached = response_cache.get(cache_key)
+        if cached:
+            for frame in cached_stream_frames(cached, start_time):
+                yield frame
+            return
+
+        full_response = ''
+        current_provider = None
+        current_model = None
+        chunks = pipeline.astream(message, provider, timeout)
+        try:
+            async for name, model, chunk in chunks:
+                if current_provider is None:
+                    current_provider, current_model = name, model
+                    yield f"data: {json.dumps({'status': 'start', 'provider': name})}\n\n"
+                yield f"data: {json.dumps({'chunk': chunk, 'provider': name})}\n\n"
                 full_response += chunk
+        finally:
+            await chunks.aclose()
 
-            elapsed = time.time() - start_time
-            yield f"data: {json.dumps({'status': 'done', 'full_text': full_response, 'provider': result.get('provider'), 'model': result.get('model'), 'elapsed': elapsed})}\n\n"
-        else:
-            # Стриминг не поддерживается или ошибка
-            if "error" in result:
-                demo_response = get_demo_response(message)
-                error_data = {
-                    'error': result.get('error'),
-                    'text': demo_response,
-                    'provider': 'BOOOMERANGS-Demo'
-                }
-                yield f"data: {json.dumps(error_data)}\n\n"
-                yield f"data: {json.dumps({'status': 'done', 'full_text': demo_response, 'provider': 'BOOOMERANGS-Demo', 'model': 'fallback-mode', 'elapsed': time.time() - start_time})}\n\n"
-            else:
-                text_data = {
-                    'text': result.get('response'),
-                    'provider': result.get('provider')
-                }
-                yield f"data: {json.dumps(text_data)}\n\n"
-                yield f"data: {json.dumps({'status': 'done', 'full_text': result.get('response'), 'provider': result.get('provider'), 'model': result.get('model'), 'elapsed': result.get('elapsed', time.time() - start_time)})}\n\n"
+        response_cache.put(cache_key, full_response, provider=current_provider, model=current_model)
+        elapsed = time.time() - start_time
+        yield f"data: {json.dumps({'status': 'done', 'full_text': full_response, 'provider': current_provider, 'model': current_model, 'elapsed': elapsed})}\n\n"
 
     except Exception as e:
         logging.error(f"Ошибка стриминга: {str(e)}", exc_info=True)
-        error_data = {'error': str(e)}
-        yield f"data: {json.dumps(error_data)}\n\n"
-        demo_response = get_demo_response(message)
-        text_data = {'text': demo_response, 'provider': 'BOOOMERANGS-Error'}
-        yield f"data: {json.dumps(text_data)}\n\n"
-        yield f"data: {json.dumps({'status': 'done', 'full_text': demo_response, 'provider': 'BOOOMERANGS-Error', 'model': 'error-mode', 'elapsed': time.time() - start_time})}\n\n"
+        for frame in error_stream_frames(message, e, start_time):
+            yield frame
+
+def parse_stream_timeout(data):
+    """
+    Тайм-аут запроса в секундах из поля timeout (мс), не более 60 секунд
+    """
+    try:
+        timeout = float(data.get('timeout', 20000)) / 1000
+        if timeout <= 0 or timeout > 60:
+            timeout = 20  # Ограничение тайм-аута максимум 60 секунд
+    except (ValueError, TypeError):
+        timeout = 20
+    return timeout
 
 @app.route('/python/chat', methods=['POST'])
 def chat():
@@ -253,28 +245,13 @@ def chat_direct():
         if not message:
             return jsonify({"error": "Отсутствует сообщение"}), 400
 
-        if provider_name and hasattr(g4f.Provider, provider_name):
-            provider = getattr(g4f.Provider, provider_name)
-            start_time = time.time()
-            response = provider(
-                prompt=message,
-                model=model,
-                timeout=timeout
-            )
-            elapsed = time.time() - start_time
-
-            if isinstance(response, str) and "<html" in response.lower():
-                raise Exception(f"Провайдер {provider_name} вернул HTML вместо текста")
+        if provider_name and pipeline.resolve(provider_name):
+            result = pipeline.run(message, provider_name, timeout, model=model, fallback=False)
+            if not result:
+                raise Exception(f"Провайдер {provider_name} не ответил")
 
-            logging.info(f"✅ Провайдер {provider_name} успешно ответил за {elapsed:.2f} сек")
-
-            return jsonify({
-                "success": True,
-                "response": response,
-                "provider": provider_name,
-                "model": model,
-                "elapsed": elapsed
-            })
+            logging.info(f"✅ Провайдер {provider_name} успешно ответил за {result['elapsed']:.2f} сек")
+            return jsonify(result)
         else:
             error_msg = f"Провайдер {provider_name} не найден"
             logging.error(error_msg)
@@ -323,12 +300,7 @@ def chat_stream():
     data = request.json or {}
     message = data.get('message', '')
     provider = data.get('provider')
-    try:
-        timeout = float(data.get('timeout', 20000)) / 1000
-        if timeout <= 0 or timeout > 60:
-            timeout = 20  # Ограничение тайм-аута максимум 60 секунд
-    except (ValueError, TypeError):
-        timeout = 20
+    timeout = parse_stream_timeout(data)
 
     if not message:
         return jsonify({"error": "Отсутствует сообщение"}), 400
@@ -343,6 +315,28 @@ def chat_stream():
         }
     )
 
+async def chat_stream_async(request):
+    """
+    ASGI-версия /python/chat/stream.
+    """
+    try:
+        data = await request.json()
+    except Exception:
+        data = None
+    data = data or {}
+    message = data.get('message', '')
+    if not message:
+        return asgi_server.json_response({"error": "Отсутствует сообщение"}, status=400)
+
+    return asgi_server.sse_response(request, astream_response_generator(message, data.get('provider'), parse_stream_timeout(data)))
+
+@app.route('/providers/health', methods=['GET'])
+def providers_health():
+    """
+    Табло здоровья провайдеров: p50/p95 времени до первого чанка, доля ошибок, circuit breaker.
+    """
+    return jsonify({"providers": provider_health.snapshot(), "cache": response_cache.stats()})
+
 @app.route('/')
 def index():
     """
@@ -355,4 +349,7 @@ if __name__ == '__main__':
     logging.info(f"🤖 Загружено {len(available_providers)} провайдеров: {', '.join(available_providers)}")
 
     # Запуск приложения
-    app.run(host='0.0.0.0', port=5004, debug=False)
\ No newline at end of file
+    if asgi_server.asgi_enabled():
+        asgi_server.run(app, [('/python/chat/stream', chat_stream_async, ['POST'])], port=5004)
+    else:
+        app.run(host='0.0.0.0', port=5004, debug=False)
\ No newline at end of file
@@ -0,0 +1,175 @@
+"""
+Табло здоровья провайдеров для BOOOMERANGS
+Хранит в памяти процесса скользящую статистику по каждому провайдеру:
+время до первого чанка (p50/p95), долю ошибок и состояние circuit breaker.
+Используется для упорядочивания провайдеров по реальной доступности.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+# Размер скользящего окна наблюдений на провайдера
+WINDOW_SIZE = int(os.environ.get('PROVIDER_HEALTH_WINDOW', '50'))
+# Сколько ошибок подряд открывают circuit breaker и на сколько секунд
+FAILURE_THRESHOLD = int(os.environ.get('PROVIDER_HEALTH_FAILURES', '3'))
+OPEN_SECONDS = float(os.environ.get('PROVIDER_HEALTH_OPEN_SECONDS', '60'))
+# Оценка времени до первого чанка для провайдеров без статистики (секунды)
+UNKNOWN_LATENCY = float(os.environ.get('PROVIDER_HEALTH_UNKNOWN_LATENCY', '5'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class ProviderHealth:
+    """Статистика одного провайдера"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = deque(maxlen=WINDOW_SIZE)
+        self.outcomes = deque(maxlen=WINDOW_SIZE)
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.last_error = None
+        self.last_success_at = None
+        self.last_failure_at = None
+
+    def current_state(self, now):
+        if self.state == OPEN and now - self.opened_at >= OPEN_SECONDS:
+            self.state = HALF_OPEN
+            self.probe_in_flight = False
+        return self.state
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def score(self, now):
+        """Чем меньше, тем лучше: медианная задержка, штрафованная за ошибки"""
+        if self.current_state(now) == OPEN:
+            return float('inf')
+        p50 = _percentile(sorted(self.latencies), 0.5)
+        if p50 is None:
+            p50 = UNKNOWN_LATENCY
+        return p50 * (1 + 4 * self.error_rate())
+
+    def to_dict(self, now):
+        latencies = sorted(self.latencies)
+        p50 = _percentile(latencies, 0.5)
+        p95 = _percentile(latencies, 0.95)
+        score = self.score(now)
+        return {
+            "state": self.current_state(now),
+            "score": None if score == float('inf') else round(score, 3),
+            "p50_ttfc": p50,
+            "p95_ttfc": p95,
+            "error_rate": round(self.error_rate(), 3),
+            "samples": len(self.outcomes),
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "last_success_at": self.last_success_at,
+            "last_failure_at": self.last_failure_at,
+        }
+
+
+_lock = threading.Lock()
+_registry = {}
+
+
+def _get(name):
+    health = _registry.get(name)
+    if health is None:
+        health = _registry[name] = ProviderHealth(name)
+    return health
+
+
+def record_success(name, ttfc):
+    """Отмечает успешный ответ провайдера; ttfc - время до первого чанка в секундах"""
+    with _lock:
+        health = _get(name)
+        health.latencies.append(ttfc)
+        health.outcomes.append(True)
+        health.consecutive_failures = 0
+        health.state = CLOSED
+        health.probe_in_flight = False
+        health.last_success_at = time.time()
+
+
+def record_failure(name, error=None):
+    """Отмечает ошибку провайдера и при необходимости открывает circuit breaker"""
+    with _lock:
+        now = time.time()
+        health = _get(name)
+        health.outcomes.append(False)
+        health.consecutive_failures += 1
+        health.last_error = str(error)[:200] if error is not None else None
+        health.last_failure_at = now
+        state = health.current_state(now)
+        if state == HALF_OPEN or health.consecutive_failures >= FAILURE_THRESHOLD:
+            if state != OPEN:
+                print(f"⛔ Circuit breaker открыт для провайдера {name} на {OPEN_SECONDS:.0f} сек")
+            health.state = OPEN
+            health.opened_at = now
+            health.probe_in_flight = False
+
+
+def is_available(name):
+    """
+    Можно ли сейчас обращаться к провайдеру. В состоянии half_open пропускается
+    только один пробный запрос, пока не придет его результат.
+    """
+    with _lock:
+        health = _registry.get(name)
+        if health is None:
+            return True
+        state = health.current_state(time.time())
+        if state == OPEN:
+            return False
+        if state == HALF_OPEN:
+            if health.probe_in_flight:
+                return False
+            health.probe_in_flight = True
+        return True
+
+
+def release_probe(name):
+    """Освобождает пробный запрос half_open, если он был отменен без результата"""
+    with _lock:
+        health = _registry.get(name)
+        if health is not None:
+            health.probe_in_flight = False
+
+
+def order_providers(names, pinned=None):
+    """
+    Упорядочивает провайдеров по здоровью, сохраняя исходный порядок при равенстве.
+    Провайдеры с открытым circuit breaker уходят в конец списка.
+    `pinned` остается первым, если его circuit breaker не открыт.
+    """
+    with _lock:
+        now = time.time()
+        scores = {name: _registry[name].score(now) if name in _registry else UNKNOWN_LATENCY for name in names}
+    unique = list(dict.fromkeys(names))
+    ordered = sorted(unique, key=lambda name: (scores[name], unique.index(name)))
+    if pinned in scores and scores[pinned] != float('inf'):
+        ordered.remove(pinned)
+        ordered.insert(0, pinned)
+    return ordered
+
+
+def snapshot():
+    """Текущее состояние табло для эндпоинта /providers/health"""
+    with _lock:
+        now = time.time()
+        return {name: health.to_dict(now) for name, health in sorted(_registry.items())}
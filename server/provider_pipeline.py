@@ -0,0 +1,207 @@
+"""
+Конвейер провайдеров G4F для BOOOMERANGS
+Классы провайдеров разрешаются один раз при старте, для каждого провайдера
+задается политика (модель и минимальный таймаут). Конвейер перебирает
+запрошенный провайдер и резервные (по табло здоровья) и предоставляет
+синхронный, потоковый и асинхронный потоковый интерфейсы.
+"""
+import asyncio
+import threading
+import time
+
+import g4f
+
+import provider_health
+
+
+class ProviderPolicy:
+    """Политика вызова провайдера: модель по умолчанию и минимальный таймаут"""
+
+    def __init__(self, name, model="gpt-4o-mini", min_timeout=0):
+        self.name = name
+        self.model = model
+        self.min_timeout = min_timeout
+
+    def timeout_for(self, timeout):
+        return max(timeout, self.min_timeout)
+
+
+class ProviderError(Exception):
+    pass
+
+
+def _is_html(text):
+    return "<html" in text.lower()
+
+
+def _close(stream):
+    """Закрывает поток провайдера; ошибка закрытия только логируется, поток все равно брошен"""
+    close = getattr(stream, 'close', None)
+    if close is None:
+        return
+    try:
+        close()
+    except Exception as e:
+        print(f"⚠️ Не удалось закрыть поток провайдера: {str(e)}")
+
+
+class ProviderPipeline:
+    """
+    Реестр провайдеров с политиками и цепочкой резервных провайдеров.
+    Неизвестные провайдеры, существующие в g4f.Provider, разрешаются при первом
+    обращении и кэшируются с политикой по умолчанию.
+    """
+
+    def __init__(self, policies, default_provider, backup_order, default_model="gpt-4o-mini"):
+        self.default_provider = default_provider
+        self.backup_order = list(backup_order)
+        self.default_model = default_model
+        self.policies = {}
+        self.classes = {}
+        self._lock = threading.Lock()
+
+        for policy in policies:
+            provider_class = getattr(g4f.Provider, policy.name, None)
+            if provider_class is None:
+                print(f"Провайдер {policy.name} не найден в g4f")
+                continue
+            self.policies[policy.name] = policy
+            self.classes[policy.name] = provider_class
+
+    def resolve(self, name):
+        """Возвращает (policy, provider_class) или None, если провайдер не существует"""
+        if name in self.classes:
+            return self.policies[name], self.classes[name]
+
+        provider_class = getattr(g4f.Provider, name, None) if name else None
+        if provider_class is None:
+            return None
+        with self._lock:
+            if name not in self.classes:
+                self.policies[name] = ProviderPolicy(name, self.default_model)
+                self.classes[name] = provider_class
+        return self.policies[name], self.classes[name]
+
+    def candidates(self, provider=None, fallback=True):
+        """Запрошенный провайдер (или провайдер по умолчанию), затем резервные по здоровью"""
+        requested = provider if self.resolve(provider) else self.default_provider
+        if not fallback:
+            return [requested]
+        backups = [name for name in provider_health.order_providers(self.backup_order) if name != requested and name in self.classes]
+        return [requested] + backups
+
+    def _create(self, name, message, timeout, model, stream):
+        policy, provider_class = self.resolve(name)
+        return g4f.ChatCompletion.create(
+            model=model or policy.model,
+            messages=[{"role": "user", "content": message}],
+            provider=provider_class,
+            stream=stream,
+            timeout=policy.timeout_for(timeout)
+        )
+
+    def run(self, message, provider=None, timeout=20, model=None, fallback=True):
+        """
+        Синхронный запрос без стриминга.
+        Возвращает словарь с полями success, response, provider, model, elapsed
+        или None, если ни один провайдер не ответил.
+        """
+        start_time = time.time()
+        for index, name in enumerate(self.candidates(provider, fallback)):
+            # Без резервных провайдеров запрошенный провайдер вызывается в любом случае
+            if fallback and not provider_health.is_available(name):
+                print(f"⛔ Пропускаем провайдер {name}: circuit breaker открыт")
+                continue
+            used_model = model if index == 0 and model else self.policies[name].model
+            try:
+                if index > 0:
+                    print(f"🔄 Пробуем резервный провайдер: {name}")
+                attempt_start = time.time()
+                response = str(self._create(name, message, timeout, used_model, stream=False))
+                if _is_html(response):
+                    raise ProviderError(f"Провайдер {name} вернул HTML вместо текста")
+                provider_health.record_success(name, time.time() - attempt_start)
+                return {
+                    "success": True,
+                    "response": response,
+                    "provider": name,
+                    "model": used_model,
+                    "elapsed": time.time() - start_time
+                }
+            except Exception as e:
+                provider_health.record_failure(name, e)
+                print(f"❌ Ошибка G4F провайдера {name}: {str(e)}")
+        return None
+
+    def stream(self, message, provider=None, timeout=20, model=None, fallback=True, cancel=None):
+        """
+        Потоковый запрос. Выдает кортежи (provider, model, chunk).
+        Переход к резервному провайдеру возможен только до первого чанка.
+        Если задано событие `cancel`, после его установки поток провайдера закрывается
+        при получении следующего чанка и генератор завершается.
+        """
+        for index, name in enumerate(self.candidates(provider, fallback)):
+            if cancel is not None and cancel.is_set():
+                return
+            # Без резервных провайдеров запрошенный провайдер вызывается в любом случае
+            if fallback and not provider_health.is_available(name):
+                print(f"⛔ Пропускаем провайдер {name}: circuit breaker открыт")
+                continue
+            used_model = model if index == 0 and model else self.policies[name].model
+            attempt_start = time.time()
+            got_first_chunk = False
+            response_stream = None
+            try:
+                if index > 0:
+                    print(f"🔄 Пробуем резервный провайдер: {name}")
+                response_stream = self._create(name, message, timeout, used_model, stream=True)
+                for chunk in response_stream:
+                    if cancel is not None and cancel.is_set():
+                        return
+                    if not isinstance(chunk, str) or not chunk:
+                        continue
+                    if _is_html(chunk):
+                        raise ProviderError('Провайдер вернул HTML вместо текста — возможно, заблокирован')
+                    if not got_first_chunk:
+                        got_first_chunk = True
+                        provider_health.record_success(name, time.time() - attempt_start)
+                    yield name, used_model, chunk
+                if got_first_chunk:
+                    return
+                raise ProviderError('пустой ответ')
+            except Exception as e:
+                if got_first_chunk:
+                    raise
+                provider_health.record_failure(name, e)
+                print(f"❌ Ошибка G4F провайдера {name}: {str(e)}")
+            finally:
+                _close(response_stream)
+        raise ProviderError('Ни один провайдер не ответил')
+
+    async def astream(self, message, provider=None, timeout=20, model=None, fallback=True):
+        """
+        Асинхронная версия stream(). Блокирующее чтение g4f выполняется в пуле потоков.
+        При отмене корутины выставляется флаг отмены, а генератор stream() закрывается
+        в пуле потоков, как только вернется текущее чтение: закрыть генератор, пока
+        другой поток выполняет в нем next(), нельзя.
+        """
+        loop = asyncio.get_running_loop()
+        cancel = threading.Event()
+        iterator = self.stream(message, provider, timeout, model, fallback, cancel)
+        finished = object()
+        pending = None
+        try:
+            while True:
+                pending = loop.run_in_executor(None, next, iterator, finished)
+                # shield: при отмене чтение в потоке продолжается, и pending сообщит, когда оно закончится
+                item = await asyncio.shield(pending)
+                pending = None
+                if item is finished:
+                    return
+                yield item
+        finally:
+            cancel.set()
+            if pending is None or pending.done():
+                loop.run_in_executor(None, _close, iterator)
+            else:
+                pending.add_done_callback(lambda _: loop.run_in_executor(None, _close, iterator))
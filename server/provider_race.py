@@ -0,0 +1,289 @@
+"""
+Гонка провайдеров (hedged requests) для BOOOMERANGS
+Запускает несколько провайдеров одновременно или с небольшой задержкой,
+первый провайдер, приславший чанк, побеждает, остальные отменяются
+"""
+import asyncio
+import concurrent.futures
+import inspect
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import provider_health
+
+# Задержка перед запуском следующего провайдера (секунды) и максимальное число участников гонки
+HEDGE_DELAY = float(os.environ.get('STREAM_HEDGE_DELAY', '1.5'))
+HEDGE_FANOUT = int(os.environ.get('STREAM_HEDGE_FANOUT', '3'))
+
+# Сколько непрочитанных событий может накопиться, прежде чем поток провайдера остановится
+MAX_BUFFERED = int(os.environ.get('STREAM_MAX_BUFFERED_EVENTS', '64'))
+
+# Потоки, в которых читаются блокирующие потоки g4f
+_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('STREAM_HEDGE_WORKERS', '32')), thread_name_prefix='hedge')
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_race_loop():
+    """Возвращает фоновый event loop, в котором выполняются гонки провайдеров"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True, name='hedge-loop').start()
+            _loop = loop
+    return _loop
+
+
+def _pump_provider(name, open_stream, cancel_event, emit):
+    """Читает поток одного провайдера в отдельном потоке и передает события в гонку"""
+    response_stream = None
+    start_time = time.time()
+    got_first_chunk = False
+    try:
+        response_stream = open_stream(name)
+        for chunk in response_stream:
+            if cancel_event.is_set():
+                break
+            if isinstance(chunk, str) and chunk:
+                if not got_first_chunk:
+                    got_first_chunk = True
+                    provider_health.record_success(name, time.time() - start_time)
+                emit(('chunk', name, chunk))
+        if not got_first_chunk:
+            if cancel_event.is_set():
+                provider_health.release_probe(name)
+            else:
+                provider_health.record_failure(name, 'пустой ответ')
+        emit(('done', name, None))
+    except Exception as e:
+        if not got_first_chunk:
+            if cancel_event.is_set():
+                provider_health.release_probe(name)
+            else:
+                provider_health.record_failure(name, e)
+        emit(('error', name, str(e)))
+    finally:
+        close = getattr(response_stream, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                pass
+
+
+async def race_providers(candidates, open_stream, sink, hedge_delay=HEDGE_DELAY, fanout=HEDGE_FANOUT, cancel_event=None, max_buffered=MAX_BUFFERED):
+    """
+    Запускает провайдеров из `candidates` с интервалом `hedge_delay`, одновременно
+    в гонке участвует не больше `fanout` провайдеров. Если провайдер падает до
+    первого чанка, следующий запускается сразу (при fanout=1 провайдеры
+    перебираются по очереди).
+    Провайдеры с открытым circuit breaker (см. provider_health) пропускаются.
+
+    События передаются в `sink` (вызывается из event loop; если sink возвращает
+    awaitable, гонка ждет его - так медленный клиент притормаживает провайдера):
+      ('winner', name, None) - провайдер прислал первый чанк
+      ('chunk', name, text)  - очередной чанк победителя
+      ('done', name, None)   - победитель завершил поток
+      ('error', name, text)  - победитель упал после первого чанка
+      ('failed', None, errors) - ни один провайдер не ответил
+
+    Возвращает имя победителя или None.
+    """
+    loop = asyncio.get_running_loop()
+    # Ограниченная очередь: поток провайдера ждет, пока гонка не разберет события
+    events = asyncio.Queue(maxsize=max_buffered)
+    contenders = list(candidates)
+    fanout = max(1, fanout)
+    cancels = {}
+    errors = {}
+    running = set()
+    next_index = 0
+    winner = None
+
+    def make_emit(cancel):
+        def emit(event):
+            if cancel.is_set():
+                return
+            future = asyncio.run_coroutine_threadsafe(events.put(event), loop)
+            while True:
+                try:
+                    future.result(timeout=0.5)
+                    return
+                except concurrent.futures.TimeoutError:
+                    if cancel.is_set():
+                        future.cancel()
+                        return
+                except concurrent.futures.CancelledError:
+                    return
+        return emit
+
+    async def deliver(event):
+        result = sink(event)
+        if inspect.isawaitable(result):
+            await result
+
+    def can_launch():
+        return next_index < len(contenders) and len(running) < fanout
+
+    def launch_next():
+        nonlocal next_index
+        while next_index < len(contenders):
+            name = contenders[next_index]
+            next_index += 1
+            if provider_health.is_available(name):
+                break
+            print(f"⛔ Провайдер {name} пропущен: circuit breaker открыт")
+        else:
+            return False
+        cancels[name] = threading.Event()
+        running.add(name)
+        print(f"🏁 Запускаем провайдера {name} в гонке")
+        loop.run_in_executor(_executor, _pump_provider, name, open_stream, cancels[name], make_emit(cancels[name]))
+        return True
+
+    def cancel_all(except_name=None):
+        for name, event in cancels.items():
+            if name != except_name:
+                event.set()
+
+    if not launch_next():
+        await deliver(('failed', None, errors))
+        return None
+
+    try:
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                cancel_all()
+                return winner
+
+            # Пока нет победителя, ждем не дольше задержки хеджирования
+            wait = None
+            if winner is None and can_launch():
+                wait = hedge_delay
+            if cancel_event is not None:
+                wait = 0.5 if wait is None else min(wait, 0.5)
+
+            try:
+                kind, name, payload = await asyncio.wait_for(events.get(), wait)
+            except asyncio.TimeoutError:
+                if winner is None and can_launch() and (cancel_event is None or not cancel_event.is_set()):
+                    launch_next()
+                continue
+
+            if winner is None:
+                if kind == 'chunk':
+                    winner = name
+                    cancel_all(except_name=name)
+                    print(f"🏆 Провайдер {name} выиграл гонку")
+                    await deliver(('winner', name, None))
+                    await deliver(('chunk', name, payload))
+                    continue
+
+                running.discard(name)
+                errors[name] = payload or 'пустой ответ'
+                print(f"❌ Провайдер {name} выбыл из гонки: {errors[name]}")
+                if not (can_launch() and launch_next()) and not running:
+                    await deliver(('failed', None, errors))
+                    return None
+            elif name == winner:
+                await deliver((kind, name, payload))
+                if kind in ('done', 'error'):
+                    return winner
+    finally:
+        # Победитель к этому моменту уже завершил поток либо гонка отменена - останавливаем всех
+        cancel_all()
+
+
+async def arace(candidates, open_stream, hedge_delay=HEDGE_DELAY, fanout=HEDGE_FANOUT, max_buffered=MAX_BUFFERED, timeout=None, tick=None):
+    """
+    Асинхронный итератор событий гонки для ASGI-обработчиков.
+    Буфер между гонкой и клиентом ограничен: пока клиент не прочитает события,
+    чтение из провайдера приостанавливается. При отмене (клиент отключился)
+    все провайдеры останавливаются.
+    `timeout` ограничивает паузу между событиями, как в iterate_race; если задан `tick`,
+    при отсутствии событий каждые `tick` секунд выдается ('tick', None, None).
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue(maxsize=max_buffered)
+    task = asyncio.ensure_future(race_providers(candidates, open_stream, events.put, hedge_delay, fanout, max_buffered=max_buffered))
+    get = None
+    last_event = loop.time()
+    try:
+        while True:
+            if get is None:
+                get = asyncio.ensure_future(events.get())
+            wait = tick
+            if timeout is not None:
+                remaining = max(0.0, timeout - (loop.time() - last_event))
+                wait = remaining if wait is None else min(wait, remaining)
+            done, _ = await asyncio.wait({get, task}, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if timeout is not None and loop.time() - last_event >= timeout:
+                    yield ('failed', None, {'timeout': 'превышено время ожидания провайдеров'})
+                    return
+                yield ('tick', None, None)
+                continue
+            if get not in done:
+                if task.exception() is not None:
+                    raise task.exception()
+                # Гонка завершилась, дочитываем оставшиеся события
+                if events.empty():
+                    return
+                get.cancel()
+                get = None
+                event = events.get_nowait()
+            else:
+                event = get.result()
+                get = None
+            last_event = loop.time()
+            yield event
+            if event[0] in ('done', 'error', 'failed'):
+                return
+    finally:
+        if get is not None:
+            get.cancel()
+        task.cancel()
+
+
+def iterate_race(candidates, open_stream, hedge_delay=HEDGE_DELAY, fanout=HEDGE_FANOUT, timeout=None, tick=None):
+    """
+    Синхронная обертка над race_providers для Flask-генераторов.
+    Выдает те же события, что передаются в sink. При закрытии генератора
+    (например, клиент отключился) все провайдеры отменяются.
+    `timeout` ограничивает паузу между событиями; если задан `tick`, во время
+    паузы каждые `tick` секунд выдается ('tick', None, None).
+    """
+    events = queue.Queue()
+    cancel_event = threading.Event()
+    future = asyncio.run_coroutine_threadsafe(
+        race_providers(candidates, open_stream, events.put, hedge_delay, fanout, cancel_event),
+        get_race_loop()
+    )
+
+    try:
+        idle = 0.0
+        while True:
+            wait = timeout
+            if tick:
+                wait = tick if timeout is None else min(tick, max(0.0, timeout - idle))
+            try:
+                event = events.get(timeout=wait)
+            except queue.Empty:
+                idle += wait or 0.0
+                if tick and (timeout is None or idle < timeout):
+                    yield ('tick', None, None)
+                    continue
+                yield ('failed', None, {'timeout': 'превышено время ожидания провайдеров'})
+                return
+            idle = 0.0
+            yield event
+            if event[0] in ('done', 'error', 'failed'):
+                return
+    finally:
+        cancel_event.set()
+        future.cancel()
@@ -0,0 +1,107 @@
+"""
+Кэш ответов чата для BOOOMERANGS
+Ограниченный LRU-кэш с временем жизни записей. Ключ строится из нормализованного
+текста сообщения, системного промпта и модели, поэтому "Привет!" и "  привет "
+попадают в одну запись. При указании RESPONSE_CACHE_DIR кэш дополнительно
+сохраняется на диск через diskcache (SQLite), если он установлен.
+"""
+import hashlib
+import os
+import re
+import string
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# Максимальное число записей в памяти и время жизни записи (секунды)
+CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '512'))
+CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '3600'))
+# Каталог для дискового кэша; пустое значение отключает его
+CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR', '')
+
+_whitespace_re = re.compile(r'\s+')
+_edge_chars = string.whitespace + string.punctuation + '…«»“”„—–'
+
+_lock = threading.Lock()
+_entries = OrderedDict()
+_stats = {"hits": 0, "misses": 0, "stores": 0}
+
+_disk = None
+if CACHE_DIR:
+    try:
+        import diskcache
+        _disk = diskcache.Cache(CACHE_DIR, size_limit=int(os.environ.get('RESPONSE_CACHE_DISK_BYTES', str(256 * 1024 * 1024))))
+        print(f"💾 Дисковый кэш ответов: {CACHE_DIR}")
+    except Exception as e:
+        print(f"Дисковый кэш ответов недоступен: {str(e)}")
+        _disk = None
+
+
+def normalize_text(text):
+    """Приводит текст к канонической форме: NFKC, нижний регистр, схлопнутые пробелы, без пунктуации по краям"""
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    text = _whitespace_re.sub(' ', text)
+    return text.strip(_edge_chars)
+
+
+def make_key(message, system_prompt='', model=''):
+    """Ключ кэша из нормализованного сообщения, системного промпта и модели"""
+    raw = '\x1f'.join((normalize_text(message), (system_prompt or '').strip(), model or ''))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def get(key):
+    """Возвращает закэшированную запись {'text', 'provider', 'model', 'created'} или None"""
+    now = time.time()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            if now - entry['created'] < CACHE_TTL:
+                _entries.move_to_end(key)
+                _stats["hits"] += 1
+                return entry
+            del _entries[key]
+
+    if _disk is not None:
+        try:
+            entry = _disk.get(key)
+        except Exception:
+            entry = None
+        if entry is not None and now - entry['created'] < CACHE_TTL:
+            with _lock:
+                _remember(key, entry)
+                _stats["hits"] += 1
+            return entry
+
+    with _lock:
+        _stats["misses"] += 1
+    return None
+
+
+def _remember(key, entry):
+    _entries[key] = entry
+    _entries.move_to_end(key)
+    while len(_entries) > CACHE_SIZE:
+        _entries.popitem(last=False)
+
+
+def put(key, text, provider=None, model=None):
+    """Сохраняет ответ в кэш; пустые ответы не кэшируются"""
+    if not text or not text.strip():
+        return
+    entry = {'text': text, 'provider': provider, 'model': model, 'created': time.time()}
+    with _lock:
+        _remember(key, entry)
+        _stats["stores"] += 1
+    if _disk is not None:
+        try:
+            _disk.set(key, entry, expire=CACHE_TTL)
+        except Exception as e:
+            print(f"Ошибка записи в дисковый кэш ответов: {str(e)}")
+
+
+def stats():
+    """Статистика кэша для диагностики"""
+    with _lock:
+        return dict(_stats, size=len(_entries), max_size=CACHE_SIZE, ttl=CACHE_TTL, disk=_disk is not None)
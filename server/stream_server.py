@@ -5,11 +5,85 @@
 from flask import Flask, request, Response, jsonify
 from flask_cors import CORS
 import g4f
+import asyncio
 import json
+import logging
+import math
+import os
 import time
 import random
 import traceback
 
+import asgi_server
+import provider_health
+import response_cache
+from provider_race import arace, iterate_race, HEDGE_DELAY, HEDGE_FANOUT
+
+# Склейка мелких чанков: накопленный текст отправляется одним событием раз в
+# STREAM_COALESCE_MS миллисекунд или при накоплении STREAM_COALESCE_BYTES байт (0 - без склейки)
+COALESCE_MS = float(os.environ.get('STREAM_COALESCE_MS', '40'))
+COALESCE_BYTES = int(os.environ.get('STREAM_COALESCE_BYTES', '256'))
+# Логируется только каждый N-й чанк и только на уровне DEBUG
+CHUNK_LOG_SAMPLE = max(1, int(os.environ.get('STREAM_CHUNK_LOG_SAMPLE', '50')))
+
+logging.basicConfig(level=os.environ.get('STREAM_LOG_LEVEL', 'INFO').upper(), format='%(asctime)s [%(levelname)s] %(message)s')
+logger = logging.getLogger('stream_server')
+
+def sse_event(event, payload):
+    """SSE-событие; UTF-8 без \\u-экранирования, чтобы кириллица не раздувала поток в 3 раза"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def log_chunk(provider_name, chunk_count, chunk):
+    """Выборочное логирование чанков: первый и каждый CHUNK_LOG_SAMPLE-й, только при DEBUG"""
+    if (chunk_count == 1 or chunk_count % CHUNK_LOG_SAMPLE == 0) and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Чанк {chunk_count} от {provider_name}: {chunk[:30]}...")
+
+class ChunkCoalescer:
+    """
+    Накопитель чанков провайдера. Первый чанк отправляется сразу (время до первого
+    токена не страдает), следующие склеиваются по окну времени или размеру.
+    Полный текст хранится списком и собирается одним join.
+    """
+
+    def __init__(self, window_ms=COALESCE_MS, max_bytes=COALESCE_BYTES):
+        self.window = window_ms / 1000
+        self.max_bytes = max_bytes
+        self.parts = []
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        self.sent_any = False
+        self.count = 0
+
+    def add(self, chunk):
+        """Добавляет чанк; возвращает текст для отправки или None, если окно еще не закрыто"""
+        self.count += 1
+        self.parts.append(chunk)
+        self.pending.append(chunk)
+        self.pending_bytes += len(chunk.encode('utf-8'))
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+        if not self.sent_any or self.window <= 0 or self.pending_bytes >= self.max_bytes or self.due():
+            return self.flush()
+        return None
+
+    def due(self):
+        return bool(self.pending) and time.monotonic() - self.pending_since >= self.window
+
+    def flush(self):
+        """Возвращает накопленный, но не отправленный текст"""
+        if not self.pending:
+            return None
+        text = self.pending[0] if len(self.pending) == 1 else ''.join(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        self.sent_any = True
+        return text
+
+    def text(self):
+        return ''.join(self.parts)
+
 # Основные провайдеры с поддержкой потоковой передачи
 # Используем более гибкий подход с getattr вместо прямого доступа
 # для избежания ошибок AttributeError
@@ -125,6 +199,113 @@ if llama_available:
 app = Flask(__name__)
 CORS(app)
 
+# Системный промпт для диалога; входит в ключ кэша ответов
+SYSTEM_PROMPT = "Вы AI-ассистент BOOOMERANGS. Отвечайте по-русски, если вопрос на русском. Давайте краткие и полезные ответы."
+
+def get_stream_model(provider_name, message):
+    """Выбирает модель для провайдера при гонке провайдеров"""
+    if provider_name == "Anthropic":
+        return "claude-3-opus-20240229"
+    if provider_name == "You":
+        return "gpt-4o-mini" if "gpt" in message.lower() else "llama-3"
+    return "gpt-3.5-turbo"
+
+def get_race_candidates(provider_name):
+    """
+    Порядок провайдеров для гонки: запрошенный, затем группы primary/secondary/fallback,
+    упорядоченные по табло здоровья провайдеров
+    """
+    candidates = []
+    for name in [provider_name] + provider_groups['primary'] + provider_groups['secondary'] + provider_groups['fallback']:
+        if name in providers and name not in candidates:
+            candidates.append(name)
+    return provider_health.order_providers(candidates, pinned=provider_name)
+
+def make_open_stream(messages, message, timeout):
+    """Фабрика потоков g4f для участников гонки провайдеров"""
+    def open_stream(name):
+        return g4f.ChatCompletion.create(
+            model=get_stream_model(name, message),
+            messages=messages,
+            provider=providers[name],
+            stream=True,
+            timeout=timeout
+        )
+    return open_stream
+
+def frame_race_event(event, state):
+    """
+    Превращает событие гонки в SSE-события. `state` хранит запрошенный провайдер,
+    накопитель чанков и параметры кэша. Возвращает (строка или None, завершено ли).
+    """
+    kind, name, payload = event
+    coalescer = state['coalescer']
+    if kind == 'tick':
+        text = coalescer.flush() if coalescer.due() else None
+        return (sse_event('chunk', {'text': text, 'provider': state['winner']}) if text else None), False
+    if kind == 'winner':
+        state['winner'] = name
+        if name != state['provider']:
+            return sse_event('update', {'text': f'Переключаемся на {name}...', 'provider': name}), False
+        return None, False
+    if kind == 'chunk':
+        text = coalescer.add(payload)
+        log_chunk(name, coalescer.count, payload)
+        return (sse_event('chunk', {'text': text, 'provider': name}) if text else None), False
+    if kind == 'failed' and state['winner'] is not None:
+        # Победитель замолчал посреди ответа (таймаут гонки): клиент уже получил часть
+        # настоящего ответа, поэтому завершаем поток им, а не демо-ответом
+        kind, name = 'error', state['winner']
+    if kind in ('done', 'error'):
+        response_text = coalescer.text()
+        if kind == 'error':
+            print(f"Провайдер {name} прервал поток: {payload}")
+        elif state['cache_key']:
+            response_cache.put(state['cache_key'], response_text, provider=name, model=get_stream_model(name, state['message']))
+        state['succeeded'] = True
+        elapsed = time.time() - state['start_time']
+        if kind == 'done':
+            print(f"Стриминг от {name} завершен успешно ({coalescer.count} чанков)")
+        frames = ''
+        rest = coalescer.flush()
+        if rest:
+            frames = sse_event('chunk', {'text': rest, 'provider': name})
+        complete = {'text': response_text, 'provider': name, 'elapsed': elapsed}
+        if kind == 'error':
+            complete['interrupted'] = True
+        return frames + sse_event('complete', complete), True
+    print(f"Ни один провайдер не ответил в гонке: {payload}")
+    return None, True
+
+def new_race_state(provider_name, message, start_time, cache_key):
+    return {'provider': provider_name, 'winner': None, 'message': message, 'start_time': start_time,
+            'cache_key': cache_key, 'coalescer': ChunkCoalescer(), 'succeeded': False}
+
+def get_race_timeout(timeout, hedge_delay, hedge_fanout):
+    """Пауза между событиями гонки: не дольше, чем все участники гонки могут ждать своих провайдеров"""
+    return timeout + hedge_delay * hedge_fanout
+
+def stream_hedged(provider_name, messages, message, timeout, hedge_delay, hedge_fanout, start_time, cache_key=None):
+    """
+    Стриминг с гонкой провайдеров: несколько провайдеров запускаются с задержкой hedge_delay,
+    побеждает первый приславший чанк. Возвращает True, если ответ был отправлен.
+    Полный ответ сохраняется в кэш по cache_key, если он указан.
+    """
+    candidates = get_race_candidates(provider_name)
+    print(f"🏁 Гонка провайдеров: {', '.join(candidates[:hedge_fanout])} (задержка {hedge_delay} сек)")
+
+    state = new_race_state(provider_name, message, start_time, cache_key)
+    race_timeout = get_race_timeout(timeout, hedge_delay, hedge_fanout)
+    tick = COALESCE_MS / 1000 if COALESCE_MS > 0 else None
+    for event in iterate_race(candidates, make_open_stream(messages, message, timeout), hedge_delay, hedge_fanout, race_timeout, tick):
+        frame, finished = frame_race_event(event, state)
+        if frame:
+            yield frame
+        if finished:
+            break
+
+    return state['succeeded']
+
 def get_demo_response(message):
     """Генерирует демо-ответ для случаев, когда API недоступен"""
     message_lower = message.lower()
@@ -149,6 +330,86 @@ def get_demo_response(message):
         
     return random.choice(random_responses)
 
+def stream_cached_response(cached, start_time):
+    """Воспроизводит закэшированный ответ в том же формате событий, что и живой стриминг"""
+    provider = cached.get('provider') or 'BOOOMERANGS-Cache'
+    print(f"⚡ Ответ из кэша (провайдер {provider})")
+    yield sse_event('start', {'provider': provider, 'cached': True})
+    yield sse_event('chunk', {'text': cached['text'], 'provider': provider})
+    elapsed = time.time() - start_time
+    yield sse_event('complete', {'text': cached['text'], 'provider': provider, 'elapsed': elapsed, 'cached': True})
+
+def stream_demo_response(message, start_time):
+    """Имитирует стриминг демо-ответа, когда ни один провайдер не ответил"""
+    print("Все провайдеры не работают, используем демо-ответ")
+    demo_response = get_demo_response(message)
+    
+    yield sse_event('update', {'text': 'Используем демо-режим...', 'provider': 'BOOOMERANGS-Demo'})
+    
+    # Имитируем стриминг для демо-ответа
+    words = demo_response.split()
+    chunk_size = max(1, len(words) // 5)  # Разбиваем на 5 частей
+    
+    for i in range(0, len(words), chunk_size):
+        chunk = ' '.join(words[i:i+chunk_size])
+        yield sse_event('chunk', {'text': chunk + ' ', 'provider': 'BOOOMERANGS-Demo'})
+        time.sleep(0.1)  # Небольшая задержка для имитации печати
+    
+    # Отправляем полный ответ в конце
+    elapsed = time.time() - start_time
+    yield sse_event('complete', {'text': demo_response, 'provider': 'BOOOMERANGS-Demo', 'elapsed': elapsed})
+
+def parse_number(value, default, convert=float):
+    """Число из параметра запроса; нечисловые значения заменяются значением по умолчанию"""
+    if isinstance(value, bool):
+        return default
+    try:
+        number = convert(value)
+    except (TypeError, ValueError, OverflowError):
+        return default
+    return number if math.isfinite(number) else default
+
+def parse_stream_request(data):
+    """
+    Разбирает JSON запроса /stream, включая специальные команды test-claude: и test-provider:.
+    Возвращает None, если сообщение не указано.
+    """
+    message = data.get('message', '')
+    provider_name = data.get('provider', 'Qwen_Qwen_2_72B')
+    timeout = parse_number(data.get('timeout'), 50000) / 1000  # Переводим миллисекунды в секунды (увеличено до 50 сек)
+    # Параметры гонки провайдеров: задержка в миллисекундах и число одновременных провайдеров
+    hedge_delay = max(0.0, parse_number(data.get('hedge_delay'), HEDGE_DELAY * 1000) / 1000)
+    hedge_fanout = max(1, parse_number(data.get('hedge_fanout'), HEDGE_FANOUT, int)) if data.get('hedge', True) else 1
+    use_cache = data.get('cache', True)
+    
+    if not message:
+        return None
+        
+    # Обработка специальных команд для тестирования провайдеров
+    if message.lower().startswith('test-claude:'):
+        message = message[11:].strip()  # Удаляем префикс
+        provider_name = 'Anthropic'
+        hedge_fanout = 1  # Тестируем только указанный провайдер
+        use_cache = False
+        print(f"🔵 Специальный запрос: тестирование Claude с сообщением: '{message}'")
+    elif message.lower().startswith('test-provider:'):
+        parts = message[13:].strip().split(':', 1)
+        if len(parts) == 2:
+            provider_name = parts[0].strip()
+            message = parts[1].strip()
+            hedge_fanout = 1  # Тестируем только указанный провайдер
+            use_cache = False
+            print(f"🔵 Специальный запрос: тестирование провайдера {provider_name} с сообщением: '{message}'")
+    
+    return {
+        'message': message,
+        'provider_name': provider_name,
+        'timeout': timeout,
+        'hedge_delay': hedge_delay,
+        'hedge_fanout': hedge_fanout,
+        'use_cache': use_cache
+    }
+
 @app.route('/stream', methods=['POST'])
 def stream_chat():
     """Потоковый вывод ответов от G4F моделей с поддержкой стриминга"""
@@ -156,50 +417,58 @@ def stream_chat():
         return Response('Метод не поддерживается', status=405)
     
     try:
-        data = request.get_json()
-        message = data.get('message', '')
-        provider_name = data.get('provider', 'Qwen_Qwen_2_72B')
-        timeout = data.get('timeout', 50000) / 1000  # Переводим миллисекунды в секунды (увеличено до 50 сек)
-        
-        if not message:
+        params = parse_stream_request(request.get_json() or {})
+        if params is None:
             return Response('Не указано сообщение', status=400)
-            
-        # Обработка специальных команд для тестирования провайдеров
-        if message.lower().startswith('test-claude:'):
-            message = message[11:].strip()  # Удаляем префикс
-            provider_name = 'Anthropic'
-            print(f"🔵 Специальный запрос: тестирование Claude с сообщением: '{message}'")
-        elif message.lower().startswith('test-provider:'):
-            parts = message[13:].strip().split(':', 1)
-            if len(parts) == 2:
-                provider_name = parts[0].strip()
-                message = parts[1].strip()
-                print(f"🔵 Специальный запрос: тестирование провайдера {provider_name} с сообщением: '{message}'")
+        message = params['message']
+        provider_name = params['provider_name']
+        timeout = params['timeout']
+        hedge_delay = params['hedge_delay']
+        hedge_fanout = params['hedge_fanout']
+        use_cache = params['use_cache']
         
         print(f"Получен запрос стриминга: '{message}' от провайдера {provider_name}")
         
         # Подготавливаем диалог с системным промптом
         messages = [
-            {"role": "system", "content": "Вы AI-ассистент BOOOMERANGS. Отвечайте по-русски, если вопрос на русском. Давайте краткие и полезные ответы."},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": message}
         ]
         
+        cache_key = response_cache.make_key(message, SYSTEM_PROMPT, provider_name) if use_cache else None
+        
         def stream_generator():
             """Генератор для стриминга ответов"""
+            # message переопределяется ниже (префикс test-gpt:), поэтому берем его из внешней функции явно
+            nonlocal message
             # Используем локальные переменные внутри генератора
             current_provider = provider_name
             start_time = time.time()
             yielded_anything = False
             
+            # Частые вопросы отдаем из кэша без обращения к провайдерам
+            cached = response_cache.get(cache_key) if cache_key else None
+            if cached:
+                yield from stream_cached_response(cached, start_time)
+                return
+            
             # Отправляем событие начала стриминга
             print(f"Начинаем стриминг от провайдера {current_provider}")
-            yield f"event: start\ndata: {json.dumps({'provider': current_provider})}\n\n"
+            yield sse_event('start', {'provider': current_provider})
             
             try:
                 # Исправляем имя провайдера, если нужно
                 if current_provider == "Qwen_Max":
                     current_provider = "Qwen_Qwen_2_5_Max"
                 
+                # Гонка провайдеров: первый ответивший побеждает, остальные отменяются
+                if hedge_fanout > 1:
+                    if (yield from stream_hedged(current_provider, messages, message, timeout, hedge_delay, hedge_fanout, start_time, cache_key)):
+                        return
+                    # Если гонка не дала ответа, переходим к демо-режиму
+                    yield from stream_demo_response(message, start_time)
+                    return
+                
                 # Попробуем сначала использовать запрошенный провайдер
                 if current_provider in providers:
                     try:
@@ -366,29 +635,37 @@ def stream_chat():
                                 )
                             
                             print(f"Получен поток от провайдера {current_provider}")
-                            response_text = ''
-                            chunk_count = 0
+                            coalescer = ChunkCoalescer()
                             
                             # Пробуем получить первый чанк с таймаутом
                             got_first_chunk = False
                             
                             for chunk in response_stream:
-                                chunk_count += 1
                                 if isinstance(chunk, str):
-                                    response_text += chunk
-                                    print(f"Чанк {chunk_count} от {current_provider}: {chunk[:30]}...")
-                                    yield f"event: chunk\ndata: {json.dumps({'text': chunk, 'provider': current_provider})}\n\n"
+                                    if not got_first_chunk:
+                                        provider_health.record_success(current_provider, time.time() - start_time)
+                                    text = coalescer.add(chunk)
+                                    log_chunk(current_provider, coalescer.count, chunk)
+                                    if text:
+                                        yield sse_event('chunk', {'text': text, 'provider': current_provider})
                                     yielded_anything = True
                                     got_first_chunk = True
                                     
                             # Если получили хотя бы один чанк, отправляем завершающее событие
                             if got_first_chunk:
+                                text = coalescer.flush()
+                                if text:
+                                    yield sse_event('chunk', {'text': text, 'provider': current_provider})
+                                response_text = coalescer.text()
+                                if cache_key:
+                                    response_cache.put(cache_key, response_text, provider=current_provider)
                                 elapsed = time.time() - start_time
                                 print(f"Стриминг от {current_provider} завершен успешно")
-                                yield f"event: complete\ndata: {json.dumps({'text': response_text, 'provider': current_provider, 'elapsed': elapsed})}\n\n"
+                                yield sse_event('complete', {'text': response_text, 'provider': current_provider, 'elapsed': elapsed})
                                 return
                                 
                         except Exception as e:
+                            provider_health.record_failure(current_provider, e)
                             print(f"Ошибка при работе с провайдером {current_provider}: {str(e)}")
                     
                     except Exception as provider_error:
@@ -400,15 +677,19 @@ def stream_chat():
                 for group_name in ['primary', 'secondary', 'fallback']:
                     print(f"Пробуем группу провайдеров: {group_name}")
                     
-                    for backup_provider in provider_groups[group_name]:
+                    for backup_provider in provider_health.order_providers(provider_groups[group_name]):
                         if backup_provider == current_provider or backup_provider not in providers:
                             continue
+                        if not provider_health.is_available(backup_provider):
+                            print(f"⛔ Пропускаем резервный провайдер {backup_provider}: circuit breaker открыт")
+                            continue
                             
                         try:
                             provider = providers[backup_provider]
                             print(f"Пробуем резервный провайдер {backup_provider}")
+                            backup_start = time.time()
                             
-                            yield f"event: update\ndata: {json.dumps({'text': f'Переключаемся на {backup_provider}...', 'provider': backup_provider})}\n\n"
+                            yield sse_event('update', {'text': f'Переключаемся на {backup_provider}...', 'provider': backup_provider})
                             
                             try:
                                 response_stream = g4f.ChatCompletion.create(
@@ -419,49 +700,43 @@ def stream_chat():
                                     timeout=timeout
                                 )
                                 
-                                response_text = ''
-                                chunk_count = 0
+                                coalescer = ChunkCoalescer()
                                 got_any_chunks = False
                                 
                                 for chunk in response_stream:
-                                    chunk_count += 1
                                     if isinstance(chunk, str):
-                                        response_text += chunk
-                                        print(f"Резервный чанк {chunk_count} от {backup_provider}: {chunk[:30]}...")
-                                        yield f"event: chunk\ndata: {json.dumps({'text': chunk, 'provider': backup_provider})}\n\n"
+                                        if not got_any_chunks:
+                                            provider_health.record_success(backup_provider, time.time() - backup_start)
+                                        text = coalescer.add(chunk)
+                                        log_chunk(backup_provider, coalescer.count, chunk)
+                                        if text:
+                                            yield sse_event('chunk', {'text': text, 'provider': backup_provider})
                                         yielded_anything = True
                                         got_any_chunks = True
                                 
                                 if got_any_chunks:
+                                    text = coalescer.flush()
+                                    if text:
+                                        yield sse_event('chunk', {'text': text, 'provider': backup_provider})
+                                    response_text = coalescer.text()
+                                    if cache_key:
+                                        response_cache.put(cache_key, response_text, provider=backup_provider)
                                     elapsed = time.time() - start_time
                                     print(f"Стриминг от резервного провайдера {backup_provider} завершен успешно")
-                                    yield f"event: complete\ndata: {json.dumps({'text': response_text, 'provider': backup_provider, 'elapsed': elapsed})}\n\n"
+                                    yield sse_event('complete', {'text': response_text, 'provider': backup_provider, 'elapsed': elapsed})
                                     return
                                     
+                                provider_health.record_failure(backup_provider, 'пустой ответ')
+                                    
                             except Exception as e:
+                                provider_health.record_failure(backup_provider, e)
                                 print(f"Ошибка при работе с резервным провайдером {backup_provider}: {str(e)}")
                                 
                         except Exception as provider_error:
                             print(f"Ошибка при инициализации резервного провайдера {backup_provider}: {str(provider_error)}")
                 
                 # Если все провайдеры не сработали, используем демо-ответ
-                print("Все провайдеры не работают, используем демо-ответ")
-                demo_response = get_demo_response(message)
-                
-                yield f"event: update\ndata: {json.dumps({'text': 'Используем демо-режим...', 'provider': 'BOOOMERANGS-Demo'})}\n\n"
-                
-                # Имитируем стриминг для демо-ответа
-                words = demo_response.split()
-                chunk_size = max(1, len(words) // 5)  # Разбиваем на 5 частей
-                
-                for i in range(0, len(words), chunk_size):
-                    chunk = ' '.join(words[i:i+chunk_size])
-                    yield f"event: chunk\ndata: {json.dumps({'text': chunk + ' ', 'provider': 'BOOOMERANGS-Demo'})}\n\n"
-                    time.sleep(0.1)  # Небольшая задержка для имитации печати
-                
-                # Отправляем полный ответ в конце
-                elapsed = time.time() - start_time
-                yield f"event: complete\ndata: {json.dumps({'text': demo_response, 'provider': 'BOOOMERANGS-Demo', 'elapsed': elapsed})}\n\n"
+                yield from stream_demo_response(message, start_time)
             
             except Exception as e:
                 print(f"Критическая ошибка в генераторе стриминга: {str(e)}")
@@ -470,12 +745,12 @@ def stream_chat():
                 # В случае общей ошибки, отправляем сообщение об ошибке
                 demo_response = "Извините, произошла ошибка при обработке запроса. Попробуйте еще раз."
                 
-                yield f"event: update\ndata: {json.dumps({'text': 'Ошибка соединения...', 'provider': 'BOOOMERANGS-Demo'})}\n\n"
-                yield f"event: chunk\ndata: {json.dumps({'text': demo_response, 'provider': 'BOOOMERANGS-Demo'})}\n\n"
+                yield sse_event('update', {'text': 'Ошибка соединения...', 'provider': 'BOOOMERANGS-Demo'})
+                yield sse_event('chunk', {'text': demo_response, 'provider': 'BOOOMERANGS-Demo'})
                 
                 # Отправляем завершающее событие
                 elapsed = time.time() - start_time
-                yield f"event: complete\ndata: {json.dumps({'text': demo_response, 'provider': 'BOOOMERANGS-Demo', 'elapsed': elapsed})}\n\n"
+                yield sse_event('complete', {'text': demo_response, 'provider': 'BOOOMERANGS-Demo', 'elapsed': elapsed})
         
         # Возвращаем потоковый ответ
         return Response(stream_generator(), content_type='text/event-stream')
@@ -485,11 +760,92 @@ def stream_chat():
         traceback.print_exc()
         return Response('Внутренняя ошибка сервера', status=500)
 
+async def astream_chat(params):
+    """
+    Асинхронный генератор SSE-событий для ASGI-режима /stream.
+    Провайдеры всегда проходят через гонку (при hedge_fanout=1 - по очереди, как
+    резервная цепочка Flask-версии), закрытие генератора отменяет все запросы к провайдерам.
+    """
+    message = params['message']
+    provider_name = params['provider_name']
+    if provider_name == "Qwen_Max":
+        provider_name = "Qwen_Qwen_2_5_Max"
+    start_time = time.time()
+    cache_key = response_cache.make_key(message, SYSTEM_PROMPT, params['provider_name']) if params['use_cache'] else None
+
+    cached = response_cache.get(cache_key) if cache_key else None
+    if cached:
+        for frame in stream_cached_response(cached, start_time):
+            yield frame
+        return
+
+    yield sse_event('start', {'provider': provider_name})
+
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": message}
+    ]
+    state = new_race_state(provider_name, message, start_time, cache_key)
+    try:
+        hedge_fanout = max(1, params['hedge_fanout'])
+        events = arace(get_race_candidates(provider_name), make_open_stream(messages, message, params['timeout']),
+                       params['hedge_delay'], hedge_fanout,
+                       timeout=get_race_timeout(params['timeout'], params['hedge_delay'], hedge_fanout),
+                       tick=COALESCE_MS / 1000 if COALESCE_MS > 0 else None)
+        try:
+            async for event in events:
+                frame, finished = frame_race_event(event, state)
+                if frame:
+                    yield frame
+                if finished:
+                    break
+        finally:
+            await events.aclose()
+    except Exception as e:
+        print(f"Критическая ошибка в асинхронном стриминге: {str(e)}")
+        traceback.print_exc()
+
+    if state['succeeded']:
+        return
+
+    # Ни один провайдер не ответил - отдаем демо-ответ без блокировки event loop
+    demo_response = get_demo_response(message)
+    yield sse_event('update', {'text': 'Используем демо-режим...', 'provider': 'BOOOMERANGS-Demo'})
+    words = demo_response.split()
+    chunk_size = max(1, len(words) // 5)
+    for i in range(0, len(words), chunk_size):
+        chunk = ' '.join(words[i:i+chunk_size])
+        yield sse_event('chunk', {'text': chunk + ' ', 'provider': 'BOOOMERANGS-Demo'})
+        await asyncio.sleep(0.1)
+    elapsed = time.time() - start_time
+    yield sse_event('complete', {'text': demo_response, 'provider': 'BOOOMERANGS-Demo', 'elapsed': elapsed})
+
+async def stream_chat_async(request):
+    """ASGI-версия /stream"""
+    try:
+        data = await request.json()
+    except Exception:
+        data = None
+    params = parse_stream_request(data or {})
+    if params is None:
+        return asgi_server.text_response('Не указано сообщение', status=400)
+    print(f"Получен запрос стриминга (ASGI): '{params['message']}' от провайдера {params['provider_name']}")
+    return asgi_server.sse_response(request, astream_chat(params))
+
 # Простой тестовый маршрут
 @app.route('/test', methods=['GET'])
 def test():
     return jsonify({"status": "ok", "message": "Flask-сервер стриминга работает"})
 
+# Табло здоровья провайдеров
+@app.route('/providers/health', methods=['GET'])
+def providers_health():
+    return jsonify({
+        "providers": provider_health.snapshot(),
+        "order": provider_health.order_providers(list(providers)),
+        "cache": response_cache.stats()
+    })
+
 # Маршрут для тестирования провайдеров
 @app.route('/test-provider/<provider_name>', methods=['GET'])
 def test_provider(provider_name):
@@ -526,5 +882,8 @@ def test_provider(provider_name):
 
 # Функция для запуска сервера
 if __name__ == '__main__':
-    print("Запуск стримингового сервера на порту 5001...")
-    app.run(host='0.0.0.0', port=5001, debug=True, threaded=True)
+    if asgi_server.asgi_enabled():
+        asgi_server.run(app, [('/stream', stream_chat_async, ['POST'])], port=5001)
+    else:
+        print("Запуск стримингового сервера на порту 5001...")
+        app.run(host='0.0.0.0', port=5001, debug=True, threaded=True)
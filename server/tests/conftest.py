@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# Модули сервера импортируются по имени, как при запуске из каталога server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import provider_health  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def clean_provider_health():
+    """Каждый тест начинает с пустого табло здоровья провайдеров"""
+    provider_health._registry.clear()
+    yield
+    provider_health._registry.clear()
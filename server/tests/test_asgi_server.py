@@ -0,0 +1,50 @@
+import asyncio
+
+import asgi_server
+
+
+class FakeRequest:
+    """Запрос Starlette, отключение клиента которого управляется тестом"""
+
+    def __init__(self):
+        self.disconnected = False
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+
+def test_events_are_passed_through(monkeypatch):
+    monkeypatch.setattr(asgi_server, 'DISCONNECT_POLL', 0.01)
+
+    async def events():
+        yield "a"
+        yield "b"
+
+    async def consume():
+        return [event async for event in asgi_server._watch_disconnect(FakeRequest(), events())]
+
+    assert asyncio.run(consume()) == ["a", "b"]
+
+
+def test_disconnect_closes_event_generator(monkeypatch):
+    monkeypatch.setattr(asgi_server, 'DISCONNECT_POLL', 0.01)
+    request = FakeRequest()
+    closed = []
+
+    async def events():
+        try:
+            yield "a"
+            await asyncio.sleep(10)
+            yield "b"
+        finally:
+            closed.append(True)
+
+    async def consume():
+        received = []
+        async for event in asgi_server._watch_disconnect(request, events()):
+            received.append(event)
+            request.disconnected = True
+        return received
+
+    assert asyncio.run(asyncio.wait_for(consume(), 5)) == ["a"]
+    assert closed == [True]
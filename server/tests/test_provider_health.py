@@ -0,0 +1,87 @@
+import types
+
+import pytest
+
+import provider_health
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Управляемые часы табло здоровья"""
+    now = types.SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(provider_health, 'time', types.SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+def fail(name, times):
+    for _ in range(times):
+        provider_health.record_failure(name, 'ошибка')
+
+
+def test_unknown_provider_is_available():
+    assert provider_health.is_available('A')
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    fail('A', provider_health.FAILURE_THRESHOLD - 1)
+    assert provider_health.is_available('A')
+
+    fail('A', 1)
+    assert not provider_health.is_available('A')
+    assert provider_health.snapshot()['A']['state'] == provider_health.OPEN
+
+
+def test_success_resets_failure_streak(clock):
+    fail('A', provider_health.FAILURE_THRESHOLD - 1)
+    provider_health.record_success('A', 0.5)
+    fail('A', provider_health.FAILURE_THRESHOLD - 1)
+
+    assert provider_health.is_available('A')
+
+
+def test_half_open_lets_one_probe_through(clock):
+    fail('A', provider_health.FAILURE_THRESHOLD)
+    clock.value += provider_health.OPEN_SECONDS
+
+    assert provider_health.is_available('A')
+    assert provider_health.snapshot()['A']['state'] == provider_health.HALF_OPEN
+    assert not provider_health.is_available('A'), "второй запрос ждет результата пробного"
+
+    provider_health.release_probe('A')
+    assert provider_health.is_available('A'), "отмененный пробный запрос освобождает место"
+
+
+def test_half_open_probe_success_closes_breaker(clock):
+    fail('A', provider_health.FAILURE_THRESHOLD)
+    clock.value += provider_health.OPEN_SECONDS
+    assert provider_health.is_available('A')
+
+    provider_health.record_success('A', 0.5)
+
+    assert provider_health.snapshot()['A']['state'] == provider_health.CLOSED
+    assert provider_health.is_available('A')
+    assert provider_health.is_available('A')
+
+
+def test_half_open_probe_failure_reopens_breaker(clock):
+    fail('A', provider_health.FAILURE_THRESHOLD)
+    clock.value += provider_health.OPEN_SECONDS
+    assert provider_health.is_available('A')
+
+    fail('A', 1)
+
+    assert not provider_health.is_available('A')
+    clock.value += provider_health.OPEN_SECONDS - 1
+    assert not provider_health.is_available('A')
+    clock.value += 1
+    assert provider_health.is_available('A')
+
+
+def test_order_providers_by_latency_and_breaker(clock):
+    provider_health.record_success('slow', 3.0)
+    provider_health.record_success('fast', 0.5)
+    fail('broken', provider_health.FAILURE_THRESHOLD)
+
+    assert provider_health.order_providers(['broken', 'slow', 'fast']) == ['fast', 'slow', 'broken']
+    assert provider_health.order_providers(['broken', 'slow', 'fast'], pinned='slow') == ['slow', 'fast', 'broken']
+    assert provider_health.order_providers(['broken', 'slow', 'fast'], pinned='broken') == ['fast', 'slow', 'broken']
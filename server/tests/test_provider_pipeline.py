@@ -0,0 +1,104 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+g4f = pytest.importorskip("g4f")
+
+import provider_health  # noqa: E402
+import provider_pipeline  # noqa: E402
+from provider_pipeline import ProviderError, ProviderPipeline, ProviderPolicy  # noqa: E402
+
+
+@pytest.fixture
+def scripts(monkeypatch):
+    """
+    Подменяет вызов g4f: ответ провайдера задается списком чанков, исключением
+    или паузами (число - пауза в секундах). Закрытые потоки записываются в scripts['closed'].
+    """
+    state = {'closed': []}
+
+    def create(model, messages, provider, stream, timeout):
+        steps = state[provider.__name__]
+        if isinstance(steps, Exception):
+            raise steps
+        if not stream:
+            return ''.join(step for step in steps if isinstance(step, str))
+
+        def generate():
+            try:
+                for step in steps:
+                    if isinstance(step, (int, float)):
+                        time.sleep(step)
+                    else:
+                        yield step
+            finally:
+                state['closed'].append(provider.__name__)
+
+        return generate()
+
+    for name in ('FakeA', 'FakeB', 'FakeC'):
+        monkeypatch.setattr(g4f.Provider, name, type(name, (), {}), raising=False)
+    monkeypatch.setattr(provider_pipeline.g4f.ChatCompletion, 'create', staticmethod(create))
+    return state
+
+
+def make_pipeline():
+    return ProviderPipeline([ProviderPolicy('FakeA', 'model-a'), ProviderPolicy('FakeB', 'model-b'), ProviderPolicy('FakeC', 'model-c')], 'FakeA', ['FakeB', 'FakeC'])
+
+
+def test_run_falls_back_to_backup(scripts):
+    scripts['FakeA'] = RuntimeError("недоступен")
+    scripts['FakeB'] = ["<html>заблокировано</html>"]
+    scripts['FakeC'] = ["ответ"]
+
+    result = make_pipeline().run("вопрос", 'FakeA')
+
+    assert result['provider'] == 'FakeC'
+    assert result['model'] == 'model-c'
+    assert result['response'] == "ответ"
+    assert provider_health.snapshot()['FakeA']['consecutive_failures'] == 1
+
+
+def test_stream_falls_back_only_before_first_chunk(scripts):
+    scripts['FakeA'] = []
+    scripts['FakeB'] = ["раз", "два"]
+    scripts['FakeC'] = ["не нужен"]
+
+    chunks = list(make_pipeline().stream("вопрос", 'FakeA'))
+
+    assert chunks == [('FakeB', 'model-b', "раз"), ('FakeB', 'model-b', "два")]
+
+
+def test_stream_without_answer_raises(scripts):
+    scripts['FakeA'] = RuntimeError("нет")
+
+    with pytest.raises(ProviderError):
+        list(make_pipeline().stream("вопрос", 'FakeA', fallback=False))
+
+
+def test_cancelled_astream_closes_provider_stream(scripts):
+    scripts['FakeA'] = ["первый", 0.3, "второй", "третий"]
+    done = threading.Event()
+
+    async def consume():
+        chunks = make_pipeline().astream("вопрос", 'FakeA', fallback=False)
+        assert (await chunks.__anext__())[2] == "первый"
+        reading = asyncio.ensure_future(chunks.__anext__())
+        await asyncio.sleep(0.05)
+        reading.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await reading
+        await chunks.aclose()
+
+        # поток закрывается в пуле, когда вернется чтение, начатое до отмены
+        deadline = time.monotonic() + 2
+        while not scripts['closed'] and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+        done.set()
+
+    asyncio.run(consume())
+
+    assert done.is_set()
+    assert scripts['closed'] == ['FakeA']
@@ -0,0 +1,135 @@
+import asyncio
+import threading
+import time
+
+import provider_health
+import provider_race
+
+
+class FakeProviders:
+    """
+    Фабрика потоков для гонки. Каждый провайдер описывается списком шагов:
+    число - пауза в секундах, строка - чанк, исключение - ошибка.
+    """
+
+    def __init__(self, **scripts):
+        self.scripts = scripts
+        self.opened = []
+        self.closed = []
+        self.lock = threading.Lock()
+
+    def __call__(self, name):
+        with self.lock:
+            self.opened.append(name)
+        return self.stream(name)
+
+    def stream(self, name):
+        try:
+            for step in self.scripts[name]:
+                if isinstance(step, Exception):
+                    raise step
+                if isinstance(step, (int, float)):
+                    time.sleep(step)
+                else:
+                    yield step
+        finally:
+            with self.lock:
+                self.closed.append(name)
+
+    def wait_closed(self, name, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if name in self.closed:
+                    return True
+            time.sleep(0.01)
+        return False
+
+
+def run_race(candidates, open_stream, hedge_delay=0.05, fanout=3, timeout=5.0):
+    return list(provider_race.iterate_race(candidates, open_stream, hedge_delay, fanout, timeout))
+
+
+async def collect(events):
+    return [event async for event in events if event[0] != 'tick']
+
+
+def test_first_chunk_wins_and_losers_are_cancelled():
+    providers = FakeProviders(slow=[0.3, "медленно", "медленно"], fast=["быстро", " ответ"])
+
+    events = run_race(['slow', 'fast'], providers)
+
+    assert events == [('winner', 'fast', None), ('chunk', 'fast', "быстро"), ('chunk', 'fast', " ответ"), ('done', 'fast', None)]
+    assert providers.wait_closed('slow'), "проигравший провайдер должен быть остановлен"
+
+
+def test_hedge_delay_staggers_contenders():
+    providers = FakeProviders(first=["ответ"], second=["запасной ответ"])
+
+    events = run_race(['first', 'second'], providers, hedge_delay=1.0)
+
+    assert events[0] == ('winner', 'first', None)
+    assert providers.opened == ['first'], "второй провайдер не запускается, пока не прошла задержка"
+
+
+def test_failure_before_first_chunk_launches_next_at_fanout_one():
+    providers = FakeProviders(a=[RuntimeError("нет ответа")], b=[], c=["ответ"])
+
+    events = run_race(['a', 'b', 'c'], providers, hedge_delay=10, fanout=1)
+
+    assert events[0] == ('winner', 'c', None)
+    assert providers.opened == ['a', 'b', 'c']
+
+
+def test_all_providers_failing_reports_errors():
+    providers = FakeProviders(a=[RuntimeError("ошибка a")], b=[])
+
+    events = run_race(['a', 'b'], providers)
+
+    assert events == [('failed', None, {'a': "ошибка a", 'b': 'пустой ответ'})]
+
+
+def test_provider_with_open_breaker_is_skipped():
+    for _ in range(provider_health.FAILURE_THRESHOLD):
+        provider_health.record_failure('broken', 'ошибка')
+    providers = FakeProviders(broken=["не должен отвечать"], ok=["ответ"])
+
+    events = run_race(['broken', 'ok'], providers)
+
+    assert events[0] == ('winner', 'ok', None)
+    assert providers.opened == ['ok']
+
+
+def test_error_after_first_chunk_ends_race_with_error():
+    providers = FakeProviders(a=["начало", RuntimeError("обрыв")], b=[0.5, "не нужен"])
+
+    events = run_race(['a', 'b'], providers, hedge_delay=1.0)
+
+    assert events == [('winner', 'a', None), ('chunk', 'a', "начало"), ('error', 'a', "обрыв")]
+
+
+def test_stalled_winner_times_out_after_chunks():
+    providers = FakeProviders(a=["начало", 2.0, "конец"])
+
+    events = run_race(['a'], providers, timeout=0.3)
+
+    assert events[:2] == [('winner', 'a', None), ('chunk', 'a', "начало")]
+    assert events[2][0] == 'failed' and 'timeout' in events[2][2]
+    assert providers.wait_closed('a', timeout=3.0)
+
+
+def test_async_race_at_fanout_one_walks_candidates():
+    providers = FakeProviders(a=[RuntimeError("нет ответа")], b=["ответ"])
+
+    events = asyncio.run(collect(provider_race.arace(['a', 'b'], providers, hedge_delay=10, fanout=1)))
+
+    assert events == [('winner', 'b', None), ('chunk', 'b', "ответ"), ('done', 'b', None)]
+
+
+def test_async_race_times_out():
+    providers = FakeProviders(a=["начало", 2.0, "конец"])
+
+    events = asyncio.run(collect(provider_race.arace(['a'], providers, hedge_delay=0.05, fanout=1, timeout=0.3, tick=0.05)))
+
+    assert events[:2] == [('winner', 'a', None), ('chunk', 'a', "начало")]
+    assert events[2][0] == 'failed' and 'timeout' in events[2][2]
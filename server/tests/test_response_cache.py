@@ -0,0 +1,70 @@
+import types
+from collections import OrderedDict
+
+import pytest
+
+import response_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(response_cache, '_entries', OrderedDict())
+    monkeypatch.setattr(response_cache, '_stats', {"hits": 0, "misses": 0, "stores": 0})
+    monkeypatch.setattr(response_cache, '_disk', None)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = types.SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(response_cache, 'time', types.SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+def test_key_normalizes_message():
+    assert response_cache.make_key("Привет!", "system", "m") == response_cache.make_key("  привет  ", "system", "m")
+    assert response_cache.make_key("Привет", "system", "m") != response_cache.make_key("Привет", "system", "other")
+    assert response_cache.make_key("Привет", "system", "m") != response_cache.make_key("Привет", "другой", "m")
+
+
+def test_put_and_get():
+    key = response_cache.make_key("вопрос")
+    response_cache.put(key, "ответ", provider="P", model="M")
+
+    entry = response_cache.get(key)
+
+    assert entry['text'] == "ответ"
+    assert entry['provider'] == "P"
+    assert response_cache.stats()['hits'] == 1
+
+
+def test_empty_answers_are_not_cached():
+    key = response_cache.make_key("вопрос")
+    response_cache.put(key, "   ")
+
+    assert response_cache.get(key) is None
+
+
+def test_entries_expire_after_ttl(clock, monkeypatch):
+    monkeypatch.setattr(response_cache, 'CACHE_TTL', 10)
+    key = response_cache.make_key("вопрос")
+    response_cache.put(key, "ответ")
+
+    clock.value += 9
+    assert response_cache.get(key) is not None
+
+    clock.value += 1
+    assert response_cache.get(key) is None
+    assert response_cache.stats()['size'] == 0
+
+
+def test_least_recently_used_entry_is_evicted(monkeypatch):
+    monkeypatch.setattr(response_cache, 'CACHE_SIZE', 2)
+    response_cache.put('a', "A")
+    response_cache.put('b', "B")
+    assert response_cache.get('a') is not None
+
+    response_cache.put('c', "C")
+
+    assert response_cache.get('b') is None
+    assert response_cache.get('a') is not None
+    assert response_cache.get('c') is not None
@@ -0,0 +1,80 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip("g4f")
+pytest.importorskip("flask")
+
+import stream_server  # noqa: E402
+
+
+def parse_frames(frames):
+    events = []
+    for block in frames.strip().split("\n\n"):
+        event, data = block.split("\n")
+        events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+def test_coalescer_sends_first_chunk_at_once_and_joins_the_rest():
+    coalescer = stream_server.ChunkCoalescer(window_ms=10000, max_bytes=10)
+
+    assert coalescer.add("Привет") == "Привет"
+    assert coalescer.add(",") is None
+    assert coalescer.add(" мир") is None
+    assert coalescer.add("!!!!!!!!") == ", мир!!!!!!!!"
+    assert coalescer.flush() is None
+    assert coalescer.text() == "Привет, мир!!!!!!!!"
+
+
+def test_race_events_become_sse_frames():
+    state = stream_server.new_race_state('A', "вопрос", time.time(), None)
+
+    assert stream_server.frame_race_event(('winner', 'B', None), state)[0].startswith("event: update")
+    frame, finished = stream_server.frame_race_event(('chunk', 'B', "ответ"), state)
+    assert parse_frames(frame) == [('chunk', {'text': "ответ", 'provider': 'B'})]
+    assert not finished
+
+    frame, finished = stream_server.frame_race_event(('done', 'B', None), state)
+    assert finished and state['succeeded']
+    assert parse_frames(frame)[-1][1]['text'] == "ответ"
+
+
+def test_timeout_after_chunks_completes_with_partial_answer():
+    state = stream_server.new_race_state('A', "вопрос", time.time(), None)
+    state['coalescer'] = stream_server.ChunkCoalescer(window_ms=10000)
+    stream_server.frame_race_event(('winner', 'A', None), state)
+    stream_server.frame_race_event(('chunk', 'A', "начало"), state)
+    stream_server.frame_race_event(('chunk', 'A', " ответа"), state)
+
+    frame, finished = stream_server.frame_race_event(('failed', None, {'timeout': "превышено время"}), state)
+
+    assert finished
+    assert state['succeeded'], "после настоящих чанков демо-ответ не отправляется"
+    assert parse_frames(frame) == [
+        ('chunk', {'text': " ответа", 'provider': 'A'}),
+        ('complete', {'text': "начало ответа", 'provider': 'A', 'elapsed': pytest.approx(0, abs=5), 'interrupted': True}),
+    ]
+
+
+def test_failed_race_without_chunks_falls_back_to_demo():
+    state = stream_server.new_race_state('A', "вопрос", time.time(), None)
+
+    frame, finished = stream_server.frame_race_event(('failed', None, {'a': "ошибка"}), state)
+
+    assert frame is None and finished
+    assert not state['succeeded']
+
+
+@pytest.mark.parametrize("data,delay,fanout", [
+    ({'hedge_delay': "abc", 'hedge_fanout': [2]}, stream_server.HEDGE_DELAY, stream_server.HEDGE_FANOUT),
+    ({'hedge_delay': -100, 'hedge_fanout': 0}, 0.0, 1),
+    ({'hedge_delay': "250", 'hedge_fanout': "2"}, 0.25, 2),
+    ({'hedge': False, 'hedge_fanout': 5}, stream_server.HEDGE_DELAY, 1),
+])
+def test_hedge_parameters_are_validated(data, delay, fanout):
+    params = stream_server.parse_stream_request(dict(data, message="вопрос"))
+
+    assert params['hedge_delay'] == pytest.approx(delay)
+    assert params['hedge_fanout'] == fanout
@@ -10,6 +10,8 @@ import json
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 
+import provider_health
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
 
@@ -28,6 +30,7 @@ def get_ai_response(message, provider_name=None):
     
     try:
         logging.info(f"Запрос к AI провайдеру: {provider_name}")
+        start_time = time.time()
         
         # Получаем провайдер
         provider = getattr(g4f.Provider, provider_name)
@@ -42,6 +45,7 @@ def get_ai_response(message, provider_name=None):
         result = str(response).strip()
         
         if result and len(result) > 10:  # Проверяем что ответ содержательный
+            provider_health.record_success(provider_name, time.time() - start_time)
             return {
                 "success": True,
                 "response": result,
@@ -53,12 +57,17 @@ def get_ai_response(message, provider_name=None):
             
     except Exception as e:
         logging.error(f"Ошибка провайдера {provider_name}: {str(e)}")
+        provider_health.record_failure(provider_name, e)
         
-        # Пробуем другой провайдер
-        for backup_provider in FREE_PROVIDERS:
+        # Пробуем другой провайдер, самые здоровые первыми
+        for backup_provider in provider_health.order_providers(FREE_PROVIDERS):
             if backup_provider != provider_name:
+                if not provider_health.is_available(backup_provider):
+                    logging.info(f"Пропускаем резервный провайдер {backup_provider}: circuit breaker открыт")
+                    continue
                 try:
                     logging.info(f"Пробуем резервный провайдер: {backup_provider}")
+                    backup_start = time.time()
                     provider = getattr(g4f.Provider, backup_provider)
                     response = g4f.ChatCompletion.create(
                         model="gpt-3.5-turbo",
@@ -67,13 +76,16 @@ def get_ai_response(message, provider_name=None):
                     )
                     result = str(response).strip()
                     if result and len(result) > 10:
+                        provider_health.record_success(backup_provider, time.time() - backup_start)
                         return {
                             "success": True,
                             "response": result,
                             "provider": f"{backup_provider}_backup",
                             "model": "gpt-3.5-turbo"
                         }
+                    provider_health.record_failure(backup_provider, 'пустой ответ')
                 except Exception as backup_error:
+                    provider_health.record_failure(backup_provider, backup_error)
                     logging.error(f"Резервный провайдер {backup_provider} тоже не работает: {str(backup_error)}")
                     continue
         
@@ -138,6 +150,14 @@ def list_providers():
         "status": "ready"
     })
 
+@app.route('/providers/health', methods=['GET'])
+def providers_health():
+    """Табло здоровья провайдеров"""
+    return jsonify({
+        "providers": provider_health.snapshot(),
+        "order": provider_health.order_providers(FREE_PROVIDERS)
+    })
+
 if __name__ == '__main__':
     logging.info(f"🚀 Запуск рабочего AI провайдера с {len(FREE_PROVIDERS)} бесплатными сервисами")
     app.run(host='0.0.0.0', port=5006, debug=False)
\ No newline at end of file
@@ -0,0 +1,145 @@
+import collections
+
+import torch
+
+from modules import devices, shared
+
+
+def layer_fields(layer):
+    """names of tensors that networks change in the layer"""
+
+    if isinstance(layer, torch.nn.MultiheadAttention):
+        return ['in_proj_weight', 'out_proj.weight', 'out_proj.bias']
+
+    return ['weight', 'bias']
+
+
+def get_field(layer, field):
+    obj, _, name = field.rpartition('.')
+    return getattr(getattr(layer, obj) if obj else layer, name, None)
+
+
+def set_field(layer, field, value):
+    obj, _, name = field.rpartition('.')
+    obj = getattr(layer, obj) if obj else layer
+
+    current = getattr(obj, name, None)
+    if current is None:
+        setattr(obj, name, torch.nn.Parameter(value.to(devices.device if value.device.type == 'cpu' else value.device, copy=True), requires_grad=False))
+    else:
+        current.copy_(value)
+
+
+def tensor_bytes(tensors):
+    return sum(x.numel() * x.element_size() for x in tensors.values())
+
+
+class FusedWeightsCache:
+    """
+    LRU cache of layer weights with a particular set of networks applied to them, so that going back to a recently used
+    combination of networks and multipliers is a copy instead of calculating weights of all networks again.
+
+    Weights are kept on the device where the layer is while their total size is within lora_fused_cache_gpu_mb; older
+    combinations are then moved to CPU memory, and dropped when that exceeds lora_fused_cache_cpu_mb.
+    """
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.gpu_bytes = 0
+        self.cpu_bytes = 0
+
+    def enabled(self):
+        return shared.opts.lora_fused_cache_gpu_mb > 0 or shared.opts.lora_fused_cache_cpu_mb > 0
+
+    def clear(self):
+        self.entries.clear()
+        self.gpu_bytes = 0
+        self.cpu_bytes = 0
+
+    def get(self, key, layer_name):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        self.entries.move_to_end(key)
+        return entry.get(layer_name)
+
+    def apply(self, layer, tensors):
+        with torch.no_grad():
+            for field, value in tensors.items():
+                set_field(layer, field, value)
+
+    def remember(self, key, layer_name, layer, changed):
+        """stores weights of the layer after networks from key were applied to it; changed tells if they differ from the original weights at all"""
+
+        entry = self.entries.setdefault(key, {})
+        self.entries.move_to_end(key)
+        self.forget(entry, layer_name)
+
+        if not changed:
+            entry[layer_name] = {}
+            return
+
+        tensors = {field: value for field in layer_fields(layer) if (value := get_field(layer, field)) is not None}
+        size = tensor_bytes(tensors)
+        on_gpu = any(x.device.type != 'cpu' for x in tensors.values())
+
+        if on_gpu and self.make_room(key, size, gpu=True):
+            entry[layer_name] = {field: value.detach().clone() for field, value in tensors.items()}
+            self.gpu_bytes += size
+        elif self.make_room(key, size, gpu=False):
+            entry[layer_name] = {field: value.detach().to(devices.cpu, copy=True) for field, value in tensors.items()}
+            self.cpu_bytes += size
+
+    def make_room(self, key, size, gpu):
+        """evicts least recently used combinations, other than key, until size bytes fit into a tier; returns False if they can't fit"""
+
+        limit = (shared.opts.lora_fused_cache_gpu_mb if gpu else shared.opts.lora_fused_cache_cpu_mb) * 1024 * 1024
+        if size > limit:
+            return False
+
+        for other_key in list(self.entries):
+            if (self.gpu_bytes if gpu else self.cpu_bytes) + size <= limit:
+                break
+
+            if other_key == key:
+                continue
+
+            if gpu:
+                self.move_to_cpu(other_key)
+            else:
+                self.drop(other_key)
+
+        return (self.gpu_bytes if gpu else self.cpu_bytes) + size <= limit
+
+    def move_to_cpu(self, key):
+        entry = self.entries[key]
+        for layer_name, tensors in list(entry.items()):
+            if not any(x.device.type != 'cpu' for x in tensors.values()):
+                continue
+
+            size = tensor_bytes(tensors)
+            self.gpu_bytes -= size
+            if self.cpu_bytes + size <= shared.opts.lora_fused_cache_cpu_mb * 1024 * 1024:
+                entry[layer_name] = {field: value.to(devices.cpu) for field, value in tensors.items()}
+                self.cpu_bytes += size
+            else:
+                del entry[layer_name]
+
+    def forget(self, entry, layer_name):
+        tensors = entry.pop(layer_name, None)
+        if not tensors:
+            return
+
+        if any(x.device.type != 'cpu' for x in tensors.values()):
+            self.gpu_bytes -= tensor_bytes(tensors)
+        else:
+            self.cpu_bytes -= tensor_bytes(tensors)
+
+    def drop(self, key):
+        entry = self.entries.pop(key)
+        for layer_name in list(entry):
+            self.forget(entry, layer_name)
+
+
+cache = FusedWeightsCache()
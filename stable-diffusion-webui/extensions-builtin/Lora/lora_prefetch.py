@@ -0,0 +1,84 @@
+import collections
+import concurrent.futures
+import os
+import threading
+
+import torch
+
+from modules import devices, errors, sd_models, shared
+
+
+class LoraPrefetcher:
+    """
+    Reads Lora files ahead of time on a pool of background threads.
+
+    State dicts are read into CPU memory, pinned if CUDA is available, so that when the task that needs them gets its
+    turn, all that's left to do is the transfer to GPU. At most lora_prefetch_limit state dicts are kept; the oldest ones
+    are dropped if nobody takes them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.futures = collections.OrderedDict()
+
+    def enabled(self):
+        return shared.opts.lora_prefetch_limit > 0
+
+    def submit(self, filename):
+        mtime = os.path.getmtime(filename)
+
+        with self.lock:
+            entry = self.futures.get(filename)
+            if entry is not None and entry[0] == mtime:
+                return
+
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="lora-prefetch")
+
+            self.futures[filename] = (mtime, self.executor.submit(self.read, filename))
+
+            while len(self.futures) > shared.opts.lora_prefetch_limit:
+                _, (_, future) = self.futures.popitem(last=False)
+                future.cancel()
+
+    def read(self, filename):
+        sd = sd_models.read_state_dict(filename, map_location="cpu")
+
+        if torch.cuda.is_available():
+            sd = {k: v.pin_memory() if isinstance(v, torch.Tensor) else v for k, v in sd.items()}
+
+        return sd
+
+    def take(self, filename, mtime):
+        """returns state dict for the file moved to the device where networks are loaded, or None if it was not prefetched"""
+
+        with self.lock:
+            entry = self.futures.pop(filename, None)
+
+        if entry is None:
+            return None
+
+        prefetched_mtime, future = entry
+        if prefetched_mtime != mtime or future.cancelled():
+            future.cancel()
+            return None
+
+        try:
+            sd = future.result()
+        except Exception as e:
+            errors.display(e, f"prefetching network {filename}")
+            return None
+
+        device = shared.weight_load_location or devices.get_optimal_device_name()
+        return {k: v.to(device, non_blocking=True) if isinstance(v, torch.Tensor) else v for k, v in sd.items()}
+
+    def clear(self):
+        with self.lock:
+            for _, future in self.futures.values():
+                future.cancel()
+
+            self.futures.clear()
+
+
+prefetcher = LoraPrefetcher()
@@ -22,34 +22,24 @@ class SdVersion(enum.Enum):
 
 
 class NetworkOnDisk:
-    def __init__(self, name, filename):
+    def __init__(self, name, filename, catalog_entry=None):
         self.name = name
         self.filename = filename
-        self.metadata = {}
+        self._metadata = None
         self.is_safetensors = os.path.splitext(filename)[1].lower() == ".safetensors"
 
-        def read_metadata():
-            metadata = sd_models.read_metadata_from_safetensors(filename)
-
-            return metadata
-
-        if self.is_safetensors:
-            try:
-                self.metadata = cache.cached_data_for_file('safetensors-metadata', "lora/" + self.name, filename, read_metadata)
-            except Exception as e:
-                errors.display(e, f"reading lora {filename}")
-
-        if self.metadata:
-            m = {}
-            for k, v in sorted(self.metadata.items(), key=lambda x: metadata_tags_order.get(x[0], 999)):
-                m[k] = v
+        self.hash = None
+        self.shorthash = None
 
-            self.metadata = m
+        if catalog_entry is not None:
+            # created from Lora catalog: metadata is only read from cache when something asks for it
+            self.alias = catalog_entry['alias']
+            self.set_hash(catalog_entry.get('hash') or hashes.sha256_from_cache(self.filename, "lora/" + self.name, use_addnet_hash=self.is_safetensors) or '')
+            self.sd_version = SdVersion[catalog_entry['sd_version']]
+            return
 
         self.alias = self.metadata.get('ss_output_name', self.name)
 
-        self.hash = None
-        self.shorthash = None
         self.set_hash(
             self.metadata.get('sshs_model_hash') or
             hashes.sha256_from_cache(self.filename, "lora/" + self.name, use_addnet_hash=self.is_safetensors) or
@@ -58,6 +48,42 @@ class NetworkOnDisk:
 
         self.sd_version = self.detect_version()
 
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = self.read_metadata()
+
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, value):
+        self._metadata = value
+
+    def read_metadata(self):
+        metadata = {}
+
+        if self.is_safetensors:
+            try:
+                metadata = cache.cached_data_for_file('safetensors-metadata', "lora/" + self.name, self.filename, lambda: sd_models.read_metadata_from_safetensors(self.filename))
+            except Exception as e:
+                errors.display(e, f"reading lora {self.filename}")
+
+        if metadata:
+            metadata = dict(sorted(metadata.items(), key=lambda x: metadata_tags_order.get(x[0], 999)))
+
+        return metadata or {}
+
+    def catalog_entry(self, mtime):
+        """data for Lora catalog that allows creating this object again without reading the file"""
+
+        return {
+            "name": self.name,
+            "mtime": mtime,
+            "alias": self.alias,
+            "hash": self.hash,
+            "sd_version": self.sd_version.name,
+        }
+
     def detect_version(self):
         if str(self.metadata.get('ss_base_model_version', "")).startswith("sdxl_"):
             return SdVersion.SDXL
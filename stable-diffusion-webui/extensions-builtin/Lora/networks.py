@@ -3,8 +3,12 @@ import gradio as gr
 import logging
 import os
 import re
+import threading
+import time
 
 import lora_patches
+import lora_fused_weights
+import lora_prefetch
 import network
 import network_lora
 import network_glora
@@ -18,7 +22,7 @@ import network_oft
 import torch
 from typing import Union
 
-from modules import shared, devices, sd_models, errors, scripts, sd_hijack
+from modules import shared, devices, sd_models, errors, scripts, sd_hijack, cache, extra_networks
 import modules.textual_inversion.textual_inversion as textual_inversion
 import modules.models.sd3.mmdit
 
@@ -159,7 +163,9 @@ def load_network(name, network_on_disk):
     net = network.Network(name, network_on_disk)
     net.mtime = os.path.getmtime(network_on_disk.filename)
 
-    sd = sd_models.read_state_dict(network_on_disk.filename)
+    sd = lora_prefetch.prefetcher.take(network_on_disk.filename, net.mtime)
+    if sd is None:
+        sd = sd_models.read_state_dict(network_on_disk.filename)
 
     # this should not be needed but is here as an emergency fix for an unknown error people are experiencing in 1.2.0
     if not hasattr(shared.sd_model, 'network_layer_mapping'):
@@ -278,6 +284,33 @@ def purge_networks_from_memory():
     devices.torch_gc()
 
 
+def prefetch_networks(id_task, prompt):
+    """starts reading files of networks mentioned in the prompt of a queued task that are not in memory yet"""
+
+    if not prompt or not lora_prefetch.prefetcher.enabled():
+        return
+
+    _, extra_network_data = extra_networks.parse_prompt(prompt)
+    names = [params.items[0] for key in ('lora', 'lyco') for params in extra_network_data.get(key, []) if params.items]
+
+    for name in dict.fromkeys(names):
+        network_on_disk = available_networks.get(name) if name.lower() in forbidden_network_aliases else available_network_aliases.get(name)
+        if network_on_disk is None:
+            continue
+
+        net = networks_in_memory.get(name)
+        if net is not None and os.path.getmtime(network_on_disk.filename) <= net.mtime:
+            continue
+
+        lora_prefetch.prefetcher.submit(network_on_disk.filename)
+
+
+def forget_expired_missing_networks():
+    now = time.time()
+    for name in [name for name, timestamp in recently_missing_networks.items() if now - timestamp >= missing_network_rescan_interval]:
+        del recently_missing_networks[name]
+
+
 def load_networks(names, te_multipliers=None, unet_multipliers=None, dyn_dims=None):
     emb_db = sd_hijack.model_hijack.embedding_db
     already_loaded = {}
@@ -302,10 +335,13 @@ def load_networks(names, te_multipliers=None, unet_multipliers=None, dyn_dims=No
         update_available_networks_by_names(unavailable_networks)
 
     networks_on_disk = [available_networks.get(name, None) if name.lower() in forbidden_network_aliases else available_network_aliases.get(name, None) for name in names]
-    if any(x is None for x in networks_on_disk):
+    missing = [name for name, network_on_disk in zip(names, networks_on_disk) if network_on_disk is None]
+    forget_expired_missing_networks()
+    if missing and not all(time.time() - recently_missing_networks.get(name, 0) < missing_network_rescan_interval for name in missing):
         list_available_networks()
 
         networks_on_disk = [available_networks.get(name, None) if name.lower() in forbidden_network_aliases else available_network_aliases.get(name, None) for name in names]
+        recently_missing_networks.update({name: time.time() for name, network_on_disk in zip(names, networks_on_disk) if network_on_disk is None})
 
     failed_to_load_networks = []
 
@@ -408,6 +444,17 @@ def network_restore_weights_from_backup(self: Union[torch.nn.Conv2d, torch.nn.Li
         restore_weights_backup(self, 'bias', bias_backup)
 
 
+def fused_model_key():
+    """identifies the model whose layers are being changed; several models can be kept loaded and switched between without reloading weights"""
+
+    sd_model = shared.sd_model
+    return id(sd_model), getattr(sd_model, 'sd_model_checkpoint', None), getattr(sd_model, 'sd_model_hash', None)
+
+
+def forget_fused_weights(sd_model):
+    lora_fused_weights.cache.clear()
+
+
 def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.GroupNorm, torch.nn.LayerNorm, torch.nn.MultiheadAttention]):
     """
     Applies the currently selected set of networks to the weights of torch layer self.
@@ -453,6 +500,13 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
     if current_names != wanted_names:
         network_restore_weights_from_backup(self)
 
+        fused_key = (fused_model_key(), *((x.name, x.mtime, x.te_multiplier, x.unet_multiplier, x.dyn_dim) for x in loaded_networks)) if wanted_names and lora_fused_weights.cache.enabled() else None
+        fused = lora_fused_weights.cache.get(fused_key, network_layer_name) if fused_key else None
+        if fused is not None:
+            lora_fused_weights.cache.apply(self, fused)
+            self.network_current_names = wanted_names
+            return
+
         for net in loaded_networks:
             module = net.modules.get(network_layer_name, None)
             if module is not None and hasattr(self, 'weight') and not isinstance(module, modules.models.sd3.mmdit.QkvLinear):
@@ -539,6 +593,10 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
             logging.debug(f"Network {net.name} layer {network_layer_name}: couldn't find supported operation")
             extra_network_lora.errors[net.name] = extra_network_lora.errors.get(net.name, 0) + 1
 
+        if fused_key:
+            changed = any(network_layer_name in net.modules or network_layer_name + "_q_proj" in net.modules for net in loaded_networks)
+            lora_fused_weights.cache.remember(fused_key, network_layer_name, self, changed)
+
         self.network_current_names = wanted_names
 
 
@@ -647,9 +705,123 @@ def network_MultiheadAttention_load_state_dict(self, *args, **kwargs):
     return originals.MultiheadAttention_load_state_dict(self, *args, **kwargs)
 
 
-def process_network_files(names: list[str] | None = None):
+def read_catalog():
+    """returns Lora catalog: a dict of filename -> data needed to create NetworkOnDisk for the file without reading it"""
+
+    lora_catalog = cache.cache("lora-networks")
+
+    catalog = {}
+    for filename in lora_catalog:
+        catalog_entry = lora_catalog.get(filename)
+        if catalog_entry is not None:
+            catalog[filename] = catalog_entry
+
+    return catalog
+
+
+def catalog_index(catalog):
+    """returns a dict of name or alias -> list of filenames from Lora catalog"""
+
+    index = {}
+    for filename, catalog_entry in catalog.items():
+        for key in {catalog_entry['name'], catalog_entry['alias']}:
+            index.setdefault(key, []).append(filename)
+
+    return index
+
+
+def catalog_file_mtime():
+    """time of the last change to catalog on disk; SQLite writes go to the write-ahead log first, so it's checked as well"""
+
+    filename = os.path.join(cache.cache_dir, "lora-networks", "cache.db")
+    return max((os.path.getmtime(x) for x in (filename, f"{filename}-wal") if os.path.exists(x)), default=None)
+
+
+def loaded_catalog():
+    """returns Lora catalog and its index; they are kept in memory and read again only when the catalog file changes, and must not be modified"""
+
+    global catalog_in_memory
+
+    mtime = catalog_file_mtime()
+    with catalog_lock:
+        if catalog_in_memory is None or catalog_in_memory[0] != mtime:
+            catalog = read_catalog()
+            catalog_in_memory = (mtime, catalog, catalog_index(catalog))
+
+        return catalog_in_memory[1], catalog_in_memory[2]
+
+
+def write_catalog(catalog, previous, complete=False):
+    """saves entries of the catalog that differ from previous, one cache entry per file; if complete is True, entries for files not in catalog are removed"""
+
+    global catalog_in_memory
+
+    lora_catalog = cache.cache("lora-networks")
+
+    changed = {filename: catalog_entry for filename, catalog_entry in catalog.items() if previous.get(filename) != catalog_entry}
+    removed = previous.keys() - catalog.keys() if complete else set()
+    if not changed and not removed:
+        return
+
+    for filename, catalog_entry in changed.items():
+        lora_catalog[filename] = catalog_entry
+
+    for filename in removed:
+        if filename in lora_catalog:
+            del lora_catalog[filename]
+
+    # the copy in memory is replaced rather than changed, since other threads may be reading it
+    with catalog_lock:
+        if complete:
+            mtime, updated = catalog_file_mtime(), dict(catalog)
+        elif catalog_in_memory is not None:
+            mtime, updated = catalog_in_memory[0], {**catalog_in_memory[1], **changed}
+        else:
+            return
+
+        catalog_in_memory = (mtime, updated, catalog_index(updated))
+
+
+def network_on_disk_for_file(name, filename, catalog):
+    """creates NetworkOnDisk for file, using catalog if the file did not change since it was added there; updates catalog"""
+
+    mtime = os.path.getmtime(filename)
+
+    catalog_entry = catalog.get(filename)
+    if catalog_entry is not None and catalog_entry['name'] == name and catalog_entry['mtime'] == mtime:
+        try:
+            return network.NetworkOnDisk(name, filename, catalog_entry=catalog_entry)
+        except Exception:
+            pass
+
+    entry = network.NetworkOnDisk(name, filename)
+    catalog[filename] = entry.catalog_entry(mtime)
+    return entry
+
+
+def register_network_on_disk(entry):
+    available_networks[entry.name] = entry
+
+    if entry.alias in available_network_aliases:
+        forbidden_network_aliases[entry.alias.lower()] = 1
+
+    available_network_aliases[entry.name] = entry
+    available_network_aliases[entry.alias] = entry
+
+    if entry.shorthash:
+        available_network_hash_lookup[entry.shorthash] = entry
+
+
+def scan_network_files(names: list[str] | None = None):
+    """returns NetworkOnDisk for files in Lora directories, only for files with given names if names are provided"""
+
     candidates = list(shared.walk_files(shared.cmd_opts.lora_dir, allowed_extensions=[".pt", ".ckpt", ".safetensors"]))
     candidates += list(shared.walk_files(shared.cmd_opts.lyco_dir_backcompat, allowed_extensions=[".pt", ".ckpt", ".safetensors"]))
+
+    old_catalog = loaded_catalog()[0]
+    catalog = {} if names is None else dict(old_catalog)
+
+    res = []
     for filename in candidates:
         if os.path.isdir(filename):
             continue
@@ -658,34 +830,97 @@ def process_network_files(names: list[str] | None = None):
         if names and name not in names:
             continue
         try:
-            entry = network.NetworkOnDisk(name, filename)
+            if names is None and filename in old_catalog:
+                catalog[filename] = old_catalog[filename]
+
+            res.append(network_on_disk_for_file(name, filename, catalog))
         except OSError:  # should catch FileNotFoundError and PermissionError etc.
             errors.report(f"Failed to load network {name} from {filename}", exc_info=True)
             continue
 
-        available_networks[name] = entry
+    write_catalog(catalog, old_catalog, complete=names is None)
 
-        if entry.alias in available_network_aliases:
-            forbidden_network_aliases[entry.alias.lower()] = 1
+    return res
 
-        available_network_aliases[name] = entry
-        available_network_aliases[entry.alias] = entry
+
+def process_network_files(names: list[str] | None = None):
+    for entry in scan_network_files(names):
+        register_network_on_disk(entry)
 
 
 def update_available_networks_by_names(names: list[str]):
-    process_network_files(names)
+    """
+    finds networks by name or alias in Lora catalog. Lora directories are only looked through if the catalog is empty;
+    names that are not in the catalog are left for load_networks, which rescans directories for them now and then.
+    """
+
+    catalog, index = loaded_catalog()
+    if not catalog:
+        process_network_files(names)
+        return
+
+    found = {filename: catalog[filename] for name in names for filename in index.get(name, [])}
+    previous = dict(found)
+    for filename, catalog_entry in previous.items():
+        try:
+            entry = network_on_disk_for_file(catalog_entry['name'], filename, found)
+        except OSError:
+            continue
+
+        register_network_on_disk(entry)
+
+    write_catalog(found, previous)
 
 
 def list_available_networks():
-    available_networks.clear()
-    available_network_aliases.clear()
-    forbidden_network_aliases.clear()
-    available_network_hash_lookup.clear()
+    with list_available_networks_lock:
+        os.makedirs(shared.cmd_opts.lora_dir, exist_ok=True)
+
+        entries = scan_network_files()
+
+        available_networks.clear()
+        available_network_aliases.clear()
+        forbidden_network_aliases.clear()
+        available_network_hash_lookup.clear()
+        forbidden_network_aliases.update({"none": 1, "Addams": 1})
+
+        for entry in entries:
+            register_network_on_disk(entry)
+
+
+def list_available_networks_from_catalog():
+    """fills lists of available networks from Lora catalog without accessing the disk; returns False if the catalog is empty"""
+
+    catalog = loaded_catalog()[0]
+    if not catalog:
+        return False
+
     forbidden_network_aliases.update({"none": 1, "Addams": 1})
 
-    os.makedirs(shared.cmd_opts.lora_dir, exist_ok=True)
+    for filename, catalog_entry in catalog.items():
+        try:
+            entry = network.NetworkOnDisk(catalog_entry['name'], filename, catalog_entry=catalog_entry)
+        except Exception:
+            continue
+
+        register_network_on_disk(entry)
 
-    process_network_files()
+    return True
+
+
+def list_available_networks_on_startup():
+    if not list_available_networks_from_catalog():
+        list_available_networks()
+        return
+
+    # catalog may be out of date; the real list is made in background, and the catalog is used until it's ready
+    def list_in_background():
+        try:
+            list_available_networks()
+        except Exception:
+            errors.report("Error listing Lora networks", exc_info=True)
+
+    threading.Thread(target=list_in_background, daemon=True, name="lora-list").start()
 
 
 re_network_name = re.compile(r"(.*)\s*\([0-9a-fA-F]+\)")
@@ -733,5 +968,13 @@ loaded_bundle_embeddings = {}
 networks_in_memory = {}
 available_network_hash_lookup = {}
 forbidden_network_aliases = {}
+list_available_networks_lock = threading.Lock()
+
+recently_missing_networks = {}
+catalog_in_memory = None
+"""(mtime of catalog file, catalog, catalog index) as last read or written by this process"""
+catalog_lock = threading.Lock()
+missing_network_rescan_interval = 30
+"""networks that were not found after looking through Lora directories are not looked for again for this many seconds"""
 
-list_available_networks()
+list_available_networks_on_startup()
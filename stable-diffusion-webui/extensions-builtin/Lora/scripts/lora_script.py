@@ -27,9 +27,11 @@ def before_ui():
 networks.originals = lora_patches.LoraPatches()
 
 script_callbacks.on_model_loaded(networks.assign_network_names_to_compvis_modules)
+script_callbacks.on_model_loaded(networks.forget_fused_weights)
 script_callbacks.on_script_unloaded(unload)
 script_callbacks.on_before_ui(before_ui)
 script_callbacks.on_infotext_pasted(networks.infotext_pasted)
+script_callbacks.on_task_queued(networks.prefetch_networks)
 
 
 shared.options_templates.update(shared.options_section(('extra_networks', "Extra Networks"), {
@@ -40,6 +42,9 @@ shared.options_templates.update(shared.options_section(('extra_networks', "Extra
     "lora_show_all": shared.OptionInfo(False, "Always show all networks on the Lora page").info("otherwise, those detected as for incompatible version of Stable Diffusion will be hidden"),
     "lora_hide_unknown_for_versions": shared.OptionInfo([], "Hide networks of unknown versions for model versions", gr.CheckboxGroup, {"choices": ["SD1", "SD2", "SDXL"]}),
     "lora_in_memory_limit": shared.OptionInfo(0, "Number of Lora networks to keep cached in memory", gr.Number, {"precision": 0}),
+    "lora_prefetch_limit": shared.OptionInfo(0, "Number of Lora networks to read ahead for queued tasks", gr.Number, {"precision": 0}).info("0 = disable; files of networks mentioned in prompts of tasks waiting in queue are read into RAM in background"),
+    "lora_fused_cache_gpu_mb": shared.OptionInfo(0, "Memory for caching model weights with Lora applied, on GPU (MB)", gr.Number, {"precision": 0}).info("0 = disable; lets recently used combinations of Lora networks and weights be applied by copying instead of calculating"),
+    "lora_fused_cache_cpu_mb": shared.OptionInfo(0, "Memory for caching model weights with Lora applied, in RAM (MB)", gr.Number, {"precision": 0}).info("0 = disable; used for combinations that do not fit into GPU cache"),
     "lora_not_found_warning_console": shared.OptionInfo(False, "Lora not found warning in console"),
     "lora_not_found_gradio_warning": shared.OptionInfo(False, "Lora not found warning popup in webui"),
 }))
@@ -17,7 +17,7 @@ from fastapi.encoders import jsonable_encoder
 from secrets import compare_digest
 
 import modules.shared as shared
-from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, restart, shared_items, script_callbacks, infotext_utils, sd_models, sd_schedulers
+from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, restart, shared_items, script_callbacks, infotext_utils, sd_models, sd_schedulers, batching, fair_queue
 from modules.api import models
 from modules.shared import opts
 from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images
@@ -30,8 +30,8 @@ from modules import devices
 from typing import Any
 import piexif
 import piexif.helper
-from contextlib import closing
-from modules.progress import create_task_id, add_task_to_queue, start_task, finish_task, current_task
+from contextlib import closing, contextmanager
+from modules.progress import create_task_id, add_task_to_queue, start_task, finish_task, current_task, pending_tasks
 
 def script_name_to_index(name, scripts):
     try:
@@ -99,6 +99,18 @@ def decode_base64_to_image(encoding):
         raise HTTPException(status_code=500, detail="Invalid encoded image") from e
 
 
+def checkpoints_needed_by(args):
+    """checkpoints that generation with given arguments is going to load"""
+
+    names = [
+        (args.get('override_settings') or {}).get('sd_model_checkpoint') or opts.sd_model_checkpoint,
+        args.get('refiner_checkpoint'),
+        args.get('hr_checkpoint_name') if args.get('enable_hr') else None,
+    ]
+
+    return [sd_models.get_closet_checkpoint_match(x) for x in names if x not in (None, "", "None", "none", "Use same checkpoint")]
+
+
 def encode_pil_to_base64(image):
     with io.BytesIO() as output_bytes:
         if isinstance(image, str):
@@ -207,6 +219,7 @@ class Api:
         self.router = APIRouter()
         self.app = app
         self.queue_lock = queue_lock
+        self.batching = batching.BatchingScheduler(queue_lock)
         api_middleware(self.app)
         self.add_api_route("/sdapi/v1/txt2img", self.text2imgapi, methods=["POST"], response_model=models.TextToImageResponse)
         self.add_api_route("/sdapi/v1/img2img", self.img2imgapi, methods=["POST"], response_model=models.ImageToImageResponse)
@@ -244,6 +257,8 @@ class Api:
         self.add_api_route("/sdapi/v1/scripts", self.get_scripts_list, methods=["GET"], response_model=models.ScriptsList)
         self.add_api_route("/sdapi/v1/script-info", self.get_script_info, methods=["GET"], response_model=list[models.ScriptInfo])
         self.add_api_route("/sdapi/v1/extensions", self.get_extensions_list, methods=["GET"], response_model=list[models.ExtensionItem])
+        self.add_api_route("/sdapi/v1/hashing", self.get_hashing_progress, methods=["GET"], response_model=list[models.HashingItem])
+        self.add_api_route("/sdapi/v1/queue", self.get_queue_status, methods=["GET"], response_model=models.QueueStatusResponse)
 
         if shared.cmd_opts.api_server_stop:
             self.add_api_route("/sdapi/v1/server-kill", self.kill_webui, methods=["POST"])
@@ -283,6 +298,41 @@ class Api:
 
         raise HTTPException(status_code=401, detail="Incorrect username or password", headers={"WWW-Authenticate": "Basic"})
 
+    def queue_client_id(self, request: Request):
+        """
+        identifies the client for fair share in generation queue: by user name with API authentication, by X-Client-Id
+        header when the request comes through one of queue_trusted_proxies, and by address otherwise
+        """
+
+        if request is None:
+            return "api"
+
+        if shared.cmd_opts.api_auth:
+            authorization = request.headers.get("Authorization", "")
+            if authorization.lower().startswith("basic "):
+                try:
+                    return "user:" + base64.b64decode(authorization[6:]).decode("utf8").split(":", 1)[0]
+                except Exception:
+                    pass
+
+        host = request.client.host if request.client else None
+        trusted_proxies = {x.strip() for x in shared.opts.queue_trusted_proxies.split(",") if x.strip()}
+        if host in trusted_proxies and request.headers.get("X-Client-Id"):
+            return "client:" + request.headers["X-Client-Id"]
+
+        return f"ip:{host}" if host else "api"
+
+    @contextmanager
+    def queue_client(self, request: Request, task_id=None):
+        """accounts queue_lock use to the client that made the request, and rejects the request if the queue is full"""
+
+        with fair_queue.client_context(self.queue_client_id(request), fair_queue.PRIORITY_BATCH):
+            try:
+                yield
+            except fair_queue.QueueFullError as e:
+                pending_tasks.pop(task_id, None)
+                raise HTTPException(status_code=429, detail=str(e)) from e
+
     def get_selectable_script(self, script_name, script_runner):
         if script_name is None or script_name == "":
             return None, None
@@ -429,7 +479,7 @@ class Api:
 
         return params
 
-    def text2imgapi(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI):
+    def text2imgapi(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI, request: Request = None):
         task_id = txt2imgreq.force_task_id or create_task_id("txt2img")
 
         script_runner = scripts.scripts_txt2img
@@ -462,9 +512,9 @@ class Api:
         send_images = args.pop('send_images', True)
         args.pop('save_images', None)
 
-        add_task_to_queue(task_id)
+        add_task_to_queue(task_id, prompt=args.get('prompt'))
 
-        with self.queue_lock:
+        def run(args, task_ids):
             with closing(StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)) as p:
                 p.is_api = True
                 p.scripts = script_runner
@@ -473,23 +523,35 @@ class Api:
 
                 try:
                     shared.state.begin(job="scripts_txt2img")
-                    start_task(task_id)
+                    for id_task in task_ids:
+                        start_task(id_task)
                     if selectable_scripts is not None:
                         p.script_args = script_args
                         processed = scripts.scripts_txt2img.run(p, *p.script_args) # Need to pass args as list here
                     else:
                         p.script_args = tuple(script_args) # Need to pass args as tuple here
                         processed = process_images(p)
-                    finish_task(task_id)
+                    for id_task in task_ids:
+                        finish_task(id_task)
                 finally:
                     shared.state.end()
                     shared.total_tqdm.clear()
 
+            return processed
+
+        with self.queue_client(request, task_id), sd_models.checkpoint_preloader.wanted_by(task_id, checkpoints_needed_by(args)):
+            if batching.enabled() and batching.is_batchable(txt2imgreq, args, selectable_scripts):
+                batch_request = batching.BatchRequest(task_id, args)
+                processed = self.batching.submit(batching.batch_key("txt2img", args), batch_request, lambda merged_args, requests: run(merged_args, [x.task_id for x in requests]))
+            else:
+                with self.queue_lock:
+                    processed = run(args, [task_id])
+
         b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
 
         return models.TextToImageResponse(images=b64images, parameters=vars(txt2imgreq), info=processed.js())
 
-    def img2imgapi(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
+    def img2imgapi(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI, request: Request = None):
         task_id = img2imgreq.force_task_id or create_task_id("img2img")
 
         init_images = img2imgreq.init_images
@@ -522,6 +584,7 @@ class Api:
 
         args = vars(populate)
         args.pop('include_init_images', None)  # this is meant to be done by "exclude": True in model, but it's for a reason that I cannot determine.
+        args.pop('init_images', None)  # decoded and given to run() separately, so that they're not a part of the batching key
         args.pop('script_name', None)
         args.pop('script_args', None)  # will refeed them to the pipeline directly after initializing them
         args.pop('alwayson_scripts', None)
@@ -532,11 +595,11 @@ class Api:
         send_images = args.pop('send_images', True)
         args.pop('save_images', None)
 
-        add_task_to_queue(task_id)
+        add_task_to_queue(task_id, prompt=args.get('prompt'))
 
-        with self.queue_lock:
+        def run(args, task_ids, images):
             with closing(StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)) as p:
-                p.init_images = [decode_base64_to_image(x) for x in init_images]
+                p.init_images = images
                 p.is_api = True
                 p.scripts = script_runner
                 p.outpath_grids = opts.outdir_img2img_grids
@@ -544,18 +607,30 @@ class Api:
 
                 try:
                     shared.state.begin(job="scripts_img2img")
-                    start_task(task_id)
+                    for id_task in task_ids:
+                        start_task(id_task)
                     if selectable_scripts is not None:
                         p.script_args = script_args
                         processed = scripts.scripts_img2img.run(p, *p.script_args) # Need to pass args as list here
                     else:
                         p.script_args = tuple(script_args) # Need to pass args as tuple here
                         processed = process_images(p)
-                    finish_task(task_id)
+                    for id_task in task_ids:
+                        finish_task(id_task)
                 finally:
                     shared.state.end()
                     shared.total_tqdm.clear()
 
+            return processed
+
+        with self.queue_client(request, task_id), sd_models.checkpoint_preloader.wanted_by(task_id, checkpoints_needed_by(args)):
+            if batching.enabled() and batching.is_batchable(img2imgreq, args, selectable_scripts, init_images):
+                batch_request = batching.BatchRequest(task_id, args, init_image=decode_base64_to_image(init_images[0]))
+                processed = self.batching.submit(batching.batch_key("img2img", args), batch_request, lambda merged_args, requests: run(merged_args, [x.task_id for x in requests], [x.init_image for x in requests for _ in range(x.count)]))
+            else:
+                with self.queue_lock:
+                    processed = run(args, [task_id], [decode_base64_to_image(x) for x in init_images])
+
         b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
 
         if not img2imgreq.include_init_images:
@@ -564,23 +639,23 @@ class Api:
 
         return models.ImageToImageResponse(images=b64images, parameters=vars(img2imgreq), info=processed.js())
 
-    def extras_single_image_api(self, req: models.ExtrasSingleImageRequest):
+    def extras_single_image_api(self, req: models.ExtrasSingleImageRequest, request: Request = None):
         reqDict = setUpscalers(req)
 
         reqDict['image'] = decode_base64_to_image(reqDict['image'])
 
-        with self.queue_lock:
+        with self.queue_client(request), self.queue_lock:
             result = postprocessing.run_extras(extras_mode=0, image_folder="", input_dir="", output_dir="", save_output=False, **reqDict)
 
         return models.ExtrasSingleImageResponse(image=encode_pil_to_base64(result[0][0]), html_info=result[1])
 
-    def extras_batch_images_api(self, req: models.ExtrasBatchImagesRequest):
+    def extras_batch_images_api(self, req: models.ExtrasBatchImagesRequest, request: Request = None):
         reqDict = setUpscalers(req)
 
         image_list = reqDict.pop('imageList', [])
         image_folder = [decode_base64_to_image(x.data) for x in image_list]
 
-        with self.queue_lock:
+        with self.queue_client(request), self.queue_lock:
             result = postprocessing.run_extras(extras_mode=1, image_folder=image_folder, image="", input_dir="", output_dir="", save_output=False, **reqDict)
 
         return models.ExtrasBatchImagesResponse(images=list(map(encode_pil_to_base64, result[0])), html_info=result[1])
@@ -627,7 +702,7 @@ class Api:
 
         return models.ProgressResponse(progress=progress, eta_relative=eta_relative, state=shared.state.dict(), current_image=current_image, textinfo=shared.state.textinfo, current_task=current_task)
 
-    def interrogateapi(self, interrogatereq: models.InterrogateRequest):
+    def interrogateapi(self, interrogatereq: models.InterrogateRequest, request: Request = None):
         image_b64 = interrogatereq.image
         if image_b64 is None:
             raise HTTPException(status_code=404, detail="Image not found")
@@ -636,7 +711,7 @@ class Api:
         img = img.convert('RGB')
 
         # Override object param
-        with self.queue_lock:
+        with self.queue_client(request), self.queue_lock:
             if interrogatereq.model == "clip":
                 processed = shared.interrogator.interrogate(img)
             elif interrogatereq.model == "deepdanbooru":
@@ -768,16 +843,16 @@ class Api:
             "skipped": convert_embeddings(db.skipped_embeddings),
         }
 
-    def refresh_embeddings(self):
-        with self.queue_lock:
+    def refresh_embeddings(self, request: Request = None):
+        with self.queue_client(request), self.queue_lock:
             sd_hijack.model_hijack.embedding_db.load_textual_inversion_embeddings(force_reload=True)
 
-    def refresh_checkpoints(self):
-        with self.queue_lock:
+    def refresh_checkpoints(self, request: Request = None):
+        with self.queue_client(request), self.queue_lock:
             shared.refresh_checkpoints()
 
-    def refresh_vae(self):
-        with self.queue_lock:
+    def refresh_vae(self, request: Request = None):
+        with self.queue_client(request), self.queue_lock:
             shared_items.refresh_vae_list()
 
     def create_embedding(self, args: dict):
@@ -902,6 +977,13 @@ class Api:
                 })
         return ext_list
 
+    def get_queue_status(self):
+        return self.queue_lock.status()
+
+    def get_hashing_progress(self):
+        from modules import hashes
+        return hashes.hashing_progress()
+
     def launch(self, server_name, port, root_path):
         self.app.include_router(self.router)
         uvicorn.run(
@@ -327,3 +327,26 @@ class ExtensionItem(BaseModel):
     version: str = Field(title="Version", description="Extension Version")
     commit_date: str = Field(title="Commit Date", description="Extension Repository Commit Date")
     enabled: bool = Field(title="Enabled", description="Flag specifying whether this extension is enabled")
+
+
+class HashingItem(BaseModel):
+    filename: str = Field(title="Filename", description="Path to the file being hashed")
+    title: str = Field(title="Title", description="Cache key of the file")
+    priority: int = Field(title="Priority", description="0 = model being loaded, 1 = requested, 2 = background")
+    position: int = Field(title="Position", description="Number of bytes hashed so far")
+    total: int = Field(title="Total", description="Size of the file in bytes")
+    progress: float = Field(title="Progress", description="Fraction of the file hashed so far")
+    running: bool = Field(title="Running", description="Whether the file is being hashed right now, as opposed to waiting in queue")
+
+
+class QueueStatusResponse(BaseModel):
+    depth: int = Field(title="Depth", description="Number of requests waiting for the generation queue")
+    running: bool = Field(title="Running", description="Whether a request is being processed right now")
+    running_for: float = Field(title="Running for", description="Seconds since the current request started")
+    oldest_wait: float = Field(title="Oldest wait", description="Seconds the longest waiting request has been in queue")
+    waiting_by_class: dict = Field(title="Waiting by class", description="Number of waiting requests per priority class")
+    waiting_by_client: dict = Field(title="Waiting by client", description="Number of waiting requests per client")
+    usage_by_client: dict = Field(title="Usage by client", description="Recent GPU time in seconds per client, used for fair share")
+    rejected: int = Field(title="Rejected", description="Number of requests rejected because the queue was full")
+    wait_time: dict = Field(title="Wait time", description="Histogram of queue wait times in seconds per priority class")
+    depth_on_arrival: dict = Field(title="Depth on arrival", description="Histogram of queue depth seen by arriving requests")
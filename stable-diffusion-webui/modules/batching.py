@@ -0,0 +1,205 @@
+import copy
+import threading
+import time
+
+from modules import fair_queue, shared
+from modules.processing import get_fixed_seed
+
+fields_varying_in_batch = {'prompt', 'negative_prompt', 'seed', 'subseed', 'batch_size', 'force_task_id'}
+
+
+class BatchRequest:
+    def __init__(self, task_id, args, init_image=None):
+        self.task_id = task_id
+        self.args = args
+        self.init_image = init_image
+        self.count = args.get('batch_size') or 1
+        self.client = fair_queue.current_client()
+
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchGroup:
+    def __init__(self, key):
+        self.key = key
+        self.requests = []
+        self.closed = False
+
+    @property
+    def count(self):
+        return sum(x.count for x in self.requests)
+
+
+def enabled():
+    return shared.opts.api_batching_window > 0 and shared.opts.api_batching_max_size > 1
+
+
+def is_batchable(req, args, selectable_scripts, init_images=None):
+    """tells if an API request can be combined with other requests into one batch"""
+
+    if selectable_scripts is not None or req.alwayson_scripts or req.infotext:
+        return False
+
+    if args.get('n_iter', 1) != 1 or args.get('batch_size', 1) > shared.opts.api_batching_max_size:
+        return False
+
+    if not isinstance(args.get('prompt', ''), str) or not isinstance(args.get('negative_prompt', ''), str) or isinstance(args.get('seed'), list) or isinstance(args.get('subseed'), list):
+        return False
+
+    # a combined batch has no grid, so requests that would get one are run on their own
+    if args.get('batch_size', 1) > 1 and not args.get('do_not_save_grid'):
+        return False
+
+    if init_images is not None and (len(init_images) != 1 or args.get('mask') is not None):
+        return False
+
+    return True
+
+
+def batch_key(kind, args):
+    return kind, repr([(k, v) for k, v in sorted(args.items(), key=lambda x: x[0]) if k not in fields_varying_in_batch])
+
+
+def merge_args(requests):
+    """creates arguments for a single processing object that generates images for all requests, keeping their prompts and seeds"""
+
+    args = dict(requests[0].args)
+    prompts = []
+    negative_prompts = []
+    seeds = []
+    subseeds = []
+
+    for request in requests:
+        seed = get_fixed_seed(request.args.get('seed', -1))
+        subseed = get_fixed_seed(request.args.get('subseed', -1))
+        subseed_strength = request.args.get('subseed_strength', 0)
+
+        prompts += [request.args.get('prompt', '')] * request.count
+        negative_prompts += [request.args.get('negative_prompt', '')] * request.count
+        seeds += [int(seed) + (x if subseed_strength == 0 else 0) for x in range(request.count)]
+        subseeds += [int(subseed) + x for x in range(request.count)]
+
+        # remember the seeds actually used so that they can be reported back even if the batch fails
+        request.args = dict(request.args, seed=seed, subseed=subseed)
+
+    args.update(prompt=prompts, negative_prompt=negative_prompts, seed=seeds, subseed=subseeds, batch_size=len(prompts), n_iter=1, do_not_save_grid=True)
+
+    return args
+
+
+def split_processed(processed, requests):
+    """creates a separate Processed for every request out of Processed for the combined batch"""
+
+    first = processed.index_of_first_image
+    if len(processed.images) - first != sum(x.count for x in requests):
+        # there's no telling which images belong to which request, and each of them may be from a different client
+        raise RuntimeError(f"Batched generation returned {len(processed.images) - first} images for {sum(x.count for x in requests)} requested")
+
+    results = []
+    position = 0
+    for request in requests:
+        part = slice(position, position + request.count)
+        position += request.count
+
+        res = copy.copy(processed)
+        res.images = processed.images[first:][part]
+        res.all_prompts = processed.all_prompts[part]
+        res.all_negative_prompts = processed.all_negative_prompts[part]
+        res.all_seeds = processed.all_seeds[part]
+        res.all_subseeds = processed.all_subseeds[part]
+        res.infotexts = processed.infotexts[first:][part]
+        res.prompt = request.args.get('prompt', '')
+        res.negative_prompt = request.args.get('negative_prompt', '')
+        res.seed = res.all_seeds[0]
+        res.subseed = res.all_subseeds[0]
+        res.batch_size = request.count
+        res.index_of_first_image = 0
+        res.info = res.infotexts[0] if res.infotexts else processed.info
+
+        results.append(res)
+
+    return results
+
+
+class BatchingScheduler:
+    """
+    Combines compatible API generation requests into one batch.
+
+    The first request of a group waits for api_batching_window milliseconds; requests that arrive meanwhile with the same
+    parameters (except for prompts and seeds) join its group, up to api_batching_max_size images. The group is then
+    closed, waits for queue_lock and is generated as a single batch, and the results are split back per request. GPU
+    time of the batch is accounted to the clients of its requests in proportion to the number of images they asked for.
+    Every request of the group gets the error if waiting for the queue or generation fails.
+    """
+
+    def __init__(self, queue_lock):
+        self.queue_lock = queue_lock
+        self.lock = threading.Condition()
+        self.open_groups = {}
+
+    def submit(self, key, request, run):
+        """
+        Generates images for request, possibly in one batch with others; run(args, requests) must do the generation
+        with combined arguments and return Processed. Returns Processed for this request.
+        """
+
+        with self.lock:
+            group = self.open_groups.get(key)
+            if group is not None and group.count + request.count <= shared.opts.api_batching_max_size:
+                group.requests.append(request)
+                if group.count >= shared.opts.api_batching_max_size:
+                    self.close(group)
+                    self.lock.notify_all()
+
+                leader = False
+            else:
+                group = BatchGroup(key)
+                group.requests.append(request)
+                self.open_groups[key] = group
+                leader = True
+
+        if leader:
+            self.run_group(group, run)
+        else:
+            request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        return request.result
+
+    def close(self, group):
+        group.closed = True
+        if self.open_groups.get(group.key) is group:
+            del self.open_groups[group.key]
+
+    def run_group(self, group, run):
+        deadline = time.time() + shared.opts.api_batching_window / 1000
+
+        with self.lock:
+            while not group.closed and time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+
+            # closed before waiting for the queue, so that nothing joins a group that may never run
+            self.close(group)
+            requests = list(group.requests)
+
+        try:
+            with self.queue_lock:
+                shares = {}
+                for request in requests:
+                    shares[request.client] = shares.get(request.client, 0) + request.count
+                self.queue_lock.share_usage(shares)
+
+                processed = run(merge_args(requests), requests)
+                for request, result in zip(requests, split_processed(processed, requests)):
+                    request.result = result
+        except BaseException as e:
+            for request in requests:
+                request.error = e
+        finally:
+            for request in requests:
+                request.done.set()
+
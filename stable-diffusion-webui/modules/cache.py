@@ -1,7 +1,9 @@
+import atexit
 import json
 import os
 import os.path
 import threading
+from collections import OrderedDict
 
 import diskcache
 import tqdm
@@ -10,14 +12,117 @@ from modules.paths import data_path, script_path
 
 cache_filename = os.environ.get('SD_WEBUI_CACHE_FILE', os.path.join(data_path, "cache.json"))
 cache_dir = os.environ.get('SD_WEBUI_CACHE_DIR', os.path.join(data_path, "cache"))
+memory_items = int(os.environ.get('SD_WEBUI_CACHE_MEMORY_ITEMS', 16384))
+write_delay = float(os.environ.get('SD_WEBUI_CACHE_WRITE_DELAY', 1.0))
 caches = {}
 cache_lock = threading.Lock()
 
+missing = object()
+
+
+class FrontCache:
+    """
+    In-memory read-through layer over a diskcache subsection.
+
+    Reads are served from a bounded LRU dict, including lookups of keys that are not in the cache. Writes go to
+    memory immediately and are saved to SQLite in batches, in one transaction, after write_delay seconds or on
+    dump_cache().
+    """
+
+    def __init__(self, disk: diskcache.Cache, max_items=memory_items):
+        self.disk = disk
+        self.max_items = max_items
+        self.memory = OrderedDict()
+        self.pending = {}
+        self.lock = threading.RLock()
+        self.timer = None
+
+    def remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.memory:
+                value = self.memory[key]
+                self.memory.move_to_end(key)
+            else:
+                value = self.disk.get(key, missing)
+                self.remember(key, value)
+
+        return default if value is missing else value
+
+    def __contains__(self, key):
+        return self.get(key, missing) is not missing
+
+    def __getitem__(self, key):
+        value = self.get(key, missing)
+        if value is missing:
+            raise KeyError(key)
+
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.remember(key, value)
+            self.pending[key] = value
+
+            if self.timer is None:
+                self.timer = threading.Timer(write_delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+
+            self.flush()
+            self.remember(key, missing)
+            self.disk.pop(key, None)
+
+    def flush(self):
+        """saves pending writes to disk"""
+
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            if not self.pending:
+                return
+
+            pending = self.pending
+            self.pending = {}
+
+            with self.disk.transact():
+                for key, value in pending.items():
+                    self.disk[key] = value
+
+    def __len__(self):
+        self.flush()
+        return len(self.disk)
+
+    def __iter__(self):
+        self.flush()
+        return iter(self.disk)
+
+    def __getattr__(self, item):
+        # everything else is done by diskcache directly, after pending writes are saved
+        self.flush()
+        return getattr(self.disk, item)
+
 
 def dump_cache():
-    """old function for dumping cache to disk; does nothing since diskcache."""
+    """saves all pending writes of in-memory caches to disk."""
+
+    for cache_obj in list(caches.values()):
+        cache_obj.flush()
+
 
-    pass
+atexit.register(dump_cache)
 
 
 def make_cache(subsection: str) -> diskcache.Cache:
@@ -45,13 +150,15 @@ def convert_old_cached_data():
         for subsection, keyvalues in data.items():
             cache_obj = caches.get(subsection)
             if cache_obj is None:
-                cache_obj = make_cache(subsection)
+                cache_obj = FrontCache(make_cache(subsection))
                 caches[subsection] = cache_obj
 
             for key, value in keyvalues.items():
                 cache_obj[key] = value
                 progress.update(1)
 
+    dump_cache()
+
 
 def cache(subsection):
     """
@@ -61,18 +168,18 @@ def cache(subsection):
         subsection (str): The subsection identifier for the cache.
 
     Returns:
-        diskcache.Cache: The cache data for the specified subsection.
+        FrontCache: The cache data for the specified subsection, backed by diskcache.
     """
 
     cache_obj = caches.get(subsection)
-    if not cache_obj:
+    if cache_obj is None:
         with cache_lock:
             if not os.path.exists(cache_dir) and os.path.isfile(cache_filename):
                 convert_old_cached_data()
 
             cache_obj = caches.get(subsection)
-            if not cache_obj:
-                cache_obj = make_cache(subsection)
+            if cache_obj is None:
+                cache_obj = FrontCache(make_cache(subsection))
                 caches[subsection] = cache_obj
 
     return cache_obj
@@ -118,6 +225,4 @@ def cached_data_for_file(subsection, title, filename, func):
         entry = {'mtime': ondisk_mtime, 'value': value}
         existing_cache[title] = entry
 
-        dump_cache()
-
     return entry['value']
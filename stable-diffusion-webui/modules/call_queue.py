@@ -3,9 +3,9 @@ from functools import wraps
 import html
 import time
 
-from modules import shared, progress, errors, devices, fifo_lock, profiling
+from modules import shared, progress, errors, devices, fair_queue, profiling
 
-queue_lock = fifo_lock.FIFOLock()
+queue_lock = fair_queue.FairQueueLock()
 
 
 def wrap_queued_call(func):
@@ -25,11 +25,17 @@ def wrap_gradio_gpu_call(func, extra_outputs=None):
         # if the first argument is a string that says "task(...)", it is treated as a job id
         if args and type(args[0]) == str and args[0].startswith("task(") and args[0].endswith(")"):
             id_task = args[0]
-            progress.add_task_to_queue(id_task)
+            progress.add_task_to_queue(id_task, prompt="\n".join(x for x in args[1:] if isinstance(x, str)))
         else:
             id_task = None
 
-        with queue_lock:
+        try:
+            queue_lock.acquire()
+        except fair_queue.QueueFullError:
+            progress.pending_tasks.pop(id_task, None)
+            raise
+
+        try:
             shared.state.begin(job=id_task)
             progress.start_task(id_task)
 
@@ -40,6 +46,8 @@ def wrap_gradio_gpu_call(func, extra_outputs=None):
                 progress.finish_task(id_task)
 
             shared.state.end()
+        finally:
+            queue_lock.release()
 
         return res
 
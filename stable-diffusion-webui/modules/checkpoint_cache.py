@@ -0,0 +1,365 @@
+import collections
+import concurrent.futures
+import contextlib
+import os
+import threading
+import time
+
+import safetensors.torch
+import torch
+
+from modules import devices, errors, shared
+
+TIER_RAM = "ram"
+"""state dict copied to RAM, page-locked if CUDA is available"""
+
+TIER_MMAP = "mmap"
+"""tensors backed by a memory-mapped safetensors file"""
+
+assumed_read_speed = 500 * 1024 * 1024
+"""bytes per second, for checkpoints that were not read from disk by get_checkpoint_state_dict"""
+
+
+def state_dict_size(sd):
+    return sum(v.numel() * v.element_size() for v in sd.values() if isinstance(v, torch.Tensor))
+
+
+def open_mmap(filename):
+    """returns state dict of a safetensors checkpoint whose tensors are views into the memory-mapped file"""
+
+    from modules import sd_models
+
+    return sd_models.get_state_dict_from_checkpoint(safetensors.torch.load_file(filename, device="cpu"))
+
+
+class CachedCheckpoint:
+    def __init__(self, checkpoint_info, state_dict, tier, size, load_time):
+        self.checkpoint_info = checkpoint_info
+        self.state_dict = state_dict
+        self.tier = tier
+        self.size = size
+        self.load_time = load_time
+        self.credit = 0.0
+
+    @property
+    def is_safetensors(self):
+        return os.path.splitext(self.checkpoint_info.filename)[1].lower() == ".safetensors"
+
+
+class CheckpointCache:
+    """
+    State dicts of recently used checkpoints, so that switching back to them does not need reading them from disk.
+
+    This sits below the models kept loaded on device (model_data.loaded_sd_models) and has two tiers: state dicts copied
+    to RAM, limited by sd_checkpoint_cache_ram_mb and sd_checkpoint_cache, and memory-mapped safetensors files, limited by
+    sd_checkpoint_cache_mmap_mb, which use no memory of their own besides the OS page cache. RAM copies are page-locked
+    when CUDA is available, so they are transferred to GPU at full speed. Checkpoints pushed out of RAM go to the mmap
+    tier if they are safetensors.
+
+    Eviction is GreedyDual-Size: an entry gets credit equal to how long it took to read from disk per GB on top of a
+    value that rises with every eviction, so entries that are slow to read again stay longer, and ones that are not used
+    drift to the bottom. Checkpoints whose model is kept loaded on device go first.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.load_times = {}
+        self.inflation = 0.0
+
+    def enabled(self, tier=None):
+        ram = shared.opts.sd_checkpoint_cache > 0 or shared.opts.sd_checkpoint_cache_ram_mb > 0
+        mmap = shared.opts.sd_checkpoint_cache_mmap_mb > 0
+
+        if tier == TIER_RAM:
+            return ram
+        if tier == TIER_MMAP:
+            return mmap
+
+        return ram or mmap
+
+    def __contains__(self, checkpoint_info):
+        return checkpoint_info in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __getitem__(self, checkpoint_info):
+        """returns a shallow copy of the cached state dict, so that the caller can pop tensors out of it"""
+
+        with self.lock:
+            entry = self.entries[checkpoint_info]
+            self.touch(entry)
+            return dict(entry.state_dict)
+
+    def __setitem__(self, checkpoint_info, state_dict):
+        self.store(checkpoint_info, state_dict)
+
+    def __delitem__(self, checkpoint_info):
+        with self.lock:
+            del self.entries[checkpoint_info]
+
+    def pop(self, checkpoint_info, default=None):
+        with self.lock:
+            entry = self.entries.pop(checkpoint_info, None)
+            return default if entry is None else entry.state_dict
+
+    def move_to_end(self, checkpoint_info):
+        with self.lock:
+            self.touch(self.entries[checkpoint_info])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def record_load_time(self, checkpoint_info, seconds):
+        self.load_times[checkpoint_info] = seconds
+
+    def touch(self, entry):
+        entry.credit = self.inflation + entry.load_time / max(entry.size / 1024 ** 3, 1e-3)
+
+    def tier_limits(self, tier):
+        """returns (bytes, count) the tier can hold, None meaning no limit"""
+
+        if tier == TIER_RAM:
+            return (shared.opts.sd_checkpoint_cache_ram_mb * 1024 * 1024 or None), (shared.opts.sd_checkpoint_cache or None)
+
+        return shared.opts.sd_checkpoint_cache_mmap_mb * 1024 * 1024, None
+
+    def fits(self, tier, size, count=1):
+        max_bytes, max_count = self.tier_limits(tier)
+        entries = [x for x in self.entries.values() if x.tier == tier]
+
+        if max_bytes is not None and sum(x.size for x in entries) + size > max_bytes:
+            return False
+
+        return max_count is None or len(entries) + count <= max_count
+
+    def eviction_order(self, tier, exclude=None):
+        from modules import sd_models
+
+        resident = {m.sd_checkpoint_info.filename for m in sd_models.model_data.loaded_sd_models if getattr(m, "sd_checkpoint_info", None) is not None}
+        entries = [x for x in self.entries.values() if x.tier == tier and x.checkpoint_info is not exclude]
+
+        return sorted(entries, key=lambda x: (x.checkpoint_info.filename not in resident, x.credit))
+
+    def make_room(self, tier, size, exclude=None):
+        """evicts entries from the tier until an entry of given size fits into it; returns False if it can't fit"""
+
+        max_bytes, _ = self.tier_limits(tier)
+        if max_bytes is not None and size > max_bytes:
+            return False
+
+        for entry in self.eviction_order(tier, exclude):
+            if self.fits(tier, size):
+                break
+
+            self.evict(entry)
+
+        return self.fits(tier, size)
+
+    def evict(self, entry):
+        self.inflation = max(self.inflation, entry.credit)
+        self.entries.pop(entry.checkpoint_info, None)
+
+        if entry.tier == TIER_RAM and entry.is_safetensors and self.enabled(TIER_MMAP) and self.make_room(TIER_MMAP, entry.size):
+            try:
+                entry.state_dict = open_mmap(entry.checkpoint_info.filename)
+            except Exception as e:
+                errors.display(e, f"memory-mapping {entry.checkpoint_info.filename}")
+                return
+
+            entry.tier = TIER_MMAP
+            self.entries[entry.checkpoint_info] = entry
+
+    def to_ram(self, state_dict):
+        pin = shared.opts.sd_checkpoint_cache_pin_memory and torch.cuda.is_available()
+
+        res = {}
+        for k, v in state_dict.items():
+            if isinstance(v, torch.Tensor):
+                v = v.to(devices.cpu)
+                if pin:
+                    try:
+                        v = v.pin_memory()
+                    except RuntimeError:
+                        pin = False
+
+            res[k] = v
+
+        return res
+
+    def store(self, checkpoint_info, state_dict):
+        """puts state dict of a checkpoint that has just been loaded into the highest tier that has room for it"""
+
+        with self.lock:
+            entry = self.entries.get(checkpoint_info)
+            if entry is not None:
+                self.touch(entry)
+                return
+
+            if not self.enabled():
+                return
+
+            size = state_dict_size(state_dict)
+            load_time = self.load_times.pop(checkpoint_info, None) or size / assumed_read_speed
+            entry = CachedCheckpoint(checkpoint_info, None, None, size, load_time)
+
+            if self.enabled(TIER_RAM) and self.make_room(TIER_RAM, size, exclude=checkpoint_info):
+                entry.state_dict = self.to_ram(state_dict)
+                entry.tier = TIER_RAM
+            elif entry.is_safetensors and self.enabled(TIER_MMAP) and self.make_room(TIER_MMAP, size, exclude=checkpoint_info):
+                entry.state_dict = open_mmap(checkpoint_info.filename)
+                entry.tier = TIER_MMAP
+            else:
+                return
+
+            self.touch(entry)
+            self.entries[checkpoint_info] = entry
+
+    def trim(self):
+        """evicts entries that are over the limits, for when the limits have been changed in settings"""
+
+        with self.lock:
+            for tier in (TIER_RAM, TIER_MMAP):
+                if not self.enabled(tier):
+                    for entry in [x for x in self.entries.values() if x.tier == tier]:
+                        self.evict(entry)
+                    continue
+
+                for entry in self.eviction_order(tier):
+                    if self.fits(tier, 0, count=0):
+                        break
+
+                    self.evict(entry)
+
+
+class CheckpointPreloader:
+    """
+    Reads state dicts of checkpoints that queued or running jobs are going to switch to, on a background thread, so
+    that the switch does not have to wait for the disk.
+
+    Jobs tell which checkpoints they need with want(); the first sd_checkpoint_preload of those, in order of the jobs,
+    that are not kept loaded and not in checkpoint cache are read into RAM, page-locked if CUDA is available.
+    get_checkpoint_state_dict takes them from here.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.wanted = collections.OrderedDict()
+        self.futures = {}
+        self.taken = None
+
+    def enabled(self):
+        return shared.opts.sd_checkpoint_preload > 0
+
+    def want(self, key, checkpoint_infos, first=False):
+        """records that the job identified by key is going to need checkpoints; first=True is for the job that is running now"""
+
+        checkpoint_infos = [x for x in checkpoint_infos if x is not None]
+        if not checkpoint_infos or not self.enabled():
+            return
+
+        with self.lock:
+            wanted = self.wanted.setdefault(key, [])
+            wanted += [x for x in checkpoint_infos if x not in wanted]
+            if first:
+                self.wanted.move_to_end(key, last=False)
+
+            self.schedule()
+
+    def done(self, key):
+        with self.lock:
+            if self.wanted.pop(key, None) is not None:
+                self.schedule()
+
+    @contextlib.contextmanager
+    def wanted_by(self, key, checkpoint_infos):
+        self.want(key, checkpoint_infos)
+        try:
+            yield
+        finally:
+            self.done(key)
+
+    def is_loaded(self, checkpoint_info):
+        from modules import sd_models
+
+        if checkpoint_info is self.taken or checkpoint_info in sd_models.checkpoints_loaded:
+            return True
+
+        return any(getattr(m, "sd_checkpoint_info", None) is not None and m.sd_checkpoint_info.filename == checkpoint_info.filename for m in sd_models.model_data.loaded_sd_models)
+
+    def schedule(self):
+        """starts reading checkpoints that are needed next, and forgets ones that are not needed anymore; must be called with lock held"""
+
+        needed = []
+        for checkpoint_infos in self.wanted.values():
+            needed += [x for x in checkpoint_infos if x not in needed and not self.is_loaded(x)]
+
+        needed = needed[:shared.opts.sd_checkpoint_preload]
+
+        for checkpoint_info in [x for x in self.futures if x not in needed]:
+            self.futures.pop(checkpoint_info).cancel()
+
+        for checkpoint_info in needed:
+            if checkpoint_info in self.futures:
+                continue
+
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint-preload")
+
+            self.futures[checkpoint_info] = self.executor.submit(self.read, checkpoint_info)
+
+    def read(self, checkpoint_info):
+        from modules import sd_models
+
+        started = time.time()
+        sd = sd_models.read_state_dict(checkpoint_info.filename, map_location="cpu")
+
+        pin = shared.opts.sd_checkpoint_cache_pin_memory and torch.cuda.is_available()
+        is_safetensors = os.path.splitext(checkpoint_info.filename)[1].lower() == ".safetensors"
+
+        for k, v in sd.items():
+            if not isinstance(v, torch.Tensor):
+                continue
+
+            if pin:
+                sd[k] = v.pin_memory()
+            elif is_safetensors:
+                # tensors are views into the memory-mapped file; read them now rather than when the model is loaded
+                sd[k] = v.clone()
+
+        print(f"Preloaded weights of {checkpoint_info.title} in {time.time() - started:.1f}s")
+
+        return sd, time.time() - started
+
+    def take(self, checkpoint_info):
+        """returns (state dict, seconds it took to read) if the checkpoint has been preloaded or is being preloaded now, otherwise None"""
+
+        with self.lock:
+            future = self.futures.pop(checkpoint_info, None)
+            if future is None:
+                return None
+
+            # cancel only succeeds if reading has not started yet, and then it's just as good to read it right away
+            if future.cancel():
+                return None
+
+            self.taken = checkpoint_info
+
+        try:
+            return future.result()
+        except Exception as e:
+            errors.display(e, f"preloading checkpoint {checkpoint_info.filename}")
+            return None
+
+    def loaded(self):
+        """to be called after a model has been loaded, to start preloading the next checkpoint"""
+
+        with self.lock:
+            self.taken = None
+            self.schedule()
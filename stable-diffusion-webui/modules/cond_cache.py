@@ -0,0 +1,101 @@
+import collections
+import threading
+
+import torch
+
+from modules import shared
+
+
+def cond_bytes(cond):
+    if isinstance(cond, torch.Tensor):
+        return cond.numel() * cond.element_size()
+
+    if isinstance(cond, dict):
+        return sum(cond_bytes(x) for x in cond.values())
+
+    if isinstance(cond, (list, tuple)):
+        return sum(cond_bytes(x) for x in cond)
+
+    return 0
+
+
+def extra_network_key(extra_network_data):
+    """hashable version of extra network data parsed from prompts"""
+
+    return tuple((name, tuple(tuple(str(x) for x in params.items) for params in params_list)) for name, params_list in sorted((extra_network_data or {}).items()))
+
+
+class ConditioningCache:
+    """
+    LRU cache of prompt schedules encoded by the text encoder, shared by all requests, so that prompts that come up
+    again and again - common negative prompts and styles - are not encoded every time.
+
+    Entries are keyed by everything that affects the result: the model and its text encoder state, which processing
+    describes with cached_params, and the prompt with its steps. Total size of cached conds, which stay on the device
+    where the text encoder put them, is kept within cond_cache_mb.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self):
+        return shared.opts.cond_cache_mb > 0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def store(self, key, value):
+        size = cond_bytes(value)
+        limit = shared.opts.cond_cache_mb * 1024 * 1024
+        if size > limit:
+            return
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+
+            while self.entries and self.size + size > limit:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+    def view(self, state):
+        """returns a dict-like object for prompt_parser.get_learned_conditioning that stores entries under the model state"""
+
+        return ConditioningCacheView(self, state)
+
+
+class ConditioningCacheView:
+    def __init__(self, cache, state):
+        self.cache = cache
+        self.state = state
+
+    def get(self, key, default=None):
+        res = self.cache.get((self.state, key))
+        return default if res is None else res
+
+    def __setitem__(self, key, value):
+        self.cache.store((self.state, key), value)
+
+
+cache = ConditioningCache()
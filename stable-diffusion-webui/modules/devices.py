@@ -92,6 +92,31 @@ def torch_gc():
         npu_specific.torch_npu_gc()
 
 
+def measure_memory(func, estimate, target_device=None):
+    """
+    Calls func() and returns its result along with how many bytes of memory it needed on top of what was allocated before.
+
+    CUDA peak memory statistics are not reset, so that the memory monitor still reports the peak of the whole job. The
+    need is therefore only known exactly if func raised the peak; otherwise estimate(result) is used, capped by the
+    previous peak that func stayed under. On other devices estimate(result) is always used.
+    """
+
+    target_device = torch.device(target_device or device)
+    if target_device.type != "cuda":
+        result = func()
+        return result, estimate(result)
+
+    peak = torch.cuda.max_memory_allocated(target_device)
+    allocated = torch.cuda.memory_allocated(target_device)
+    result = func()
+    new_peak = torch.cuda.max_memory_allocated(target_device)
+
+    if new_peak > peak:
+        return result, new_peak - allocated
+
+    return result, min(estimate(result), peak - allocated)
+
+
 def torch_npu_set_device():
     # Work around due to bug in torch_npu, revert me after fixed, @see https://gitee.com/ascend/pytorch/issues/I8KECW?from=project-issue
     if npu_specific.has_npu:
@@ -1,7 +1,10 @@
+import collections
+import concurrent.futures
 import os
 import re
 import shutil
 import json
+import threading
 
 
 import torch
@@ -72,6 +75,134 @@ def to_half(tensor, enable):
     return tensor
 
 
+safetensors_dtypes = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+if hasattr(torch, "float8_e4m3fn"):
+    safetensors_dtypes.update({"F8_E4M3": torch.float8_e4m3fn, "F8_E5M2": torch.float8_e5m2})
+
+
+class SafetensorsCheckpoint:
+    """
+    Tensors of a .safetensors checkpoint, under the same names as read_state_dict would give them, read one by one
+    from the memory-mapped file when needed, rather than all at once.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+        self.keys = {}
+        self.shapes = {}
+        self.dtypes = {}
+
+        with safetensors.safe_open(filename, framework="pt", device="cpu") as file:
+            keys = list(file.keys())
+            for key in keys:
+                tensor_slice = file.get_slice(key)
+                self.shapes[key] = tensor_slice.get_shape()
+                self.dtypes[key] = safetensors_dtypes[tensor_slice.get_dtype()]
+
+        ln_final = 'conditioner.embedders.0.model.ln_final.weight'
+        is_sd2_turbo = ln_final in self.shapes and self.shapes[ln_final][0] == 1024
+        replacements = sd_models.checkpoint_dict_replacements_sd2_turbo if is_sd2_turbo else sd_models.checkpoint_dict_replacements_sd1
+
+        for key in keys:
+            self.keys[sd_models.transform_checkpoint_dict_key(key, replacements)] = key
+
+    def __contains__(self, name):
+        return name in self.keys
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def meta(self, name):
+        """returns a tensor on meta device with the same shape and dtype as the one in the file"""
+
+        key = self.keys[name]
+        return torch.empty(self.shapes[key], dtype=self.dtypes[key], device="meta")
+
+    def get(self, name):
+        file = getattr(self.local, "file", None)
+        if file is None:
+            file = self.local.file = safetensors.safe_open(self.filename, framework="pt", device="cpu")
+
+        return file.get_tensor(self.keys[name])
+
+
+def save_safetensors_streaming(filename, plan, produce, metadata=None, threads=1):
+    """
+    Writes a .safetensors file tensor by tensor. plan is a dict of name -> tensor on meta device with the shape and
+    dtype of the tensor to be saved; produce(name) creates the actual tensor. Up to two tensors per thread are kept in
+    memory at a time, so memory use doesn't depend on the size of the checkpoint. As with safetensors.torch.save_file,
+    metadata must map strings to strings.
+    """
+
+    for key, value in (metadata or {}).items():
+        if not isinstance(key, str) or not isinstance(value, str):
+            raise TypeError(f"Metadata must be a dict of str to str, got {type(key).__name__} {key!r}: {type(value).__name__}")
+
+    dtype_names = {v: k for k, v in safetensors_dtypes.items()}
+
+    header = {}
+    offset = 0
+    for name, tensor in plan.items():
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": dtype_names[tensor.dtype], "shape": list(tensor.shape), "data_offsets": [offset, offset + size]}
+        offset += size
+
+    if metadata:
+        header["__metadata__"] = metadata
+
+    header_bytes = json.dumps(header, separators=(',', ':')).encode("utf8")
+    header_bytes += b' ' * (-len(header_bytes) % 8)
+
+    names = iter(plan)
+    pending = collections.deque()
+
+    def submit_next():
+        name = next(names, None)
+        if name is not None:
+            pending.append((name, executor.submit(produce, name)))
+
+    temp_filename = filename + ".tmp"
+    try:
+        with open(temp_filename, "wb") as file, concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="merge") as executor:
+            file.write(len(header_bytes).to_bytes(8, "little"))
+            file.write(header_bytes)
+
+            for _ in range(threads * 2):
+                submit_next()
+
+            while pending:
+                name, future = pending.popleft()
+                tensor = future.result()
+                submit_next()
+
+                expected = plan[name]
+                if tensor.dtype != expected.dtype or tensor.shape != expected.shape:
+                    raise RuntimeError(f"Tensor {name} came out as {tensor.dtype} {list(tensor.shape)} rather than {expected.dtype} {list(expected.shape)}")
+
+                if tensor.numel() > 0:
+                    file.write(tensor.contiguous().view(-1).view(torch.uint8).numpy().data)
+
+                shared.state.sampling_step += 1
+
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
 def read_metadata(primary_model_name, secondary_model_name, tertiary_model_name):
     metadata = {}
 
@@ -147,14 +278,94 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
     result_is_inpainting_model = False
     result_is_instruct_pix2pix_model = False
 
-    if theta_func2:
+    def difference_of(key, b, c):
+        """first step of "Add difference": B - C for model weights"""
+
+        if key in checkpoint_dict_skip_on_merge or 'model' not in key:
+            return b
+
+        return theta_func1(b, c) if c is not None else torch.zeros_like(b)
+
+    def merged(key, a, b):
+        """returns merged tensor for key, and what kind of model A is if it's an inpainting or instruct-pix2pix model and B isn't"""
+
+        # this enables merging an inpainting model (A) with another one (B);
+        # where normal model would have 4 channels, for latenst space, inpainting model would
+        # have another 4 channels for unmasked picture's latent space, plus one channel for mask, for a total of 9
+        if a.shape != b.shape and a.shape[0:1] + a.shape[2:] == b.shape[0:1] + b.shape[2:]:
+            if a.shape[1] == 4 and b.shape[1] == 9:
+                raise RuntimeError("When merging inpainting model with a normal one, A must be the inpainting model.")
+            if a.shape[1] == 4 and b.shape[1] == 8:
+                raise RuntimeError("When merging instruct-pix2pix model with a normal one, A must be the instruct-pix2pix model.")
+
+            a = a.clone()
+            if a.shape[1] == 8 and b.shape[1] == 4:#If we have an Instruct-Pix2Pix model...
+                a[:, 0:4, :, :] = theta_func2(a[:, 0:4, :, :], b, multiplier)#Merge only the vectors the models have in common.  Otherwise we get an error due to dimension mismatch.
+                kind = "instruct-pix2pix"
+            else:
+                assert a.shape[1] == 9 and b.shape[1] == 4, f"Bad dimensions for merged layer {key}: A={a.shape}, B={b.shape}"
+                a[:, 0:4, :, :] = theta_func2(a[:, 0:4, :, :], b, multiplier)
+                kind = "inpainting"
+        else:
+            a = theta_func2(a, b, multiplier)
+            kind = None
+
+        return to_half(a, save_as_half), kind
+
+    # when everything is in safetensors format, tensors are read from memory-mapped inputs and written to output one by one
+    model_infos = [x for x in [primary_model_info, secondary_model_info, tertiary_model_info] if x is not None]
+    streaming = checkpoint_format == "safetensors" and all(os.path.splitext(x.filename)[1].lower() == ".safetensors" for x in model_infos)
+
+    if streaming:
+        shared.state.job_count = 1
+
+        checkpoint_a = SafetensorsCheckpoint(primary_model_info.filename)
+        checkpoint_b = SafetensorsCheckpoint(secondary_model_info.filename) if theta_func2 else None
+        checkpoint_c = SafetensorsCheckpoint(tertiary_model_info.filename) if theta_func1 else None
+
+        vae_dict = None
+        bake_in_vae_filename = sd_vae.vae_dict.get(bake_in_vae, None)
+        if bake_in_vae_filename is not None:
+            print(f"Baking in VAE from {bake_in_vae_filename}")
+            vae_dict = sd_vae.load_vae_dict(bake_in_vae_filename, map_location='cpu')
+
+        def produce(key, meta=False):
+            """creates the tensor for key of the result, or, with meta=True, a tensor on meta device with its shape and dtype"""
+
+            def get(checkpoint):
+                return checkpoint.meta(key) if meta else checkpoint.get(key)
+
+            if vae_dict is not None and key.startswith('first_stage_model.') and key[len('first_stage_model.'):] in vae_dict:
+                vae_tensor = vae_dict[key[len('first_stage_model.'):]]
+                return to_half(vae_tensor.to("meta") if meta else vae_tensor, save_as_half), None
+
+            if checkpoint_b is not None and 'model' in key and key in checkpoint_b and key not in checkpoint_dict_skip_on_merge:
+                b = get(checkpoint_b)
+                if checkpoint_c is not None:
+                    b = difference_of(key, b, get(checkpoint_c) if key in checkpoint_c else None)
+
+                return merged(key, get(checkpoint_a), b)
+
+            return to_half(get(checkpoint_a), save_as_half and not theta_func2), None
+
+        plan = {}
+        for key in checkpoint_a:
+            plan[key], kind = produce(key, meta=True)
+            result_is_inpainting_model = result_is_inpainting_model or kind == "inpainting"
+            result_is_instruct_pix2pix_model = result_is_instruct_pix2pix_model or kind == "instruct-pix2pix"
+
+        if discard_weights:
+            regex = re.compile(discard_weights)
+            plan = {key: value for key, value in plan.items() if not re.search(regex, key)}
+
+    if not streaming and theta_func2:
         shared.state.textinfo = "Loading B"
         print(f"Loading {secondary_model_info.filename}...")
         theta_1 = sd_models.read_state_dict(secondary_model_info.filename, map_location='cpu')
     else:
         theta_1 = None
 
-    if theta_func1:
+    if not streaming and theta_func1:
         shared.state.textinfo = "Loading C"
         print(f"Loading {tertiary_model_info.filename}...")
         theta_2 = sd_models.read_state_dict(tertiary_model_info.filename, map_location='cpu')
@@ -162,84 +373,57 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
         shared.state.textinfo = 'Merging B and C'
         shared.state.sampling_steps = len(theta_1.keys())
         for key in tqdm.tqdm(theta_1.keys()):
-            if key in checkpoint_dict_skip_on_merge:
-                continue
-
-            if 'model' in key:
-                if key in theta_2:
-                    t2 = theta_2.get(key, torch.zeros_like(theta_1[key]))
-                    theta_1[key] = theta_func1(theta_1[key], t2)
-                else:
-                    theta_1[key] = torch.zeros_like(theta_1[key])
+            theta_1[key] = difference_of(key, theta_1[key], theta_2.get(key))
 
             shared.state.sampling_step += 1
         del theta_2
 
         shared.state.nextjob()
 
-    shared.state.textinfo = f"Loading {primary_model_info.filename}..."
-    print(f"Loading {primary_model_info.filename}...")
-    theta_0 = sd_models.read_state_dict(primary_model_info.filename, map_location='cpu')
-
-    print("Merging...")
-    shared.state.textinfo = 'Merging A and B'
-    shared.state.sampling_steps = len(theta_0.keys())
-    for key in tqdm.tqdm(theta_0.keys()):
-        if theta_1 and 'model' in key and key in theta_1:
-
-            if key in checkpoint_dict_skip_on_merge:
-                continue
-
-            a = theta_0[key]
-            b = theta_1[key]
-
-            # this enables merging an inpainting model (A) with another one (B);
-            # where normal model would have 4 channels, for latenst space, inpainting model would
-            # have another 4 channels for unmasked picture's latent space, plus one channel for mask, for a total of 9
-            if a.shape != b.shape and a.shape[0:1] + a.shape[2:] == b.shape[0:1] + b.shape[2:]:
-                if a.shape[1] == 4 and b.shape[1] == 9:
-                    raise RuntimeError("When merging inpainting model with a normal one, A must be the inpainting model.")
-                if a.shape[1] == 4 and b.shape[1] == 8:
-                    raise RuntimeError("When merging instruct-pix2pix model with a normal one, A must be the instruct-pix2pix model.")
-
-                if a.shape[1] == 8 and b.shape[1] == 4:#If we have an Instruct-Pix2Pix model...
-                    theta_0[key][:, 0:4, :, :] = theta_func2(a[:, 0:4, :, :], b, multiplier)#Merge only the vectors the models have in common.  Otherwise we get an error due to dimension mismatch.
-                    result_is_instruct_pix2pix_model = True
-                else:
-                    assert a.shape[1] == 9 and b.shape[1] == 4, f"Bad dimensions for merged layer {key}: A={a.shape}, B={b.shape}"
-                    theta_0[key][:, 0:4, :, :] = theta_func2(a[:, 0:4, :, :], b, multiplier)
-                    result_is_inpainting_model = True
-            else:
-                theta_0[key] = theta_func2(a, b, multiplier)
+    if not streaming:
+        shared.state.textinfo = f"Loading {primary_model_info.filename}..."
+        print(f"Loading {primary_model_info.filename}...")
+        theta_0 = sd_models.read_state_dict(primary_model_info.filename, map_location='cpu')
 
-            theta_0[key] = to_half(theta_0[key], save_as_half)
+        print("Merging...")
+        shared.state.textinfo = 'Merging A and B'
+        shared.state.sampling_steps = len(theta_0.keys())
+        for key in tqdm.tqdm(theta_0.keys()):
+            if theta_1 and 'model' in key and key in theta_1:
 
-        shared.state.sampling_step += 1
+                if key in checkpoint_dict_skip_on_merge:
+                    continue
 
-    del theta_1
+                theta_0[key], kind = merged(key, theta_0[key], theta_1[key])
+                result_is_inpainting_model = result_is_inpainting_model or kind == "inpainting"
+                result_is_instruct_pix2pix_model = result_is_instruct_pix2pix_model or kind == "instruct-pix2pix"
 
-    bake_in_vae_filename = sd_vae.vae_dict.get(bake_in_vae, None)
-    if bake_in_vae_filename is not None:
-        print(f"Baking in VAE from {bake_in_vae_filename}")
-        shared.state.textinfo = 'Baking in VAE'
-        vae_dict = sd_vae.load_vae_dict(bake_in_vae_filename, map_location='cpu')
+            shared.state.sampling_step += 1
 
-        for key in vae_dict.keys():
-            theta_0_key = 'first_stage_model.' + key
-            if theta_0_key in theta_0:
-                theta_0[theta_0_key] = to_half(vae_dict[key], save_as_half)
+        del theta_1
 
-        del vae_dict
+        bake_in_vae_filename = sd_vae.vae_dict.get(bake_in_vae, None)
+        if bake_in_vae_filename is not None:
+            print(f"Baking in VAE from {bake_in_vae_filename}")
+            shared.state.textinfo = 'Baking in VAE'
+            vae_dict = sd_vae.load_vae_dict(bake_in_vae_filename, map_location='cpu')
 
-    if save_as_half and not theta_func2:
-        for key in theta_0.keys():
-            theta_0[key] = to_half(theta_0[key], save_as_half)
+            for key in vae_dict.keys():
+                theta_0_key = 'first_stage_model.' + key
+                if theta_0_key in theta_0:
+                    theta_0[theta_0_key] = to_half(vae_dict[key], save_as_half)
 
-    if discard_weights:
-        regex = re.compile(discard_weights)
-        for key in list(theta_0):
-            if re.search(regex, key):
-                theta_0.pop(key, None)
+            del vae_dict
+
+        if save_as_half and not theta_func2:
+            for key in theta_0.keys():
+                theta_0[key] = to_half(theta_0[key], save_as_half)
+
+        if discard_weights:
+            regex = re.compile(discard_weights)
+            for key in list(theta_0):
+                if re.search(regex, key):
+                    theta_0.pop(key, None)
 
     ckpt_dir = shared.cmd_opts.ckpt_dir or sd_models.model_path
 
@@ -310,8 +494,14 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
         metadata["sd_merge_recipe"] = json.dumps(merge_recipe)
         metadata["sd_merge_models"] = json.dumps(sd_merge_models)
 
+    # values copied from models' metadata are parsed from JSON, and safetensors only stores strings
+    metadata = {str(k): v if isinstance(v, str) else json.dumps(v) for k, v in metadata.items()}
+
     _, extension = os.path.splitext(output_modelname)
-    if extension.lower() == ".safetensors":
+    if streaming:
+        shared.state.sampling_steps = len(plan)
+        save_safetensors_streaming(output_modelname, plan, lambda key: produce(key)[0], metadata=metadata if len(metadata)>0 else None, threads=shared.opts.model_merger_threads)
+    elif extension.lower() == ".safetensors":
         safetensors.torch.save_file(theta_0, output_modelname, metadata=metadata if len(metadata)>0 else None)
     else:
         torch.save(theta_0, output_modelname)
@@ -0,0 +1,202 @@
+import bisect
+import contextlib
+import itertools
+import threading
+import time
+
+from modules import shared
+
+PRIORITY_INTERACTIVE = 0
+"""requests made from the web UI"""
+
+PRIORITY_BATCH = 1
+"""requests made via API"""
+
+priority_names = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BATCH: "batch"}
+
+wait_time_buckets = [0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600]
+depth_buckets = [0, 1, 2, 4, 8, 16, 32, 64, 128]
+
+usage_half_life = 300
+"""seconds after which the GPU time used by a client counts half as much when choosing who goes next"""
+
+context = threading.local()
+
+
+class QueueFullError(Exception):
+    status_code = 429
+
+    def __init__(self, depth):
+        super().__init__(f"Generation queue is full ({depth} requests waiting); try again later")
+        self.depth = depth
+
+
+@contextlib.contextmanager
+def client_context(client, priority):
+    """makes queue_lock acquired by the current thread to be accounted to the client with given priority"""
+
+    previous = getattr(context, "client", None), getattr(context, "priority", None)
+    context.client, context.priority = client, priority
+    try:
+        yield
+    finally:
+        context.client, context.priority = previous
+
+
+def current_client():
+    """client that queue_lock acquired by the current thread is accounted to"""
+
+    return getattr(context, "client", None) or "local"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += 1
+        self.sum += value
+
+    def dict(self):
+        labels = [f"<={x}" for x in self.buckets] + [f">{self.buckets[-1]}"]
+        return {"buckets": dict(zip(labels, self.counts)), "count": self.total, "sum": self.sum}
+
+
+class Waiter:
+    def __init__(self, client, priority, seq):
+        self.client = client
+        self.priority = priority
+        self.seq = seq
+        self.arrived = time.time()
+        self.event = threading.Event()
+
+
+class FairQueueLock:
+    """
+    A lock for the generation queue that decides which waiting thread goes next.
+
+    Waiting threads are let in by priority class first (web UI before API), then by fair share between clients: the
+    client that used the least GPU time recently (decaying with usage_half_life) goes first, and arrival order breaks
+    ties. The lock is handed directly to the chosen thread on release. With queue_max_depth set, threads that would have
+    to wait behind that many others get QueueFullError instead.
+    """
+
+    def __init__(self):
+        self._inner_lock = threading.Lock()
+        self._locked = False
+        self._waiters = []
+        self._seq = itertools.count()
+
+        self._usage = {}
+        self._holder = None
+        self._held_since = None
+        self._shares = None
+
+        self.wait_times = {name: Histogram(wait_time_buckets) for name in priority_names.values()}
+        self.depths = Histogram(depth_buckets)
+        self.rejected = 0
+
+    def _decayed_usage(self, client, now):
+        value, timestamp = self._usage.get(client, (0.0, now))
+        return value * 0.5 ** ((now - timestamp) / usage_half_life)
+
+    def _take(self, client, priority, arrived):
+        self._locked = True
+        self._holder = client
+        self._held_since = time.time()
+        self._shares = None
+        self.wait_times[priority_names.get(priority, "batch")].add(self._held_since - arrived)
+
+    def acquire(self, blocking=True):
+        client = current_client()
+        priority = getattr(context, "priority", None)
+        if priority is None:
+            priority = PRIORITY_INTERACTIVE
+
+        with self._inner_lock:
+            self.depths.add(len(self._waiters))
+
+            if not self._locked and not self._waiters:
+                self._take(client, priority, time.time())
+                return True
+            elif not blocking:
+                return False
+
+            max_depth = shared.opts.queue_max_depth
+            if max_depth and len(self._waiters) >= max_depth:
+                self.rejected += 1
+                raise QueueFullError(len(self._waiters))
+
+            waiter = Waiter(client, priority, next(self._seq))
+            self._waiters.append(waiter)
+
+        waiter.event.wait()
+        return True
+
+    def share_usage(self, shares):
+        """
+        makes the time the lock is held for be split between clients in proportion to their weights in shares dict,
+        instead of being accounted to the client that acquired it; called by the thread that holds the lock when it
+        does work for several clients at once, such as a batch of their requests
+        """
+
+        total = sum(shares.values())
+        with self._inner_lock:
+            self._shares = {client: weight / total for client, weight in shares.items()} if total > 0 else None
+
+    def release(self):
+        with self._inner_lock:
+            now = time.time()
+            if self._holder is not None:
+                for client, share in (self._shares or {self._holder: 1.0}).items():
+                    self._usage[client] = (self._decayed_usage(client, now) + (now - self._held_since) * share, now)
+
+                if len(self._usage) > 1000:
+                    self._usage = {client: (value, timestamp) for client, (value, timestamp) in self._usage.items() if self._decayed_usage(client, now) > 0.01}
+
+            self._locked = False
+            self._holder = None
+            self._shares = None
+
+            if self._waiters:
+                if shared.opts.queue_fair_share:
+                    waiter = min(self._waiters, key=lambda x: (x.priority, self._decayed_usage(x.client, now), x.seq))
+                else:
+                    waiter = min(self._waiters, key=lambda x: (x.priority, x.seq))
+
+                self._waiters.remove(waiter)
+                self._take(waiter.client, waiter.priority, waiter.arrived)
+                waiter.event.set()
+
+    __enter__ = acquire
+
+    def __exit__(self, t, v, tb):
+        self.release()
+
+    def status(self):
+        """information about the queue for monitoring"""
+
+        with self._inner_lock:
+            now = time.time()
+            waiting_by_class = dict.fromkeys(priority_names.values(), 0)
+            waiting_by_client = {}
+            for waiter in self._waiters:
+                waiting_by_class[priority_names.get(waiter.priority, "batch")] += 1
+                waiting_by_client[waiter.client] = waiting_by_client.get(waiter.client, 0) + 1
+
+            return {
+                "depth": len(self._waiters),
+                "running": self._locked,
+                "running_for": now - self._held_since if self._locked else 0.0,
+                "oldest_wait": max((now - x.arrived for x in self._waiters), default=0.0),
+                "waiting_by_class": waiting_by_class,
+                "waiting_by_client": waiting_by_client,
+                "usage_by_client": {client: self._decayed_usage(client, now) for client in self._usage},
+                "rejected": self.rejected,
+                "wait_time": {name: histogram.dict() for name, histogram in self.wait_times.items()},
+                "depth_on_arrival": self.depths.dict(),
+            }
@@ -1,5 +1,10 @@
 import hashlib
+import heapq
+import itertools
+import mmap
 import os.path
+import threading
+import time
 
 from modules import shared
 import modules.cache
@@ -7,6 +12,17 @@ import modules.cache
 dump_cache = modules.cache.dump_cache
 cache = modules.cache.cache
 
+blksize_mmap = 16 * 1024 * 1024
+
+PRIORITY_ACTIVE = 0
+"""hash of a model that is being loaded right now"""
+
+PRIORITY_FOREGROUND = 1
+"""hash that some caller is waiting for"""
+
+PRIORITY_BACKGROUND = 2
+"""hash queued ahead of time, e.g. for checkpoints found on disk"""
+
 
 def calculate_sha256(filename):
     hash_sha256 = hashlib.sha256()
@@ -38,9 +54,192 @@ def sha256_from_cache(filename, title, use_addnet_hash=False):
     return cached_sha256
 
 
-def sha256(filename, title, use_addnet_hash=False):
-    hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
+class HashingTask:
+    def __init__(self, filename, title, use_addnet_hash, priority):
+        self.filename = filename
+        self.title = title
+        self.use_addnet_hash = use_addnet_hash
+        self.priority = priority
+        self.queued = False
+        self.started = None
+
+        self.hasher = None
+        self.mtime = None
+        self.position = 0
+        self.total = 0
+
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def progress(self):
+        return {
+            "filename": self.filename,
+            "title": self.title,
+            "priority": self.priority,
+            "position": self.position,
+            "total": self.total,
+            "progress": self.position / self.total if self.total else 0.0,
+            "running": self.started is not None and not self.queued,
+        }
+
+
+class HashingService:
+    """
+    Calculates sha256 of model files on a pool of background threads.
+
+    Files are read through mmap in large blocks. Tasks are taken in priority order; a running task yields its
+    worker to a higher priority one between blocks when no other worker is idle, keeping its hasher, so it
+    continues from where it stopped instead of starting over.
+
+    Partial progress is not saved to the hashes cache: hashlib can't export the state of an unfinished sha256, so
+    a hash interrupted by a restart is calculated from the beginning the next time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.queue = []
+        self.tasks = {}
+        self.workers = []
+        self.idle = 0
+        self.counter = itertools.count()
+
+    def submit(self, filename, title, use_addnet_hash=False, priority=PRIORITY_BACKGROUND):
+        key = (title, use_addnet_hash)
+
+        with self.lock:
+            task = self.tasks.get(key)
+            if task is None:
+                task = HashingTask(filename, title, use_addnet_hash, priority)
+                self.tasks[key] = task
+                self.push(task)
+            elif priority < task.priority:
+                task.priority = priority
+                if task.queued:
+                    self.push(task)
+
+            self.start_workers()
+            self.lock.notify_all()
+
+        return task
+
+    def push(self, task):
+        task.queued = True
+        heapq.heappush(self.queue, (task.priority, next(self.counter), task))
+
+    def pop(self):
+        while self.queue:
+            priority, _, task = heapq.heappop(self.queue)
+            if task.queued and priority == task.priority:
+                task.queued = False
+                return task
+
+        return None
+
+    def top_priority(self):
+        while self.queue:
+            priority, _, task = self.queue[0]
+            if task.queued and priority == task.priority:
+                return priority
+
+            heapq.heappop(self.queue)
+
+        return None
+
+    def should_yield(self, task):
+        with self.lock:
+            if self.idle > 0:
+                return False
+
+            priority = self.top_priority()
+            return priority is not None and priority < task.priority
+
+    def start_workers(self):
+        count = max(1, shared.opts.hashing_workers)
+        while len(self.workers) < count:
+            thread = threading.Thread(target=self.worker, daemon=True, name=f"hashing-{len(self.workers)}")
+            self.workers.append(thread)
+            thread.start()
 
+    def worker(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+                task = self.pop()
+                while task is None:
+                    self.lock.wait()
+                    task = self.pop()
+                self.idle -= 1
+
+            try:
+                finished = self.hash_blocks(task)
+            except Exception as e:
+                task.error = e
+                finished = True
+
+            if finished:
+                self.finish(task)
+            else:
+                with self.lock:
+                    self.push(task)
+                    self.lock.notify_all()
+
+    def hash_blocks(self, task):
+        """hashes the file from task.position onwards; returns False if the task was preempted before finishing"""
+
+        if task.hasher is None:
+            task.started = time.time()
+            task.mtime = os.path.getmtime(task.filename)
+            task.total = os.path.getsize(task.filename)
+            task.hasher = hashlib.sha256()
+
+            if task.use_addnet_hash:
+                with open(task.filename, "rb") as file:
+                    task.position = int.from_bytes(file.read(8), "little") + 8
+
+        if task.position >= task.total:
+            return True
+
+        with open(task.filename, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                while task.position < task.total:
+                    end = min(task.position + blksize_mmap, task.total)
+                    task.hasher.update(view[task.position:end])
+                    task.position = end
+
+                    if task.position < task.total and self.should_yield(task):
+                        return False
+            finally:
+                view.release()
+
+        return True
+
+    def finish(self, task):
+        if task.error is None:
+            task.result = task.hasher.hexdigest()
+
+            hashes = cache("hashes-addnet") if task.use_addnet_hash else cache("hashes")
+            hashes[task.title] = {
+                "mtime": task.mtime,
+                "sha256": task.result,
+            }
+
+        with self.lock:
+            self.tasks.pop((task.title, task.use_addnet_hash), None)
+
+        task.hasher = None
+        task.done.set()
+
+    def progress(self):
+        with self.lock:
+            return [task.progress() for task in sorted(self.tasks.values(), key=lambda x: (x.priority, x.title))]
+
+
+service = HashingService()
+
+
+def sha256(filename, title, use_addnet_hash=False, priority=PRIORITY_FOREGROUND):
     sha256_value = sha256_from_cache(filename, title, use_addnet_hash)
     if sha256_value is not None:
         return sha256_value
@@ -49,21 +248,33 @@ def sha256(filename, title, use_addnet_hash=False):
         return None
 
     print(f"Calculating sha256 for {filename}: ", end='')
-    if use_addnet_hash:
-        with open(filename, "rb") as file:
-            sha256_value = addnet_hash_safetensors(file)
-    else:
-        sha256_value = calculate_sha256(filename)
-    print(f"{sha256_value}")
+    task = service.submit(filename, title, use_addnet_hash, priority)
+    task.done.wait()
+
+    if task.error is not None:
+        print(f"error: {task.error}")
+        raise task.error
+
+    print(f"{task.result}")
+
+    return task.result
 
-    hashes[title] = {
-        "mtime": os.path.getmtime(filename),
-        "sha256": sha256_value,
-    }
 
-    dump_cache()
+def sha256_background(filename, title, use_addnet_hash=False):
+    """queues calculation of sha256 for the file if it's not in cache; returns the cached value or None"""
+
+    sha256_value = sha256_from_cache(filename, title, use_addnet_hash)
+    if sha256_value is not None or shared.cmd_opts.no_hashing:
+        return sha256_value
+
+    service.submit(filename, title, use_addnet_hash, PRIORITY_BACKGROUND)
+    return None
 
-    return sha256_value
+
+def hashing_progress():
+    """list of dicts describing files that are being hashed or waiting to be hashed"""
+
+    return service.progress()
 
 
 def addnet_hash_safetensors(b):
@@ -81,4 +292,3 @@ def addnet_hash_safetensors(b):
         hash_sha256.update(chunk)
 
     return hash_sha256.hexdigest()
-
@@ -729,7 +729,7 @@ def train_hypernetwork(id_task, hypernetwork_name: str, learn_rate: float, batch
                             textual_inversion.tensorboard_add_image(tensorboard_writer,
                                                                     f"Validation at epoch {epoch_num}", image,
                                                                     hypernetwork.step)
-                        last_saved_image, last_text_info = images.save_image(image, images_dir, "", p.seed, p.prompt, shared.opts.samples_format, processed.infotexts[0], p=p, forced_filename=forced_filename, save_to_dirs=False)
+                        last_saved_image, last_text_info = images.save_image(image, images_dir, "", p.seed, p.prompt, shared.opts.samples_format, processed.infotexts[0], p=p, forced_filename=forced_filename, save_to_dirs=False, wait=True)
                         last_saved_image += f", prompt: {preview_text}"
 
                 shared.state.job_no = hypernetwork.step
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import atexit
+import collections
 import datetime
 import functools
 import pytz
@@ -8,6 +10,7 @@ import math
 import os
 from collections import namedtuple
 import re
+import threading
 
 import numpy as np
 import piexif
@@ -551,7 +554,7 @@ def get_next_sequence_number(path, basename):
         basename = f"{basename}-"
 
     prefix_length = len(basename)
-    for p in os.listdir(path):
+    for p in os.listdir(path) + image_writer.pending_names(path):
         if p.startswith(basename):
             parts = os.path.splitext(p[prefix_length:])[0].split('-')  # splits the filename (removing the basename first if one is defined, so the sequence number is always the first element)
             try:
@@ -562,6 +565,99 @@ def get_next_sequence_number(path, basename):
     return result + 1
 
 
+class ImageWriter:
+    """
+    Writes images saved by save_image on a background thread when save_images_async is enabled, so that the thread that
+    generates images does not wait for encoding and disk.
+
+    Files are written one at a time in the order they were submitted. Filenames are picked by save_image before
+    submitting, and files that are waiting to be written count as existing when picking the next sequence number.
+    At most save_images_async_queue images wait; submitting more blocks until there is room. Callbacks for saved
+    images run on the writer thread.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.jobs = collections.deque()
+        self.pending = collections.Counter()
+        self.thread = None
+
+    def pending_names(self, path):
+        """names of files in directory that are waiting to be written"""
+
+        path = os.path.normpath(path)
+        with self.condition:
+            return [os.path.basename(x) for x in self.pending if os.path.dirname(os.path.normpath(x)) == path]
+
+    def is_pending(self, filename):
+        with self.condition:
+            return filename in self.pending
+
+    def wait_for_image(self, image):
+        """waits until the image is written, if it is waiting to be"""
+
+        if threading.current_thread() is self.thread:
+            return
+
+        with self.condition:
+            while any(job_image is image for _, job_image, _ in self.jobs):
+                self.condition.wait()
+
+    def submit(self, filename, func, image=None):
+        if threading.current_thread() is self.thread:
+            # called from a callback of an image being written; waiting for room in the queue would never end
+            func()
+            return
+
+        with self.condition:
+            while len(self.jobs) >= max(1, opts.save_images_async_queue):
+                self.condition.wait()
+
+            self.jobs.append((filename, image, func))
+            self.pending[filename] += 1
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="image-writer", daemon=True)
+                self.thread.start()
+
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+
+                filename, _, func = self.jobs[0]
+
+            try:
+                func()
+            except Exception:
+                errors.report(f"Error saving image {filename}", exc_info=True)
+
+            with self.condition:
+                self.jobs.popleft()
+                self.pending[filename] -= 1
+                if self.pending[filename] <= 0:
+                    del self.pending[filename]
+
+                self.condition.notify_all()
+
+    def flush(self):
+        """waits until all submitted images are written"""
+
+        if threading.current_thread() is self.thread:
+            return
+
+        with self.condition:
+            while self.jobs:
+                self.condition.wait()
+
+
+image_writer = ImageWriter()
+atexit.register(image_writer.flush)
+
+
 def save_image_with_geninfo(image, geninfo, filename, extension=None, existing_pnginfo=None, pnginfo_section_name='parameters'):
     """
     Saves image to filename, including geninfo as text information for generation info.
@@ -586,7 +682,7 @@ def save_image_with_geninfo(image, geninfo, filename, extension=None, existing_p
         else:
             pnginfo_data = None
 
-        image.save(filename, format=image_format, quality=opts.jpeg_quality, pnginfo=pnginfo_data)
+        image.save(filename, format=image_format, quality=opts.jpeg_quality, pnginfo=pnginfo_data, compress_level=opts.png_compress_level)
 
     elif extension.lower() in (".jpg", ".jpeg", ".webp"):
         if image.mode == 'RGBA':
@@ -621,7 +717,7 @@ def save_image_with_geninfo(image, geninfo, filename, extension=None, existing_p
         image.save(filename, format=image_format, quality=opts.jpeg_quality)
 
 
-def save_image(image, path, basename, seed=None, prompt=None, extension='png', info=None, short_filename=False, no_prompt=False, grid=False, pnginfo_section_name='parameters', p=None, existing_info=None, forced_filename=None, suffix="", save_to_dirs=None):
+def save_image(image, path, basename, seed=None, prompt=None, extension='png', info=None, short_filename=False, no_prompt=False, grid=False, pnginfo_section_name='parameters', p=None, existing_info=None, forced_filename=None, suffix="", save_to_dirs=None, wait=False):
     """Save an image.
 
     Args:
@@ -647,12 +743,16 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
             If specified, `basename` and filename pattern will be ignored.
         save_to_dirs (bool):
             If true, the image will be saved into a subdirectory of `path`.
+        wait (bool):
+            If true, files are written before returning even if `save_images_async` is enabled.
 
     Returns: (fullfn, txt_fullfn)
         fullfn (`str`):
-            The full path of the saved imaged.
+            The full path of the saved imaged. With `save_images_async` enabled and `wait` false, the file may not
+            exist yet when this returns; use `image_writer.wait_for_image(image)` before reading it.
         txt_fullfn (`str` or None):
-            If a text file is saved for this image, this will be its full path. Otherwise None.
+            If a text file is saved for this image, this will be its full path. Otherwise None. Written along with
+            the image, so it may not exist yet either.
     """
     namegen = FilenameGenerator(p, seed, prompt, image, basename=basename)
 
@@ -691,7 +791,7 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
             for i in range(500):
                 fn = f"{basecount + i:05}" if basename == '' else f"{basename}-{basecount + i:04}"
                 fullfn = os.path.join(path, f"{fn}{file_decoration}.{extension}")
-                if not os.path.exists(fullfn):
+                if not os.path.exists(fullfn) and not image_writer.is_pending(fullfn):
                     break
         else:
             fullfn = os.path.join(path, f"{file_decoration}.{extension}")
@@ -725,44 +825,57 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
                 filename = f"{filename_without_extension}-{n}{extension}"
         os.replace(temp_file_path, filename)
 
+        return filename
+
     fullfn_without_extension, extension = os.path.splitext(params.filename)
     if hasattr(os, 'statvfs'):
         max_name_len = os.statvfs(path).f_namemax
         fullfn_without_extension = fullfn_without_extension[:max_name_len - max(4, len(extension))]
         params.filename = fullfn_without_extension + extension
         fullfn = params.filename
-    _atomically_save_image(image, fullfn_without_extension, extension)
-
-    image.already_saved_as = fullfn
-
-    oversize = image.width > opts.target_side_length or image.height > opts.target_side_length
-    if opts.export_for_4chan and (oversize or os.stat(fullfn).st_size > opts.img_downscale_threshold * 1024 * 1024):
-        ratio = image.width / image.height
-        resize_to = None
-        if oversize and ratio > 1:
-            resize_to = round(opts.target_side_length), round(image.height * opts.target_side_length / image.width)
-        elif oversize:
-            resize_to = round(image.width * opts.target_side_length / image.height), round(opts.target_side_length)
-
-        if resize_to is not None:
-            try:
-                # Resizing image with LANCZOS could throw an exception if e.g. image mode is I;16
-                image = image.resize(resize_to, LANCZOS)
-            except Exception:
-                image = image.resize(resize_to)
-        try:
-            _atomically_save_image(image, fullfn_without_extension, ".jpg")
-        except Exception as e:
-            errors.display(e, "saving image as downscaled JPG")
 
     if opts.save_txt and info is not None:
         txt_fullfn = f"{fullfn_without_extension}.txt"
-        with open(txt_fullfn, "w", encoding="utf8") as file:
-            file.write(f"{info}\n")
     else:
         txt_fullfn = None
 
-    script_callbacks.image_saved_callback(params)
+    def write_files():
+        # set only once the file exists; the gallery uses the file instead of encoding the image again
+        image.already_saved_as = _atomically_save_image(image, fullfn_without_extension, extension)
+
+        oversize = image.width > opts.target_side_length or image.height > opts.target_side_length
+        if opts.export_for_4chan and (oversize or os.stat(fullfn).st_size > opts.img_downscale_threshold * 1024 * 1024):
+            ratio = image.width / image.height
+            resize_to = None
+            if oversize and ratio > 1:
+                resize_to = round(opts.target_side_length), round(image.height * opts.target_side_length / image.width)
+            elif oversize:
+                resize_to = round(image.width * opts.target_side_length / image.height), round(opts.target_side_length)
+
+            downscaled = image
+            if resize_to is not None:
+                try:
+                    # Resizing image with LANCZOS could throw an exception if e.g. image mode is I;16
+                    downscaled = image.resize(resize_to, LANCZOS)
+                except Exception:
+                    downscaled = image.resize(resize_to)
+            try:
+                _atomically_save_image(downscaled, fullfn_without_extension, ".jpg")
+            except Exception as e:
+                errors.display(e, "saving image as downscaled JPG")
+
+        if txt_fullfn is not None:
+            with open(txt_fullfn, "w", encoding="utf8") as file:
+                file.write(f"{info}\n")
+
+        script_callbacks.image_saved_callback(params)
+
+    if opts.save_images_async and not wait:
+        # the writer thread adds to the dict when encoding PNG; callers may reuse theirs for the next image
+        params.pnginfo = dict(params.pnginfo)
+        image_writer.submit(fullfn, write_files, image)
+    else:
+        write_files()
 
     return fullfn, txt_fullfn
 
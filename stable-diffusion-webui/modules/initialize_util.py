@@ -166,6 +166,9 @@ def configure_sigint_handler():
         if shared.opts.dump_stacks_on_signal:
             dumpstacks()
 
+        from modules import images
+        images.image_writer.flush()
+
         os._exit(0)
 
     if not os.environ.get("COVERAGE_RUN"):
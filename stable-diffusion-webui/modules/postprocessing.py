@@ -1,3 +1,5 @@
+import collections
+import concurrent.futures
 import os
 
 from PIL import Image
@@ -6,6 +8,44 @@ from modules import shared, images, devices, scripts, scripts_postprocessing, ui
 from modules.shared import opts
 
 
+def read_image(filename):
+    image = images.read(filename)
+    image.load()
+    return image
+
+
+def save_caption(fullfn, pp_caption):
+    caption_filename = os.path.splitext(fullfn)[0] + ".txt"
+    existing_caption = ""
+    try:
+        with open(caption_filename, encoding="utf8") as file:
+            existing_caption = file.read().strip()
+    except FileNotFoundError:
+        pass
+
+    action = shared.opts.postprocessing_existing_caption_action
+    if action == 'Prepend' and existing_caption:
+        caption = f"{existing_caption} {pp_caption}"
+    elif action == 'Append' and existing_caption:
+        caption = f"{pp_caption} {existing_caption}"
+    elif action == 'Keep' and existing_caption:
+        caption = existing_caption
+    else:
+        caption = pp_caption
+
+    caption = caption.strip()
+    if caption:
+        with open(caption_filename, "w", encoding="utf8") as file:
+            file.write(caption)
+
+
+def save_postprocessed_image(image, caption, **kwargs):
+    fullfn, _ = images.save_image(image, **kwargs)
+
+    if caption:
+        save_caption(fullfn, caption)
+
+
 def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir, show_extras_results, *args, save_output: bool = True):
     devices.torch_gc()
 
@@ -44,85 +84,98 @@ def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir,
     data_to_process = list(get_images(extras_mode, image, image_folder, input_dir))
     shared.state.job_count = len(data_to_process)
 
-    for image_placeholder, name in data_to_process:
-        image_data: Image.Image
+    # Files are read ahead and saved in the background, so that upscalers don't have to wait for the disk or for
+    # image encoding. Files without a forced name are numbered by save_image by looking at what's in the directory,
+    # so those are saved by a separate single writer, one at a time and in order.
+    io_threads = max(1, opts.postprocessing_io_threads)
+    queue_size = io_threads * 2
+
+    reads = {}
+    writes = collections.deque()
+    writes_by_filename = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix="postprocessing-read") as reader, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix="postprocessing-write") as writer, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="postprocessing-write-numbered") as numbered_writer:
+
+        for index, (image_placeholder, name) in enumerate(data_to_process):
+            image_data: Image.Image
+
+            for i in range(index, min(index + queue_size, len(data_to_process))):
+                if i not in reads and isinstance(data_to_process[i][0], str):
+                    reads[i] = reader.submit(read_image, data_to_process[i][0])
+
+            shared.state.nextjob()
+            shared.state.textinfo = name
+            shared.state.skipped = False
 
-        shared.state.nextjob()
-        shared.state.textinfo = name
-        shared.state.skipped = False
+            if shared.state.interrupted or shared.state.stopping_generation:
+                break
 
-        if shared.state.interrupted or shared.state.stopping_generation:
-            break
+            if isinstance(image_placeholder, str):
+                try:
+                    image_data = reads.pop(index).result()
+                except Exception:
+                    continue
+            else:
+                image_data = image_placeholder
+
+            image_data = image_data if image_data.mode in ("RGBA", "RGB") else image_data.convert("RGB")
+
+            parameters, existing_pnginfo = images.read_info_from_image(image_data)
+            if parameters:
+                existing_pnginfo["parameters"] = parameters
 
-        if isinstance(image_placeholder, str):
-            try:
-                image_data = images.read(image_placeholder)
-            except Exception:
+            initial_pp = scripts_postprocessing.PostprocessedImage(image_data)
+
+            scripts.scripts_postproc.run(initial_pp, args)
+
+            if shared.state.skipped:
                 continue
-        else:
-            image_data = image_placeholder
 
-        image_data = image_data if image_data.mode in ("RGBA", "RGB") else image_data.convert("RGB")
+            used_suffixes = {}
+            for pp in [initial_pp, *initial_pp.extra_images]:
+                suffix = pp.get_suffix(used_suffixes)
 
-        parameters, existing_pnginfo = images.read_info_from_image(image_data)
-        if parameters:
-            existing_pnginfo["parameters"] = parameters
+                if opts.use_original_name_batch and name is not None:
+                    basename = os.path.splitext(os.path.basename(name))[0]
+                    forced_filename = basename + suffix
+                else:
+                    basename = ''
+                    forced_filename = None
 
-        initial_pp = scripts_postprocessing.PostprocessedImage(image_data)
+                infotext = ", ".join([k if k == v else f'{k}: {infotext_utils.quote(v)}' for k, v in pp.info.items() if v is not None])
 
-        scripts.scripts_postproc.run(initial_pp, args)
+                # every image gets its own copy, since save_image adds to it, possibly on another thread
+                image_pnginfo = dict(existing_pnginfo)
+                if opts.enable_pnginfo:
+                    pp.image.info = image_pnginfo
+                    pp.image.info["postprocessing"] = infotext
 
-        if shared.state.skipped:
-            continue
+                shared.state.assign_current_image(pp.image)
 
-        used_suffixes = {}
-        for pp in [initial_pp, *initial_pp.extra_images]:
-            suffix = pp.get_suffix(used_suffixes)
+                if save_output:
+                    # two inputs with the same name but different extensions are saved to the same file
+                    previous = writes_by_filename.pop(forced_filename, None)
+                    if previous is not None:
+                        previous.result()
 
-            if opts.use_original_name_batch and name is not None:
-                basename = os.path.splitext(os.path.basename(name))[0]
-                forced_filename = basename + suffix
-            else:
-                basename = ''
-                forced_filename = None
-
-            infotext = ", ".join([k if k == v else f'{k}: {infotext_utils.quote(v)}' for k, v in pp.info.items() if v is not None])
-
-            if opts.enable_pnginfo:
-                pp.image.info = existing_pnginfo
-                pp.image.info["postprocessing"] = infotext
-
-            shared.state.assign_current_image(pp.image)
-
-            if save_output:
-                fullfn, _ = images.save_image(pp.image, path=outpath, basename=basename, extension=opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=existing_pnginfo, forced_filename=forced_filename, suffix=suffix)
-
-                if pp.caption:
-                    caption_filename = os.path.splitext(fullfn)[0] + ".txt"
-                    existing_caption = ""
-                    try:
-                        with open(caption_filename, encoding="utf8") as file:
-                            existing_caption = file.read().strip()
-                    except FileNotFoundError:
-                        pass
-
-                    action = shared.opts.postprocessing_existing_caption_action
-                    if action == 'Prepend' and existing_caption:
-                        caption = f"{existing_caption} {pp.caption}"
-                    elif action == 'Append' and existing_caption:
-                        caption = f"{pp.caption} {existing_caption}"
-                    elif action == 'Keep' and existing_caption:
-                        caption = existing_caption
-                    else:
-                        caption = pp.caption
-
-                    caption = caption.strip()
-                    if caption:
-                        with open(caption_filename, "w", encoding="utf8") as file:
-                            file.write(caption)
-
-            if extras_mode != 2 or show_extras_results:
-                outputs.append(pp.image)
+                    while len(writes) >= queue_size:
+                        writes.popleft().result()
+
+                    future = (writer if forced_filename is not None else numbered_writer).submit(save_postprocessed_image, pp.image, pp.caption, path=outpath, basename=basename, extension=opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=image_pnginfo, forced_filename=forced_filename, suffix=suffix)
+                    writes.append(future)
+                    if forced_filename is not None:
+                        writes_by_filename[forced_filename] = future
+
+                if extras_mode != 2 or show_extras_results:
+                    outputs.append(pp.image)
+
+        for future in reads.values():
+            future.cancel()
+
+        for future in writes:
+            future.result()
 
     devices.torch_gc()
     shared.state.end()
@@ -16,7 +16,7 @@ from skimage import exposure
 from typing import Any
 
 import modules.sd_hijack
-from modules import devices, prompt_parser, masking, sd_samplers, lowvram, infotext_utils, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors, rng, profiling
+from modules import devices, prompt_parser, cond_cache, masking, sd_samplers, lowvram, infotext_utils, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors, rng, profiling
 from modules.rng import slerp # noqa: F401
 from modules.sd_hijack import model_hijack
 from modules.sd_samplers_common import images_tensor_to_samples, decode_first_stage, approximation_indexes
@@ -457,6 +457,26 @@ class StableDiffusionProcessing:
             opts.emphasis,
         )
 
+    def cond_cache_state(self, extra_network_data):
+        """Returns parameters of the model and text encoder that conds in cond_cache depend on, besides prompts"""
+
+        return (
+            shared.sd_model.sd_checkpoint_info,
+            cond_cache.extra_network_key(extra_network_data),
+            model_hijack.embedding_db.version,
+            opts.CLIP_stop_at_last_layers,
+            opts.sdxl_clip_l_skip,
+            opts.emphasis,
+            opts.use_old_emphasis_implementation,
+            opts.comma_padding_backtrack,
+            opts.sdxl_crop_left,
+            opts.sdxl_crop_top,
+            opts.sdxl_refiner_low_aesthetic_score,
+            opts.sdxl_refiner_high_aesthetic_score,
+            opts.fp8_storage,
+            opts.cache_fp16_weight,
+        )
+
     def get_conds_with_caching(self, function, required_prompts, steps, caches, extra_network_data, hires_steps=None):
         """
         Returns the result of calling function(shared.sd_model, required_prompts, steps)
@@ -468,6 +488,9 @@ class StableDiffusionProcessing:
         computed result is stored.
 
         caches is a list with items described above.
+
+        Prompt schedules are also looked up in and added to cond_cache, which is shared between all requests, if
+        function is one of prompt_parser's.
         """
 
         if shared.opts.use_old_scheduling:
@@ -484,8 +507,12 @@ class StableDiffusionProcessing:
 
         cache = caches[0]
 
+        kwargs = {}
+        if cond_cache.cache.enabled() and function in (prompt_parser.get_learned_conditioning, prompt_parser.get_multicond_learned_conditioning):
+            kwargs["persistent_cache"] = cond_cache.cache.view(self.cond_cache_state(extra_network_data))
+
         with devices.autocast():
-            cache[1] = function(shared.sd_model, required_prompts, steps, hires_steps, shared.opts.use_old_scheduling)
+            cache[1] = function(shared.sd_model, required_prompts, steps, hires_steps, shared.opts.use_old_scheduling, **kwargs)
 
         cache[0] = cached_params
         return cache[1]
@@ -622,52 +649,106 @@ class DecodedSamples(list):
     already_decoded = True
 
 
+vae_memory_factor = 32
+"""estimate of memory the VAE needs to decode a sample, in multiples of the decoded image's size, for when it can't be measured"""
+
+
+def switch_vae_precision_after_nans(model, e):
+    """converts VAE to a dtype that is less likely to produce NaNs, if enabled in settings; raises e otherwise"""
+
+    if shared.opts.auto_vae_precision_bfloat16:
+        autofix_dtype = torch.bfloat16
+        autofix_dtype_text = "bfloat16"
+        autofix_dtype_setting = "Automatically convert VAE to bfloat16"
+        autofix_dtype_comment = ""
+    elif shared.opts.auto_vae_precision:
+        autofix_dtype = torch.float32
+        autofix_dtype_text = "32-bit float"
+        autofix_dtype_setting = "Automatically revert VAE to 32-bit floats"
+        autofix_dtype_comment = "\nTo always start with 32-bit VAE, use --no-half-vae commandline flag."
+    else:
+        raise e
+
+    if devices.dtype_vae == autofix_dtype:
+        raise e
+
+    errors.print_error_explanation(
+        "A tensor with all NaNs was produced in VAE.\n"
+        f"Web UI will now convert VAE into {autofix_dtype_text} and retry.\n"
+        f"To disable this behavior, disable the '{autofix_dtype_setting}' setting.{autofix_dtype_comment}"
+    )
+
+    devices.dtype_vae = autofix_dtype
+    model.first_stage_model.to(devices.dtype_vae)
+
+
+def decode_first_stage_measured(model, batch):
+    """decodes latents, returning the result and how many bytes decoding needed per sample"""
+
+    decoded, decode_bytes = devices.measure_memory(lambda: decode_first_stage(model, batch), lambda x: x.numel() * x.element_size() * vae_memory_factor)
+    return decoded, decode_bytes // batch.shape[0]
+
+
 def decode_latent_batch(model, batch, target_device=None, check_for_nans=False):
+    """
+    Decodes a batch of latents with VAE, several at a time: the first sample is decoded alone to find out how much memory
+    decoding takes, and the rest in sub-batches that fit into sd_vae_decode_batch_mb, which are halved if they run out of
+    memory. Samples that come out as NaNs are decoded again one by one after switching VAE precision.
+    """
+
     samples = DecodedSamples()
 
     if check_for_nans:
         devices.test_for_nans(batch, "unet")
 
-    for i in range(batch.shape[0]):
-        sample = decode_first_stage(model, batch[i:i + 1])[0]
-
-        if check_for_nans:
-
-            try:
-                devices.test_for_nans(sample, "vae")
-            except devices.NansException as e:
-                if shared.opts.auto_vae_precision_bfloat16:
-                    autofix_dtype = torch.bfloat16
-                    autofix_dtype_text = "bfloat16"
-                    autofix_dtype_setting = "Automatically convert VAE to bfloat16"
-                    autofix_dtype_comment = ""
-                elif shared.opts.auto_vae_precision:
-                    autofix_dtype = torch.float32
-                    autofix_dtype_text = "32-bit float"
-                    autofix_dtype_setting = "Automatically revert VAE to 32-bit floats"
-                    autofix_dtype_comment = "\nTo always start with 32-bit VAE, use --no-half-vae commandline flag."
-                else:
-                    raise e
+    budget = shared.opts.sd_vae_decode_batch_mb * 1024 * 1024
+    sub_batch_size = 1
+    measured = False
 
-                if devices.dtype_vae == autofix_dtype:
-                    raise e
+    # copies to CPU are made asynchronous so that they overlap with decoding of the next sub-batch
+    non_blocking = target_device is not None and torch.device(target_device).type == "cpu" and devices.device.type == "cuda"
 
-                errors.print_error_explanation(
-                    "A tensor with all NaNs was produced in VAE.\n"
-                    f"Web UI will now convert VAE into {autofix_dtype_text} and retry.\n"
-                    f"To disable this behavior, disable the '{autofix_dtype_setting}' setting.{autofix_dtype_comment}"
-                )
+    i = 0
+    while i < batch.shape[0]:
+        sub_batch = batch[i:i + sub_batch_size]
+        decoded_dtype = devices.dtype_vae
+
+        try:
+            if not measured:
+                decoded, sample_bytes = decode_first_stage_measured(model, sub_batch)
+                sub_batch_size = max(1, min(budget // max(sample_bytes, 1), batch.shape[0]))
+                measured = True
+            else:
+                decoded = decode_first_stage(model, sub_batch)
+        except Exception as e:
+            if sub_batch.shape[0] == 1 or not (isinstance(e, torch.cuda.OutOfMemoryError) or isinstance(e, RuntimeError) and "memory" in str(e)):
+                raise
+
+            sub_batch_size = max(1, sub_batch.shape[0] // 2)
+            devices.torch_gc()
+            continue
+
+        for j, sample in enumerate(decoded):
+            if check_for_nans:
+                try:
+                    devices.test_for_nans(sample, "vae")
+                except devices.NansException as e:
+                    # other samples in the sub-batch may have already caused the switch
+                    if devices.dtype_vae == decoded_dtype:
+                        switch_vae_precision_after_nans(model, e)
+
+                    batch = batch.to(devices.dtype_vae)
+                    sample = decode_first_stage(model, batch[i + j:i + j + 1])[0]
 
-                devices.dtype_vae = autofix_dtype
-                model.first_stage_model.to(devices.dtype_vae)
-                batch = batch.to(devices.dtype_vae)
+            if target_device is not None:
+                sample = sample.to(target_device, non_blocking=non_blocking)
 
-                sample = decode_first_stage(model, batch[i:i + 1])[0]
+            samples.append(sample)
 
-        if target_device is not None:
-            sample = sample.to(target_device)
+        i += sub_batch.shape[0]
 
-        samples.append(sample)
+    if non_blocking:
+        torch.cuda.synchronize(devices.device)
 
     return samples
 
@@ -847,6 +928,7 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
             res = process_images_inner(p)
 
     finally:
+        sd_models.checkpoint_preloader.done(id(p))
         sd_models.apply_token_merging(p.sd_model, 0)
 
         # restore opts to original state
@@ -884,6 +966,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
         if p.refiner_checkpoint_info is None:
             raise Exception(f'Could not find checkpoint with name {p.refiner_checkpoint}')
 
+        sd_models.checkpoint_preloader.want(id(p), [p.refiner_checkpoint_info], first=True)
+
     if hasattr(shared.sd_model, 'fix_dimensions'):
         p.width, p.height = shared.sd_model.fix_dimensions(p.width, p.height)
 
@@ -1259,6 +1343,8 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
                 if self.hr_checkpoint_info is None:
                     raise Exception(f'Could not find checkpoint with name {self.hr_checkpoint_name}')
 
+                sd_models.checkpoint_preloader.want(id(self), [self.hr_checkpoint_info], first=True)
+
                 self.extra_generation_params["Hires checkpoint"] = self.hr_checkpoint_info.short_title
 
             if self.hr_sampler_name is not None and self.hr_sampler_name != self.sampler_name:
@@ -8,6 +8,7 @@ from pydantic import BaseModel, Field
 from modules.shared import opts
 
 import modules.shared as shared
+from modules import script_callbacks
 from collections import OrderedDict
 import string
 import random
@@ -49,9 +50,11 @@ def record_results(id_task, res):
         recorded_results.pop(0)
 
 
-def add_task_to_queue(id_job):
+def add_task_to_queue(id_job, prompt=None):
     pending_tasks[id_job] = time.time()
 
+    script_callbacks.task_queued_callback(id_job, prompt)
+
 class PendingTasksResponse(BaseModel):
     size: int = Field(title="Pending task size")
     tasks: List[str] = Field(title="Pending task ids")
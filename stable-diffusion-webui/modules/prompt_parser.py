@@ -1,5 +1,9 @@
 from __future__ import annotations
 
+import bisect
+import collections
+import copy
+import functools
 import re
 from collections import namedtuple
 import lark
@@ -47,7 +51,7 @@ def get_learned_conditioning_prompt_schedules(prompts, base_steps, hires_steps=N
     >>> g("a [b:.5] c")
     [[5, 'a  c'], [10, 'a b c']]
     >>> g("a [{b|d{:.5] c")  # not handling this right now
-    [[5, 'a  c'], [10, 'a {b|d{ c']]
+    [[10, 'a [{b|d{:.5] c']]
     >>> g("((a][:b:c [d:3]")
     [[3, '((a][:b:c '], [10, '((a][:b:c d']]
     >>> g("[a|(b:1.1)]")
@@ -61,8 +65,42 @@ def get_learned_conditioning_prompt_schedules(prompts, base_steps, hires_steps=N
     [[10, 'a b c']]
     >>> g("a [b:1.5] c")
     [[5, 'a  c'], [10, 'a b c']]
+    >>> g("a [b:c:0.5] d")
+    [[10, 'a c d']]
+    >>> g("a [b:c:15] d")
+    [[5, 'a b d'], [10, 'a c d']]
+    >>> g = lambda p: get_learned_conditioning_prompt_schedules([p], 10, 10, use_old_scheduling=True)[0]
+    >>> g("a [b:.5] c")
+    [[5, 'a  c'], [10, 'a b c']]
+    >>> g("a [b:c:0.5] d")
+    [[5, 'a b d'], [10, 'a c d']]
+    >>> g("a [b:c:15] d")
+    [[10, 'a b d']]
+    >>> g("a[b:[c:d:2]:1]e")
+    [[1, 'abe'], [2, 'ace'], [10, 'ade']]
     """
 
+    promptdict = {prompt: [list(x) for x in get_prompt_schedule(prompt, base_steps, hires_steps, use_old_scheduling)] for prompt in set(prompts)}
+    return [promptdict[prompt] for prompt in prompts]
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_prompt_schedule(prompt):
+    """returns lark tree for the prompt, or None if it can't be parsed; the tree is shared between callers and must be copied before changing it"""
+
+    try:
+        return schedule_parser.parse(prompt)
+    except lark.exceptions.LarkError:
+        if 0:
+            import traceback
+            traceback.print_exc()
+        return None
+
+
+@functools.lru_cache(maxsize=4096)
+def get_prompt_schedule(prompt, base_steps, hires_steps=None, use_old_scheduling=False):
+    """schedule of a single prompt for get_learned_conditioning_prompt_schedules, as a tuple of (step, text) pairs"""
+
     if hires_steps is None or use_old_scheduling:
         int_offset = 0
         flt_offset = 0
@@ -72,6 +110,13 @@ def get_learned_conditioning_prompt_schedules(prompts, base_steps, hires_steps=N
         flt_offset = 1.0
         steps = hires_steps
 
+    # scheduling and alternation both need square brackets, and without them the parsed prompt is the same text
+    if "[" not in prompt:
+        return ((steps, prompt), )
+
+    scheduled_nodes = []
+    alternate_nodes = []
+
     def collect_steps(steps, tree):
         res = [steps]
 
@@ -89,9 +134,11 @@ def get_learned_conditioning_prompt_schedules(prompts, base_steps, hires_steps=N
                 tree.children[-2] = min(steps, int(v))
                 if tree.children[-2] >= 1:
                     res.append(tree.children[-2])
+                scheduled_nodes.append(tree)
 
             def alternate(self, tree):
                 res.extend(range(1, steps+1))
+                alternate_nodes.append(tree)
 
         CollectSteps().visit(tree)
         return sorted(set(res))
@@ -119,18 +166,27 @@ def get_learned_conditioning_prompt_schedules(prompts, base_steps, hires_steps=N
                     yield child
         return AtStep().transform(tree)
 
-    def get_schedule(prompt):
-        try:
-            tree = schedule_parser.parse(prompt)
-        except lark.exceptions.LarkError:
-            if 0:
-                import traceback
-                traceback.print_exc()
-            return [[steps, prompt]]
-        return [[t, at_step(t, tree)] for t in collect_steps(steps, tree)]
-
-    promptdict = {prompt: get_schedule(prompt) for prompt in set(prompts)}
-    return [promptdict[prompt] for prompt in prompts]
+    tree = parse_prompt_schedule(prompt)
+    if tree is None:
+        return ((steps, prompt), )
+
+    # collect_steps writes step numbers into the tree
+    tree = copy.deepcopy(tree)
+
+    # the text only depends on which side of each scheduled edit the step is on, and on which option each alternation
+    # picks, so with [a|b] the tree is transformed twice rather than once for every step
+    texts = {}
+    res = []
+    for step in collect_steps(steps, tree):
+        key = tuple(step <= node.children[-2] for node in scheduled_nodes) + tuple((step - 1) % len(node.children) for node in alternate_nodes)
+
+        text = texts.get(key)
+        if text is None:
+            text = texts[key] = at_step(step, tree)
+
+        res.append((step, text))
+
+    return tuple(res)
 
 
 ScheduledPromptConditioning = namedtuple("ScheduledPromptConditioning", ["end_at_step", "cond"])
@@ -154,7 +210,7 @@ class SdConditioning(list):
 
 
 
-def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps, hires_steps=None, use_old_scheduling=False):
+def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps, hires_steps=None, use_old_scheduling=False, persistent_cache=None):
     """converts a list of prompts into a list of prompt schedules - each schedule is a list of ScheduledPromptConditioning, specifying the comdition (cond),
     and the sampling step at which this condition is to be replaced by the next one.
 
@@ -171,6 +227,9 @@ def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps,
             ScheduledPromptConditioning(end_at_step=20, cond=tensor([[-0.3886,  0.0229, -0.0522,  ..., -0.4901, -0.3067,  0.0673], ..., [-0.7352, -0.4356, -0.7888,  ...,  0.6994, -0.4312, -1.2593]], device='cuda:0'))
         ]
     ]
+
+    persistent_cache is an optional dict-like object that keeps schedules between calls; it must only be used with
+    one model and text encoder state (see modules.cond_cache).
     """
     res = []
 
@@ -184,6 +243,13 @@ def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps,
             res.append(cached)
             continue
 
+        persistent_key = (prompt, steps, hires_steps, use_old_scheduling, getattr(prompts, 'is_negative_prompt', False), getattr(prompts, 'width', None), getattr(prompts, 'height', None))
+        cached = persistent_cache.get(persistent_key) if persistent_cache is not None else None
+        if cached is not None:
+            cache[prompt] = cached
+            res.append(cached)
+            continue
+
         texts = SdConditioning([x[1] for x in prompt_schedule], copy_from=prompts)
         conds = model.get_learned_conditioning(texts)
 
@@ -197,6 +263,9 @@ def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps,
             cond_schedule.append(ScheduledPromptConditioning(end_at_step, cond))
 
         cache[prompt] = cond_schedule
+        if persistent_cache is not None:
+            persistent_cache[persistent_key] = cond_schedule
+
         res.append(cond_schedule)
 
     return res
@@ -249,7 +318,7 @@ class MulticondLearnedConditioning:
         self.batch: list[list[ComposableScheduledPromptConditioning]] = batch
 
 
-def get_multicond_learned_conditioning(model, prompts, steps, hires_steps=None, use_old_scheduling=False) -> MulticondLearnedConditioning:
+def get_multicond_learned_conditioning(model, prompts, steps, hires_steps=None, use_old_scheduling=False, persistent_cache=None) -> MulticondLearnedConditioning:
     """same as get_learned_conditioning, but returns a list of ScheduledPromptConditioning along with the weight objects for each prompt.
     For each prompt, the list is obtained by splitting the prompt using the AND separator.
 
@@ -258,7 +327,7 @@ def get_multicond_learned_conditioning(model, prompts, steps, hires_steps=None,
 
     res_indexes, prompt_flat_list, prompt_indexes = get_multicond_prompt_list(prompts)
 
-    learned_conditioning = get_learned_conditioning(model, prompt_flat_list, steps, hires_steps, use_old_scheduling)
+    learned_conditioning = get_learned_conditioning(model, prompt_flat_list, steps, hires_steps, use_old_scheduling, persistent_cache)
 
     res = []
     for indexes in res_indexes:
@@ -349,6 +418,103 @@ def reconstruct_multicond_batch(c: MulticondLearnedConditioning, current_step):
     return conds_list, stacked
 
 
+class CompiledCondSchedule:
+    """
+    Conds of a batch of prompt schedules prepared for all sampling steps at once, so that getting them for a step is a
+    lookup instead of reconstruct_cond_batch/reconstruct_multicond_batch.
+
+    Steps at which any of the schedules moves to its next cond divide sampling into segments. A table maps each step to
+    its segment; the batch tensor of a segment is stacked (and padded, for prompts with AND) when the segment is first
+    needed, and is then returned for every step in it. If there are many segments, as with [a|b] prompts, only the
+    most recently used max_kept_segments are kept.
+    """
+
+    max_kept_segments = 8
+
+    def __init__(self, source, schedules, stack):
+        self.source = source
+        """the object the schedules were compiled from"""
+
+        self.schedules = schedules
+        self.stack = stack
+
+        ends = sorted({entry.end_at_step for schedule in schedules for entry in schedule})
+
+        # same choice as reconstruct_cond_batch: first entry that ends at or after the step, or the first entry if none does
+        selections = []
+        for end in ends + [None]:
+            selections.append(tuple(next((i for i, entry in enumerate(schedule) if end is not None and end <= entry.end_at_step), 0) for schedule in schedules))
+
+        self.segments = list(dict.fromkeys(selections))
+        segment_of_bound = [self.segments.index(x) for x in selections]
+
+        self.step_to_segment = [segment_of_bound[bisect.bisect_left(ends, step)] for step in range(int(ends[-1]) + 2)] if ends else [0]
+        self.built = collections.OrderedDict()
+
+    def segment(self, step):
+        return self.step_to_segment[min(max(int(step), 0), len(self.step_to_segment) - 1)]
+
+    def get(self, step):
+        index = self.segment(step)
+
+        res = self.built.get(index)
+        if res is None:
+            res = self.stack([schedule[i].cond for schedule, i in zip(self.schedules, self.segments[index])])
+            self.built[index] = res
+
+            while len(self.built) > self.max_kept_segments:
+                self.built.popitem(last=False)
+        else:
+            self.built.move_to_end(index)
+
+        if isinstance(res, DictWithShape):
+            # callers may replace items in the dict when padding conds
+            res = DictWithShape(res, res.shape)
+
+        return res
+
+
+def compile_cond_batch(c: list[list[ScheduledPromptConditioning]]) -> CompiledCondSchedule:
+    """prepares a batch for CompiledCondSchedule.get(step), which returns the same as reconstruct_cond_batch(c, step)"""
+
+    def stack(conds):
+        param = conds[0]
+        if isinstance(param, dict):
+            res = {k: torch.stack([x[k].to(device=v.device, dtype=v.dtype) for x in conds]) for k, v in param.items()}
+            return DictWithShape(res, res['crossattn'].shape)
+
+        return torch.stack([x.to(device=param.device, dtype=param.dtype) for x in conds])
+
+    return CompiledCondSchedule(c, c, stack)
+
+
+def compile_multicond_batch(c: MulticondLearnedConditioning) -> CompiledCondSchedule:
+    """prepares a batch for CompiledCondSchedule.get(step), which returns the same stacked tensor as reconstruct_multicond_batch(c, step); conds_list is in the conds_list field"""
+
+    param = c.batch[0][0].schedules[0].cond
+
+    schedules = []
+    conds_list = []
+    for composable_prompts in c.batch:
+        conds_for_batch = []
+        for composable_prompt in composable_prompts:
+            conds_for_batch.append((len(schedules), composable_prompt.weight))
+            schedules.append(composable_prompt.schedules)
+
+        conds_list.append(conds_for_batch)
+
+    def stack(tensors):
+        if isinstance(tensors[0], dict):
+            stacked = {k: stack_conds([x[k] for x in tensors]) for k in tensors[0].keys()}
+            return DictWithShape(stacked, stacked['crossattn'].shape)
+
+        return stack_conds(tensors).to(device=param.device, dtype=param.dtype)
+
+    res = CompiledCondSchedule(c, schedules, stack)
+    res.conds_list = conds_list
+    return res
+
+
 re_attention = re.compile(r"""
 \\\(|
 \\\)|
@@ -238,6 +238,7 @@ callback_map = dict(
     callbacks_list_optimizers=[],
     callbacks_list_unets=[],
     callbacks_before_token_counter=[],
+    callbacks_task_queued=[],
 )
 
 ordered_callbacks_map = {}
@@ -431,6 +432,14 @@ def before_token_counter_callback(params: BeforeTokenCounterParams):
             report_exception(c, 'before_token_counter')
 
 
+def task_queued_callback(id_task, prompt):
+    for c in ordered_callbacks('task_queued'):
+        try:
+            c.callback(id_task, prompt)
+        except Exception:
+            report_exception(c, 'task_queued')
+
+
 def remove_current_script_callbacks():
     stack = [x for x in inspect.stack() if x.filename != __file__]
     filename = stack[0].filename if stack else 'unknown file'
@@ -506,6 +515,7 @@ def on_before_image_saved(callback, *, name=None):
 
 def on_image_saved(callback, *, name=None):
     """register a function to be called after an image is saved to a file.
+    With save_images_async enabled, the callback is called on the image writer thread, after save_image has returned.
     The callback is called with one argument:
         - params: ImageSaveParams - parameters the image was saved with. Changing fields in this object does nothing.
     """
@@ -611,3 +621,11 @@ def on_before_token_counter(callback, *, name=None):
     The function will be called with one argument of type BeforeTokenCounterParams, and should modify its fields if necessary."""
 
     add_callback(callback_map['callbacks_before_token_counter'], callback, name=name, category='before_token_counter')
+
+
+def on_task_queued(callback, *, name=None):
+    """register a function to be called when a generation task is added to the queue, before it waits for its turn.
+    The function will be called with two arguments: id of the task, and text of its prompt (or None if unknown).
+    It is called on the thread that queues the task, so it must return quickly and do any heavy work elsewhere."""
+
+    add_callback(callback_map['callbacks_task_queued'], callback, name=name, category='task_queued')
@@ -1,8 +1,8 @@
-import collections
 import importlib
 import os
 import sys
 import threading
+import time
 import enum
 
 import torch
@@ -13,6 +13,7 @@ from urllib import request
 import ldm.modules.midas as midas
 
 from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet, sd_models_xl, cache, extra_networks, processing, lowvram, sd_hijack, patches
+from modules.checkpoint_cache import CheckpointCache, CheckpointPreloader
 from modules.timer import Timer
 from modules.shared import opts
 import tomesd
@@ -24,7 +25,8 @@ model_path = os.path.abspath(os.path.join(paths.models_path, model_dir))
 checkpoints_list = {}
 checkpoint_aliases = {}
 checkpoint_alisases = checkpoint_aliases  # for compatibility with old name
-checkpoints_loaded = collections.OrderedDict()
+checkpoints_loaded = CheckpointCache()
+checkpoint_preloader = CheckpointPreloader()
 
 
 class ModelType(enum.Enum):
@@ -104,8 +106,8 @@ class CheckpointInfo:
         for id in self.ids:
             checkpoint_aliases[id] = self
 
-    def calculate_shorthash(self):
-        self.sha256 = hashes.sha256(self.filename, f"checkpoint/{self.name}")
+    def calculate_shorthash(self, priority=hashes.PRIORITY_FOREGROUND):
+        self.sha256 = hashes.sha256(self.filename, f"checkpoint/{self.name}", priority=priority)
         if self.sha256 is None:
             return
 
@@ -176,6 +178,11 @@ def list_models():
         checkpoint_info = CheckpointInfo(filename)
         checkpoint_info.register()
 
+    if shared.opts.hash_models_in_background:
+        for checkpoint_info in list(checkpoints_list.values()):
+            if checkpoint_info.sha256 is None:
+                hashes.sha256_background(checkpoint_info.filename, f"checkpoint/{checkpoint_info.name}")
+
 
 re_strip_checksum = re.compile(r"\s*\[[^]]+]\s*$")
 
@@ -330,18 +337,26 @@ def read_state_dict(checkpoint_file, print_global_state=False, map_location=None
 
 
 def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
-    sd_model_hash = checkpoint_info.calculate_shorthash()
+    sd_model_hash = checkpoint_info.calculate_shorthash(priority=hashes.PRIORITY_ACTIVE)
     timer.record("calculate hash")
 
     if checkpoint_info in checkpoints_loaded:
         # use checkpoint cache
         print(f"Loading weights [{sd_model_hash}] from cache")
-        # move to end as latest
-        checkpoints_loaded.move_to_end(checkpoint_info)
         return checkpoints_loaded[checkpoint_info]
 
+    preloaded = checkpoint_preloader.take(checkpoint_info)
+    if preloaded is not None:
+        print(f"Loading weights [{sd_model_hash}] from preloaded state dict")
+        res, load_time = preloaded
+        checkpoints_loaded.record_load_time(checkpoint_info, load_time)
+        timer.record("load preloaded weights")
+        return res
+
     print(f"Loading weights [{sd_model_hash}] from {checkpoint_info.filename}")
+    started = time.time()
     res = read_state_dict(checkpoint_info.filename)
+    checkpoints_loaded.record_load_time(checkpoint_info, time.time() - started)
     timer.record("load weights from disk")
 
     return res
@@ -408,7 +423,7 @@ def set_model_fields(model):
 
 
 def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer):
-    sd_model_hash = checkpoint_info.calculate_shorthash()
+    sd_model_hash = checkpoint_info.calculate_shorthash(priority=hashes.PRIORITY_ACTIVE)
     timer.record("calculate hash")
 
     if devices.fp8:
@@ -430,9 +445,10 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     if model.is_ssd:
         sd_hijack.model_hijack.convert_sdxl_to_ssd(model)
 
-    if shared.opts.sd_checkpoint_cache > 0:
+    if checkpoints_loaded.enabled():
         # cache newly loaded model
-        checkpoints_loaded[checkpoint_info] = state_dict.copy()
+        checkpoints_loaded.store(checkpoint_info, state_dict)
+        timer.record("cache weights")
 
     if hasattr(model, "before_load_weights"):
         model.before_load_weights(state_dict)
@@ -521,8 +537,7 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     timer.record("apply dtype to VAE")
 
     # clean up cache if limit is reached
-    while len(checkpoints_loaded) > shared.opts.sd_checkpoint_cache:
-        checkpoints_loaded.popitem(last=False)
+    checkpoints_loaded.trim()
 
     model.sd_model_hash = sd_model_hash
     model.sd_model_checkpoint = checkpoint_info.filename
@@ -856,6 +871,7 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None):
     sd_model.eval()
     model_data.set_sd_model(sd_model)
     model_data.was_loaded_at_least_once = True
+    checkpoint_preloader.loaded()
 
     sd_hijack.model_hijack.embedding_db.load_textual_inversion_embeddings(force_reload=True)  # Reload embeddings after model load as they may or may not fit the model
 
@@ -997,6 +1013,7 @@ def reload_model_weights(sd_model=None, info=None, forced_reload=False):
     print(f"Weights loaded in {timer.summary()}.")
 
     model_data.set_sd_model(sd_model)
+    checkpoint_preloader.loaded()
     sd_unet.apply_unet()
 
     return sd_model
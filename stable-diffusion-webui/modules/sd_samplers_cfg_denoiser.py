@@ -63,6 +63,9 @@ class CFGDenoiser(torch.nn.Module):
         self.need_last_noise_uncond = False
         self.last_noise_uncond = None
 
+        self.compiled_cond = None
+        self.compiled_uncond = None
+
         # NOTE: masking before denoising can cause the original latents to be oversmoothed
         # as the original latents do not have noise
         self.mask_before_denoising = False
@@ -97,6 +100,17 @@ class CFGDenoiser(torch.nn.Module):
         self.sampler.sampler_extra_args['cond'] = c
         self.sampler.sampler_extra_args['uncond'] = uc
 
+    def get_compiled_conds(self, cond, uncond):
+        """returns cond and uncond schedules compiled for looking up conds by step; they are compiled again only when different conds are passed"""
+
+        if self.compiled_cond is None or self.compiled_cond.source is not cond:
+            self.compiled_cond = prompt_parser.compile_multicond_batch(cond)
+
+        if self.compiled_uncond is None or self.compiled_uncond.source is not uncond:
+            self.compiled_uncond = prompt_parser.compile_cond_batch(uncond)
+
+        return self.compiled_cond, self.compiled_uncond
+
     def pad_cond_uncond(self, cond, uncond):
         empty = shared.sd_model.cond_stage_model_empty_prompt
         num_repeats = (cond.shape[1] - uncond.shape[1]) // empty.shape[1]
@@ -165,8 +179,9 @@ class CFGDenoiser(torch.nn.Module):
         # so is_edit_model is set to False to support AND composition.
         is_edit_model = shared.sd_model.cond_stage_key == "edit" and self.image_cfg_scale is not None and self.image_cfg_scale != 1.0
 
-        conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
-        uncond = prompt_parser.reconstruct_cond_batch(uncond, self.step)
+        compiled_cond, compiled_uncond = self.get_compiled_conds(cond, uncond)
+        conds_list, tensor = compiled_cond.conds_list, compiled_cond.get(self.step)
+        uncond = compiled_uncond.get(self.step)
 
         assert not is_edit_model or all(len(conds) == 1 for conds in conds_list), "AND is not supported for InstructPix2Pix checkpoint (unless using Image CFG scale = 1.0)"
 
@@ -3,7 +3,7 @@ from collections import namedtuple
 import numpy as np
 import torch
 from PIL import Image
-from modules import devices, images, sd_vae_approx, sd_samplers, sd_vae_taesd, shared, sd_models
+from modules import devices, images, sd_vae_approx, sd_samplers, sd_vae_taesd, sd_vae_tiled, shared, sd_models
 from modules.shared import opts, state
 import k_diffusion.sampling
 
@@ -31,7 +31,7 @@ def setup_img2img_steps(p, steps=None):
     return steps, t_enc
 
 
-approximation_indexes = {"Full": 0, "Approx NN": 1, "Approx cheap": 2, "TAESD": 3}
+approximation_indexes = {"Full": 0, "Approx NN": 1, "Approx cheap": 2, "TAESD": 3, "Tiled": 4}
 
 
 def samples_to_images_tensor(sample, approximation=None, model=None):
@@ -55,7 +55,11 @@ def samples_to_images_tensor(sample, approximation=None, model=None):
         if model is None:
             model = shared.sd_model
         with torch.no_grad(), devices.without_autocast(): # fixes an issue with unstable VAEs that are flaky even in fp32
-            x_sample = model.decode_first_stage(sample.to(model.first_stage_model.dtype))
+            sample = sample.to(model.first_stage_model.dtype)
+            if approximation == 4:
+                x_sample = sd_vae_tiled.decode(model, sample)
+            else:
+                x_sample = model.decode_first_stage(sample)
 
     return x_sample
 
@@ -97,17 +101,18 @@ def images_tensor_to_samples(image, approximation=None, model=None):
             model = shared.sd_model
         model.first_stage_model.to(devices.dtype_vae)
 
+        def encode(x):
+            if approximation == 4:
+                return sd_vae_tiled.encode(model, x)
+
+            return model.get_first_stage_encoding(model.encode_first_stage(x))
+
         image = image.to(shared.device, dtype=devices.dtype_vae)
         image = image * 2 - 1
         if len(image) > 1:
-            x_latent = torch.stack([
-                model.get_first_stage_encoding(
-                    model.encode_first_stage(torch.unsqueeze(img, 0))
-                )[0]
-                for img in image
-            ])
+            x_latent = torch.stack([encode(torch.unsqueeze(img, 0))[0] for img in image])
         else:
-            x_latent = model.get_first_stage_encoding(model.encode_first_stage(image))
+            x_latent = encode(image)
 
     return x_latent
 
@@ -0,0 +1,83 @@
+from typing import Callable
+
+import psutil
+import torch
+
+from modules import devices, shared
+from modules.upscaler_utils import is_out_of_memory, process_tiles
+
+latent_scale = 8
+"""how many image pixels one latent pixel covers, along each side"""
+
+tile_memory_factor = 256
+"""estimate of memory VAE needs to process a tile, in multiples of the tile's size as an RGB image"""
+
+min_tile_size = 32
+"""smallest tile side, in latent pixels; smaller tiles see too little of the picture for VAE to stay consistent between them"""
+
+tile_overlap = 16
+"""how much neighbouring tiles overlap, in latent pixels"""
+
+
+def available_memory():
+    """bytes that tensors on the device can still take"""
+
+    if devices.device.type == "cuda":
+        if shared.mem_mon is not None and not shared.mem_mon.disabled:
+            free, _ = shared.mem_mon.cuda_mem_get_info()
+        else:
+            free, _ = torch.cuda.mem_get_info(devices.device)
+
+        # memory torch has reserved but does not use for tensors is available too
+        return free + torch.cuda.memory_reserved(devices.device) - torch.cuda.memory_allocated(devices.device)
+
+    return psutil.virtual_memory().available
+
+
+def auto_tile_size(batch_size: int, dtype: torch.dtype) -> int:
+    """largest tile side, in latent pixels, at which VAE should process a batch of tiles using at most half of available memory"""
+
+    bytes_per_latent_pixel = 3 * torch.finfo(dtype).bits // 8 * tile_memory_factor * latent_scale ** 2 * batch_size
+    side = int((available_memory() // 2 // bytes_per_latent_pixel) ** 0.5)
+
+    return max(min_tile_size, side // 8 * 8)
+
+
+def apply_tiled(x: torch.Tensor, fn: Callable[[torch.Tensor], torch.Tensor], tile: int, *, min_tile: int, overlap: int, align: int = 1) -> torch.Tensor:
+    """
+    Runs fn over x in tiles of the given size, or over all of x at once if it fits into a tile. If that runs out of memory,
+    tiles are halved until they get smaller than min_tile. All sizes are in x's pixels; tile sizes, overlap and tile
+    positions are kept at multiples of align, so that they fall on whole pixels of what fn returns.
+    """
+
+    while True:
+        try:
+            if tile >= x.shape[2] and tile >= x.shape[3]:
+                return fn(x)
+
+            return process_tiles(x, fn, tile_size=tile, tile_overlap=min(overlap, tile // 4), align=align).to(x.dtype)
+        except Exception as e:
+            if tile <= min_tile or not is_out_of_memory(e):
+                raise
+
+            tile = max(min_tile, min(tile, max(x.shape[2:])) // 2 // align * align)
+            devices.torch_gc()
+
+
+def decode(model, latent: torch.Tensor) -> torch.Tensor:
+    """decodes BCHW latents into images with values in range [-1, 1], a tile at a time, with tile size picked for available memory"""
+
+    tile = auto_tile_size(latent.shape[0], latent.dtype)
+
+    return apply_tiled(latent, model.decode_first_stage, tile, min_tile=min_tile_size, overlap=tile_overlap)
+
+
+def encode(model, image: torch.Tensor) -> torch.Tensor:
+    """encodes BCHW images with values in range [-1, 1] into latents, a tile at a time, with tile size picked for available memory"""
+
+    def encode_tile(x):
+        return model.get_first_stage_encoding(model.encode_first_stage(x))
+
+    tile = auto_tile_size(image.shape[0], image.dtype) * latent_scale
+
+    return apply_tiled(image, encode_tile, tile, min_tile=min_tile_size * latent_scale, overlap=tile_overlap * latent_scale, align=latent_scale)
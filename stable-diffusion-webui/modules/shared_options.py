@@ -56,6 +56,9 @@ options_templates.update(options_section(('saving-images', "Saving images/grids"
     "save_mask_composite": OptionInfo(False, "For inpainting, save a masked composite"),
     "jpeg_quality": OptionInfo(80, "Quality for saved jpeg and avif images", gr.Slider, {"minimum": 1, "maximum": 100, "step": 1}),
     "webp_lossless": OptionInfo(False, "Use lossless compression for webp images"),
+    "png_compress_level": OptionInfo(6, "Compression level for png images", gr.Slider, {"minimum": 0, "maximum": 9, "step": 1}).info("lower = faster saving, larger files"),
+    "save_images_async": OptionInfo(False, "Save images in background").info("generation continues while images are encoded and written to disk; files appear shortly after the job finishes"),
+    "save_images_async_queue": OptionInfo(16, "Maximum number of images waiting to be saved in background", gr.Slider, {"minimum": 1, "maximum": 128, "step": 1}),
     "export_for_4chan": OptionInfo(True, "Save copy of large images as JPG").info("if the file size is above the limit, or either width or height are above the limit"),
     "img_downscale_threshold": OptionInfo(4.0, "File size limit for the above option, MB", gr.Number),
     "target_side_length": OptionInfo(4000, "Width/height limit for the above option, in pixels", gr.Number),
@@ -103,6 +106,7 @@ options_templates.update(options_section(('upscaling', "Upscaling", "postprocess
     "dat_enabled_models": OptionInfo(["DAT x2", "DAT x3", "DAT x4"], "Select which DAT models to show in the web UI.", gr.CheckboxGroup, lambda: {"choices": shared_items.dat_models_names()}),
     "DAT_tile": OptionInfo(192, "Tile size for DAT upscalers.", gr.Slider, {"minimum": 0, "maximum": 512, "step": 16}).info("0 = no tiling"),
     "DAT_tile_overlap": OptionInfo(8, "Tile overlap for DAT upscalers.", gr.Slider, {"minimum": 0, "maximum": 48, "step": 1}).info("Low values = visible seam"),
+    "upscaler_tile_batch_mb": OptionInfo(1024, "Memory budget for upscaling several tiles at once (MB)", gr.Number).info("how much memory ESRGAN, DAT, SwinIR and other tiled upscalers may use for tiles that go through the model together; lower if upscaling runs out of memory"),
     "upscaler_for_img2img": OptionInfo(None, "Upscaler for img2img", gr.Dropdown, lambda: {"choices": [x.name for x in shared.sd_upscalers]}),
     "set_scale_by_when_changing_upscaler": OptionInfo(False, "Automatically set the Scale by factor based on the name of the selected Upscaler."),
 }))
@@ -128,6 +132,12 @@ options_templates.update(options_section(('system', "System", "system"), {
     "disable_mmap_load_safetensors": OptionInfo(False, "Disable memmapping for loading .safetensors files.").info("fixes very slow loading speed in some cases"),
     "hide_ldm_prints": OptionInfo(True, "Prevent Stability-AI's ldm/sgm modules from printing noise to console."),
     "dump_stacks_on_signal": OptionInfo(False, "Print stack traces before exiting the program with ctrl+c."),
+    "hashing_workers": OptionInfo(2, "Number of threads for calculating model hashes", gr.Slider, {"minimum": 1, "maximum": 8, "step": 1}).info("takes effect after restart"),
+    "queue_max_depth": OptionInfo(0, "Maximum number of requests waiting in generation queue", gr.Number, {"precision": 0}).info("0 = unlimited; further requests are rejected, with HTTP 429 for API"),
+    "queue_fair_share": OptionInfo(True, "Fair share scheduling for generation queue").info("waiting requests of clients that recently used less GPU time go first; web UI requests always go before API requests"),
+    "queue_trusted_proxies": OptionInfo("", "Trusted proxies for fair share").info("comma-separated addresses; API requests from them are told apart by X-Client-Id header instead of by address"),
+    "model_merger_threads": OptionInfo(2, "Number of threads for merging checkpoints", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}).info("when all checkpoints are .safetensors, they are merged tensor by tensor without being loaded whole; each thread holds a few tensors in memory"),
+    "hash_models_in_background": OptionInfo(False, "Calculate hashes of all checkpoints in background").info("hashes are queued when the list of checkpoints is refreshed; the checkpoint being loaded is always hashed first"),
 }))
 
 options_templates.update(options_section(('profiler', "Profiler", "system"), {
@@ -150,6 +160,8 @@ options_templates.update(options_section(('API', "API", "system"), {
     "api_enable_requests": OptionInfo(True, "Allow http:// and https:// URLs for input images in API", restrict_api=True),
     "api_forbid_local_requests": OptionInfo(True, "Forbid URLs to local resources", restrict_api=True),
     "api_useragent": OptionInfo("", "User agent for requests", restrict_api=True),
+    "api_batching_window": OptionInfo(0, "Batching window for API generation requests (ms)", gr.Slider, {"minimum": 0, "maximum": 1000, "step": 10}).info("0 = disable; txt2img/img2img API requests that differ only in prompt and seed and arrive within this time, or while the GPU is busy, are generated as one batch"),
+    "api_batching_max_size": OptionInfo(8, "Maximum batch size for combined API generation requests", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
 }))
 
 options_templates.update(options_section(('training', "Training", "training"), {
@@ -172,6 +184,10 @@ options_templates.update(options_section(('sd', "Stable Diffusion", "sd"), {
     "sd_checkpoints_limit": OptionInfo(1, "Maximum number of checkpoints loaded at the same time", gr.Slider, {"minimum": 1, "maximum": 10, "step": 1}),
     "sd_checkpoints_keep_in_cpu": OptionInfo(True, "Only keep one model on device").info("will keep models other than the currently used one in RAM rather than VRAM"),
     "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}).info("obsolete; set to 0 and use the two settings above instead"),
+    "sd_checkpoint_cache_ram_mb": OptionInfo(0, "Memory for caching checkpoints in RAM (MB)", gr.Number, {"precision": 0}).info("0 = disable; limits the cache above by size rather than by number of checkpoints"),
+    "sd_checkpoint_cache_mmap_mb": OptionInfo(0, "Size of safetensors checkpoints to keep memory-mapped (MB)", gr.Number, {"precision": 0}).info("0 = disable; checkpoints that don't fit into RAM cache stay mapped from disk, reading from OS file cache when switching back"),
+    "sd_checkpoint_preload": OptionInfo(0, "Checkpoints to preload for queued jobs", gr.Slider, {"minimum": 0, "maximum": 4, "step": 1}).info("0 = disable; reads checkpoints that queued API requests, refiner and hires fix will switch to into RAM in background"),
+    "sd_checkpoint_cache_pin_memory": OptionInfo(True, "Use page-locked memory for checkpoints cached in RAM").info("makes moving them to GPU faster; only with CUDA"),
     "sd_unet": OptionInfo("Automatic", "SD Unet", gr.Dropdown, lambda: {"choices": shared_items.sd_unet_items()}, refresh=shared_items.refresh_unet_list).info("choose Unet model: Automatic = use one with same filename as checkpoint; None = use Unet from checkpoint"),
     "enable_quantization": OptionInfo(False, "Enable quantization in K samplers for sharper and cleaner results. This may change existing seeds").needs_reload_ui(),
     "emphasis": OptionInfo("Original", "Emphasis mode", gr.Radio, lambda: {"choices": [x.name for x in sd_emphasis.options]}, infotext="Emphasis").info("makes it possible to make model to pay (more:1.1) or (less:0.9) attention to text when you use the syntax in prompt; " + sd_emphasis.get_options_descriptions()),
@@ -208,8 +224,9 @@ For img2img, VAE is used to process user's input image before the sampling, and
     "sd_vae_overrides_per_model_preferences": OptionInfo(True, "Selected VAE overrides per-model preferences").info("you can set per-model VAE either by editing user metadata for checkpoints, or by making the VAE have same name as checkpoint"),
     "auto_vae_precision_bfloat16": OptionInfo(False, "Automatically convert VAE to bfloat16").info("triggers when a tensor with NaNs is produced in VAE; disabling the option in this case will result in a black square image; if enabled, overrides the option below"),
     "auto_vae_precision": OptionInfo(True, "Automatically revert VAE to 32-bit floats").info("triggers when a tensor with NaNs is produced in VAE; disabling the option in this case will result in a black square image"),
-    "sd_vae_encode_method": OptionInfo("Full", "VAE type for encode", gr.Radio, {"choices": ["Full", "TAESD"]}, infotext='VAE Encoder').info("method to encode image to latent (use in img2img, hires-fix or inpaint mask)"),
-    "sd_vae_decode_method": OptionInfo("Full", "VAE type for decode", gr.Radio, {"choices": ["Full", "TAESD"]}, infotext='VAE Decoder').info("method to decode latent to image"),
+    "sd_vae_encode_method": OptionInfo("Full", "VAE type for encode", gr.Radio, {"choices": ["Full", "TAESD", "Tiled"]}, infotext='VAE Encoder').info("method to encode image to latent (use in img2img, hires-fix or inpaint mask); Tiled = full VAE run on overlapping tiles sized for available memory, for large images"),
+    "sd_vae_decode_method": OptionInfo("Full", "VAE type for decode", gr.Radio, {"choices": ["Full", "TAESD", "Tiled"]}, infotext='VAE Decoder').info("method to decode latent to image; Tiled = full VAE run on overlapping tiles sized for available memory, for large images"),
+    "sd_vae_decode_batch_mb": OptionInfo(2048, "Memory budget for decoding several images at once with VAE (MB)", gr.Number).info("images of a batch are decoded together as long as VAE needs less memory than this for them; 0 = one at a time"),
 }))
 
 options_templates.update(options_section(('img2img', "img2img", "sd"), {
@@ -239,6 +256,7 @@ options_templates.update(options_section(('optimizations', "Optimizations", "sd"
     "pad_cond_uncond": OptionInfo(False, "Pad prompt/negative prompt", infotext='Pad conds').info("improves performance when prompt and negative prompt have different lengths; changes seeds"),
     "pad_cond_uncond_v0": OptionInfo(False, "Pad prompt/negative prompt (v0)", infotext='Pad conds v0').info("alternative implementation for the above; used prior to 1.6.0 for DDIM sampler; overrides the above if set; WARNING: truncates negative prompt if it's too long; changes seeds"),
     "persistent_cond_cache": OptionInfo(True, "Persistent cond cache").info("do not recalculate conds from prompts if prompts have not changed since previous calculation"),
+    "cond_cache_mb": OptionInfo(64, "Cond cache for recently used prompts (MB)", gr.Number).info("prompts and negative prompts used by any recent request are not encoded again; 0 = disable"),
     "batch_cond_uncond": OptionInfo(True, "Batch cond/uncond").info("do both conditional and unconditional denoising in one batch; uses a bit more VRAM during sampling, but improves speed; previously this was controlled by --always-batch-cond-uncond commandline argument"),
     "fp8_storage": OptionInfo("Disable", "FP8 weight", gr.Radio, {"choices": ["Disable", "Enable for SDXL", "Enable"]}).info("Use FP8 to store Linear/Conv layers' weight. Require pytorch>=2.1.0."),
     "cache_fp16_weight": OptionInfo(False, "Cache FP16 weight for LoRA").info("Cache fp16 weight when enabling FP8, will increase the quality of LoRA. Use more system ram."),
@@ -290,6 +308,7 @@ options_templates.update(options_section(('extra_networks', "Extra Networks", "s
     "ui_extra_networks_tab_reorder": OptionInfo("", "Extra networks tab order").needs_reload_ui(),
     "textual_inversion_print_at_load": OptionInfo(False, "Print a list of Textual Inversion embeddings when loading model"),
     "textual_inversion_add_hashes_to_infotext": OptionInfo(True, "Add Textual Inversion hashes to infotext"),
+    "textual_inversion_scan_interval": OptionInfo(0, "Scan Textual Inversion embedding directories in background every N seconds", gr.Number, {"precision": 0}).info("0 = check for changes before every generation instead; with background scans, new and changed files are loaded at the next generation"),
     "sd_hypernetwork": OptionInfo("None", "Add hypernetwork to prompt", gr.Dropdown, lambda: {"choices": ["None", *shared.hypernetworks]}, refresh=shared_items.reload_hypernetworks),
 }))
 
@@ -415,6 +434,7 @@ options_templates.update(options_section(('postprocessing', "Postprocessing", "p
     'postprocessing_operation_order': OptionInfo([], "Postprocessing operation order", ui_components.DropdownMulti, lambda: {"choices": [x.name for x in shared_items.postprocessing_scripts()]}),
     'upscaling_max_images_in_cache': OptionInfo(5, "Maximum number of images in upscaling cache", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
     'postprocessing_existing_caption_action': OptionInfo("Ignore", "Action for existing captions", gr.Radio, {"choices": ["Ignore", "Keep", "Prepend", "Append"]}).info("when generating captions using postprocessing; Ignore = use generated; Keep = use original; Prepend/Append = combine both"),
+    'postprocessing_io_threads': OptionInfo(4, "Threads for reading and saving images in batch postprocessing", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}).info("files are read ahead and saved in the background while upscalers work on other images"),
 }))
 
 options_templates.update(options_section((None, "Hidden options"), {
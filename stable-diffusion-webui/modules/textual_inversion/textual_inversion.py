@@ -1,4 +1,7 @@
+import itertools
 import os
+import threading
+import time
 from collections import namedtuple
 from contextlib import closing
 
@@ -23,6 +26,8 @@ from modules.textual_inversion.saving_settings import save_settings_to_file
 TextualInversionTemplate = namedtuple("TextualInversionTemplate", ["name", "path"])
 textual_inversion_templates = {}
 
+embedding_serials = itertools.count(1)
+
 
 def list_textual_inversion_templates():
     textual_inversion_templates.clear()
@@ -50,6 +55,8 @@ class Embedding:
         self.filename = None
         self.hash = None
         self.shorthash = None
+        self.serial = next(embedding_serials)
+        """tells this object apart from other embeddings, including ones with the same name made later"""
 
     def save(self, filename):
         embedding_data = {
@@ -107,6 +114,61 @@ class DirWithTextualInversionEmbeddings:
 
         self.mtime = os.path.getmtime(self.path)
 
+    def scan(self):
+        """returns a dict of full path -> (size, mtime) for all non-empty files in the directory and its subdirectories"""
+
+        files = {}
+        if not os.path.isdir(self.path):
+            return files
+
+        for root, _, fns in os.walk(self.path, followlinks=True):
+            for fn in fns:
+                fullfn = os.path.join(root, fn)
+                try:
+                    st = os.stat(fullfn)
+                except OSError:
+                    continue
+
+                if st.st_size == 0:
+                    continue
+
+                files[fullfn] = (st.st_size, st.st_mtime)
+
+        return files
+
+
+class EmbeddingFile:
+    """a file in one of embedding directories, with embeddings that were read from it"""
+
+    def __init__(self, path, stat):
+        self.path = path
+        self.stat = stat
+        self.embeddings = []
+
+
+class EmbeddingDirWatcher(threading.Thread):
+    """periodically scans embedding directories in background; when anything changed, the scan result is left in database.pending_scan"""
+
+    def __init__(self, database):
+        super().__init__(daemon=True, name="embeddings-watcher")
+        self.database = database
+        self.last_scan = None
+
+    def run(self):
+        while True:
+            time.sleep(max(shared.opts.textual_inversion_scan_interval, 1))
+
+            try:
+                scan = self.database.scan_dirs()
+            except Exception:
+                errors.report("Error scanning embedding directories", exc_info=True)
+                continue
+
+            if scan != self.last_scan:
+                self.last_scan = scan
+                with self.database.pending_scan_lock:
+                    self.database.pending_scan = scan
+
 
 class EmbeddingDatabase:
     def __init__(self):
@@ -116,6 +178,23 @@ class EmbeddingDatabase:
         self.expected_shape = -1
         self.embedding_dirs = {}
         self.previously_displayed_embeddings = ()
+        self.files = {}
+        self.pending_scan = None
+        self.pending_scan_lock = threading.Lock()
+        self.watcher = None
+        self.registered = 0
+        """xor of hashes of names and serials of registered embeddings; registering the same embedding again after unregistering it restores the value"""
+        self.generation = 0
+        """increases when embeddings change without being registered again: when all are reloaded, or vectors are trained in place"""
+
+    @property
+    def version(self):
+        """changes whenever registered embeddings change, and only then"""
+
+        return self.registered, self.generation
+
+    def registration_hash(self, name, embedding):
+        return hash((name, getattr(embedding, 'serial', id(embedding))))
 
     def add_embedding_dir(self, path):
         self.embedding_dirs[path] = DirWithTextualInversionEmbeddings(path)
@@ -127,6 +206,12 @@ class EmbeddingDatabase:
         return self.register_embedding_by_name(embedding, model, embedding.name)
 
     def register_embedding_by_name(self, embedding, model, name):
+        previous = self.word_embeddings.get(name)
+        if previous is not None:
+            self.registered ^= self.registration_hash(name, previous)
+        if embedding is not None:
+            self.registered ^= self.registration_hash(name, embedding)
+
         ids = model.cond_stage_model.tokenize([name])[0]
         first_id = ids[0]
         if first_id not in self.ids_lookup:
@@ -154,14 +239,16 @@ class EmbeddingDatabase:
         vec = shared.sd_model.cond_stage_model.encode_embedding_init_text(",", 1)
         return vec.shape[1]
 
-    def load_from_file(self, path, filename):
+    def read_from_file(self, path, filename):
+        """reads embedding from file; returns None if the file is not an embedding"""
+
         name, ext = os.path.splitext(filename)
         ext = ext.upper()
 
         if ext in ['.PNG', '.WEBP', '.JXL', '.AVIF']:
             _, second_ext = os.path.splitext(name)
             if second_ext.upper() == '.PREVIEW':
-                return
+                return None
 
             embed_image = Image.open(path)
             if hasattr(embed_image, 'text') and 'sd-ti-embedding' in embed_image.text:
@@ -173,23 +260,38 @@ class EmbeddingDatabase:
                     name = data.get('name', name)
                 else:
                     # if data is None, means this is not an embedding, just a preview image
-                    return
+                    return None
         elif ext in ['.BIN', '.PT']:
             data = torch.load(path, map_location="cpu")
         elif ext in ['.SAFETENSORS']:
             data = safetensors.torch.load_file(path, device="cpu")
         else:
-            return
+            return None
 
-        if data is not None:
-            embedding = create_embedding_from_data(data, name, filename=filename, filepath=path)
+        if data is None:
+            print(f"Unable to load Textual inversion embedding due to data issue: '{name}'.")
+            return None
 
-            if self.expected_shape == -1 or self.expected_shape == embedding.shape:
-                self.register_embedding(embedding, shared.sd_model)
-            else:
-                self.skipped_embeddings[name] = embedding
+        return create_embedding_from_data(data, name, filename=filename, filepath=path)
+
+    def register_loaded(self, embedding):
+        if self.expected_shape == -1 or self.expected_shape == embedding.shape:
+            self.skipped_embeddings.pop(embedding.name, None)
+            self.register_embedding(embedding, shared.sd_model)
         else:
-            print(f"Unable to load Textual inversion embedding due to data issue: '{name}'.")
+            self.skipped_embeddings[embedding.name] = embedding
+
+    def unregister(self, embedding):
+        if self.word_embeddings.get(embedding.name) is embedding:
+            self.register_embedding_by_name(None, shared.sd_model, embedding.name)
+
+        if self.skipped_embeddings.get(embedding.name) is embedding:
+            del self.skipped_embeddings[embedding.name]
+
+    def load_from_file(self, path, filename):
+        embedding = self.read_from_file(path, filename)
+        if embedding is not None:
+            self.register_loaded(embedding)
 
 
     def load_from_dir(self, embdir):
@@ -209,26 +311,85 @@ class EmbeddingDatabase:
                     errors.report(f"Error loading embedding {fn}", exc_info=True)
                     continue
 
+    def scan_dirs(self):
+        files = {}
+        for embdir in list(self.embedding_dirs.values()):
+            files.update(embdir.scan())
+
+        return files
+
+    def start_watcher(self):
+        if self.watcher is None:
+            self.watcher = EmbeddingDirWatcher(self)
+            self.watcher.start()
+
     def load_textual_inversion_embeddings(self, force_reload=False):
-        if not force_reload:
-            need_reload = False
-            for embdir in self.embedding_dirs.values():
-                if embdir.has_changed():
-                    need_reload = True
-                    break
+        """
+        Brings loaded embeddings up to date with embedding directories. Only files that were added or changed since the
+        last call (by size and mtime) are read; embeddings from deleted files are removed. With force_reload, all
+        embeddings are registered again for the current model, which is required after the model changes.
+        """
 
-            if not need_reload:
+        with self.pending_scan_lock:
+            scan, self.pending_scan = self.pending_scan, None
+
+        scan_in_background = shared.opts.textual_inversion_scan_interval > 0
+        if scan_in_background:
+            self.start_watcher()
+
+        if not force_reload and scan is None:
+            if scan_in_background and all(embdir.mtime is not None for embdir in self.embedding_dirs.values()):
                 return
 
-        self.ids_lookup.clear()
-        self.word_embeddings.clear()
-        self.skipped_embeddings.clear()
-        self.expected_shape = self.get_expected_shape()
+            if not scan_in_background and not any(embdir.has_changed() for embdir in self.embedding_dirs.values()):
+                return
+
+        if scan is None:
+            scan = self.scan_dirs()
 
         for embdir in self.embedding_dirs.values():
-            self.load_from_dir(embdir)
             embdir.update()
 
+        if force_reload or self.expected_shape == -1:
+            self.expected_shape = self.get_expected_shape()
+
+        changed = {path for path, stat in scan.items() if path not in self.files or self.files[path].stat != stat}
+        removed = {path for path in self.files if path not in scan}
+
+        if force_reload:
+            self.generation += 1
+            self.registered = 0
+            self.ids_lookup.clear()
+            self.word_embeddings.clear()
+            self.skipped_embeddings.clear()
+        else:
+            for path in changed | removed:
+                for embedding in self.files[path].embeddings if path in self.files else []:
+                    self.unregister(embedding)
+
+        for path in removed:
+            del self.files[path]
+
+        for path in sorted(changed):
+            file = EmbeddingFile(path, scan[path])
+            self.files[path] = file
+
+            try:
+                embedding = self.read_from_file(path, os.path.basename(path))
+            except Exception:
+                errors.report(f"Error loading embedding {os.path.basename(path)}", exc_info=True)
+                continue
+
+            if embedding is not None:
+                file.embeddings.append(embedding)
+
+        # register everything that is not registered: files that were read just now, or all files for force_reload,
+        # or files whose embeddings have the same name as ones that were just removed
+        for file in self.files.values():
+            for embedding in file.embeddings:
+                if file.path in changed or (embedding.name not in self.word_embeddings and embedding.name not in self.skipped_embeddings):
+                    self.register_loaded(embedding)
+
         # re-sort word_embeddings because load_from_dir may not load in alphabetic order.
         # using a temporary copy so we don't reinitialize self.word_embeddings in case other objects have a reference to it.
         sorted_word_embeddings = {e.name: e for e in sorted(self.word_embeddings.values(), key=lambda e: e.name.lower())}
@@ -564,6 +725,9 @@ def train_embedding(id_task, embedding_name, learn_rate, batch_size, gradient_st
                 scaler.step(optimizer)
                 scaler.update()
                 embedding.step += 1
+
+                # the vectors were changed in place; conds cached for previews and generation were made from the old ones
+                hijack.embedding_db.generation += 1
                 pbar.update()
                 optimizer.zero_grad(set_to_none=True)
                 loss_step = _loss_step
@@ -628,7 +792,7 @@ def train_embedding(id_task, embedding_name, learn_rate, batch_size, gradient_st
                     if image is not None:
                         shared.state.assign_current_image(image)
 
-                        last_saved_image, last_text_info = images.save_image(image, images_dir, "", p.seed, p.prompt, shared.opts.samples_format, processed.infotexts[0], p=p, forced_filename=forced_filename, save_to_dirs=False)
+                        last_saved_image, last_text_info = images.save_image(image, images_dir, "", p.seed, p.prompt, shared.opts.samples_format, processed.infotexts[0], p=p, forced_filename=forced_filename, save_to_dirs=False, wait=True)
                         last_saved_image += f", prompt: {preview_text}"
 
                         if tensorboard_writer and shared.opts.training_tensorboard_save_images:
@@ -660,7 +824,7 @@ def train_embedding(id_task, embedding_name, learn_rate, batch_size, gradient_st
                         captioned_image.save(last_saved_image_chunks, "PNG", pnginfo=info)
                         embedding_yet_to_be_embedded = False
 
-                    last_saved_image, last_text_info = images.save_image(image, images_dir, "", p.seed, p.prompt, shared.opts.samples_format, processed.infotexts[0], p=p, forced_filename=forced_filename, save_to_dirs=False)
+                    last_saved_image, last_text_info = images.save_image(image, images_dir, "", p.seed, p.prompt, shared.opts.samples_format, processed.infotexts[0], p=p, forced_filename=forced_filename, save_to_dirs=False, wait=True)
                     last_saved_image += f", prompt: {preview_text}"
 
                 shared.state.job_no = embedding.step
@@ -7,7 +7,7 @@ import gradio.components
 
 from PIL import PngImagePlugin
 
-from modules import shared
+from modules import shared, images
 
 
 Savedfile = namedtuple("Savedfile", ["name"])
@@ -32,6 +32,8 @@ def check_tmp_file(gradio, filename):
 
 
 def save_pil_to_file(self, pil_image, dir=None, format="png"):
+    images.image_writer.wait_for_image(pil_image)
+
     already_saved_as = getattr(pil_image, 'already_saved_as', None)
     if already_saved_as and os.path.isfile(already_saved_as):
         register_tmp_file(shared.demo, already_saved_as)
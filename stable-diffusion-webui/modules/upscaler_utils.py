@@ -6,7 +6,7 @@ import torch
 import tqdm
 from PIL import Image
 
-from modules import devices, images, shared, torch_utils
+from modules import devices, shared, torch_utils
 
 logger = logging.getLogger(__name__)
 
@@ -62,104 +62,171 @@ def upscale_with_model(
         logger.debug("=> %s", output)
         return output
 
-    grid = images.split_grid(img, tile_size, tile_size, tile_overlap)
-    newtiles = []
-
-    with tqdm.tqdm(total=grid.tile_count, desc=desc, disable=not shared.opts.enable_upscale_progressbar) as p:
-        for y, h, row in grid.tiles:
-            newrow = []
-            for x, w, tile in row:
-                if shared.state.interrupted:
-                    return img
-                output = upscale_pil_patch(model, tile)
-                scale_factor = output.width // tile.width
-                newrow.append([x * scale_factor, w * scale_factor, output])
-                p.update(1)
-            newtiles.append([y * scale_factor, h * scale_factor, newrow])
-
-    newgrid = images.Grid(
-        newtiles,
-        tile_w=grid.tile_w * scale_factor,
-        tile_h=grid.tile_h * scale_factor,
-        image_w=grid.image_w * scale_factor,
-        image_h=grid.image_h * scale_factor,
-        overlap=grid.overlap * scale_factor,
-    )
-    return images.combine_grid(newgrid)
+    param = torch_utils.get_param(model)
 
+    with torch.inference_mode(), devices.without_autocast():
+        tensor = pil_image_to_torch_bgr(img).unsqueeze(0)  # add batch dimension
+        tensor = tensor.to(device=param.device, dtype=param.dtype)
+        output = tiled_upscale_batched(tensor, model, tile_size=tile_size, tile_overlap=tile_overlap, desc=desc)
 
-def tiled_upscale_2(
-    img: torch.Tensor,
-    model,
-    *,
-    tile_size: int,
-    tile_overlap: int,
-    scale: int,
-    device: torch.device,
-    desc="Tiled upscale",
-):
-    # Alternative implementation of `upscale_with_model` originally used by
-    # SwinIR and ScuNET.  It differs from `upscale_with_model` in that tiling and
-    # weighting is done in PyTorch space, as opposed to `images.Grid` doing it in
-    # Pillow space without weighting.
+        if output is None:
+            return img
 
-    b, c, h, w = img.size()
-    tile_size = min(tile_size, h, w)
+        return torch_bgr_to_pil_image(output)
 
-    if tile_size <= 0:
-        logger.debug("Upscaling %s without tiling", img.shape)
-        return model(img)
-
-    stride = tile_size - tile_overlap
-    h_idx_list = list(range(0, h - tile_size, stride)) + [h - tile_size]
-    w_idx_list = list(range(0, w - tile_size, stride)) + [w - tile_size]
-    result = torch.zeros(
-        b,
-        c,
-        h * scale,
-        w * scale,
-        device=device,
-        dtype=img.dtype,
-    )
-    weights = torch.zeros_like(result)
-    logger.debug("Upscaling %s to %s with tiles", img.shape, result.shape)
-    with tqdm.tqdm(total=len(h_idx_list) * len(w_idx_list), desc=desc, disable=not shared.opts.enable_upscale_progressbar) as pbar:
-        for h_idx in h_idx_list:
-            if shared.state.interrupted or shared.state.skipped:
-                break
 
-            for w_idx in w_idx_list:
-                if shared.state.interrupted or shared.state.skipped:
-                    break
+tile_memory_factor = 16
+"""estimate of memory the model needs to upscale a tile, in multiples of the upscaled tile's size in float32, for when it can't be measured"""
+
 
-                # Only move this patch to the device if it's not already there.
-                in_patch = img[
-                    ...,
-                    h_idx : h_idx + tile_size,
-                    w_idx : w_idx + tile_size,
-                ].to(device=device)
+def tile_positions(size: int, tile_size: int, stride: int, align: int = 1) -> list[int]:
+    """start of each tile along a side; the last tile is moved back to end at the side's last multiple of align"""
 
-                out_patch = model(in_patch)
+    return list(range(0, size - tile_size, stride)) + [(size - tile_size) // align * align]
 
-                result[
-                    ...,
-                    h_idx * scale : (h_idx + tile_size) * scale,
-                    w_idx * scale : (w_idx + tile_size) * scale,
-                ].add_(out_patch)
 
-                out_patch_mask = torch.ones_like(out_patch)
+def feather_ramp(length: int, ramp: int, start: bool, end: bool, device) -> torch.Tensor:
+    """1D blending weights for a tile: rising over the first ramp pixels if there's a tile before it, falling over the last ones if there's a tile after it"""
 
-                weights[
-                    ...,
-                    h_idx * scale : (h_idx + tile_size) * scale,
-                    w_idx * scale : (w_idx + tile_size) * scale,
-                ].add_(out_patch_mask)
+    weights = torch.ones(length, device=device)
+    ramp = min(ramp, length // 2)
+    if ramp <= 0:
+        return weights
 
-                pbar.update(1)
+    values = torch.arange(1, ramp + 1, device=device, dtype=weights.dtype) / (ramp + 1)
+    if start:
+        weights[:ramp] = values
+    if end:
+        weights[-ramp:] = values.flip(0)
 
-    output = result.div_(weights)
+    return weights
 
-    return output
+
+def model_memory_per_tile(model, tile: torch.Tensor):
+    """runs a single tile through the model, returning the result and how many bytes the model needed for it"""
+
+    return devices.measure_memory(lambda: model(tile), lambda output: output.numel() * 4 * tile_memory_factor, tile.device)
+
+
+def is_out_of_memory(e: Exception) -> bool:
+    return isinstance(e, torch.cuda.OutOfMemoryError) or (isinstance(e, RuntimeError) and "memory" in str(e))
+
+
+def process_tiles(
+    img: torch.Tensor,
+    fn: Callable[[torch.Tensor], torch.Tensor],
+    *,
+    tile_size: int,
+    tile_overlap: int,
+    scale: float | None = None,
+    align: int = 1,
+    batch_budget: int = 0,
+    should_stop: Callable[[], bool] | None = None,
+    desc: str | None = None,
+) -> torch.Tensor | None:
+    """
+    Applies fn to overlapping tiles of BCHW tensor img and blends the results, with weights that fade towards the edges
+    of the tiles. fn may change the number of channels, and the size of a tile by the same factor along both sides,
+    including by a fraction; that scale is taken from the first tile unless given, in which case fn's output must
+    match it. Tile sizes, overlap and positions are multiples of align, which must be enough for tile positions to
+    land on whole output pixels; a strip of fewer than align pixels at the end of a side is left out of the result.
+
+    The first tile goes through fn alone to measure how much memory it takes, and then as many tiles are put through
+    fn at once as fit into batch_budget bytes; that is halved if it runs out of memory. The result is float32, on the
+    device fn returns. Returns None if should_stop returns True before a batch of tiles.
+    """
+
+    b, _, h, w = img.shape
+    tile_h, tile_w = max(min(tile_size, h) // align * align, align), max(min(tile_size, w) // align * align, align)
+    tile_overlap = tile_overlap // align * align
+    stride_h, stride_w = max(tile_h - tile_overlap, align), max(tile_w - tile_overlap, align)
+
+    positions = [(y, x) for y in tile_positions(h, tile_h, stride_h, align) for x in tile_positions(w, tile_w, stride_w, align)]
+
+    result = None
+    weights = None
+    masks = {}
+    batch_size = 1
+
+    logger.debug("Processing %s with %d tiles of %dx%d", img.shape, len(positions), tile_w, tile_h)
+
+    with tqdm.tqdm(total=len(positions), desc=desc, disable=desc is None or not shared.opts.enable_upscale_progressbar) as pbar:
+        done = 0
+        while done < len(positions):
+            if should_stop is not None and should_stop():
+                return None
+
+            batch = positions[done:done + batch_size]
+            tiles = torch.cat([img[..., y:y + tile_h, x:x + tile_w] for y, x in batch])
+
+            try:
+                if result is None:
+                    output, tile_bytes = model_memory_per_tile(fn, tiles)
+                    batch_size = max(1, min(batch_budget // max(tile_bytes, 1), len(positions)))
+                else:
+                    output = fn(tiles)
+            except Exception as e:
+                if len(batch) == 1 or not is_out_of_memory(e):
+                    raise
+
+                batch_size = max(1, len(batch) // 2)
+                logger.debug("Out of memory processing %d tiles at once, trying %d", len(batch), batch_size)
+                devices.torch_gc()
+                continue
+
+            if result is None:
+                scale = scale or output.shape[-1] / tile_w
+                if output.shape[-2:] != (round(tile_h * scale), round(tile_w * scale)):
+                    raise ValueError(f"a {tile_w}x{tile_h} tile was turned into {output.shape[-1]}x{output.shape[-2]}, expected scale {scale}")
+
+                result = torch.zeros(b, output.shape[1], int(h * scale), int(w * scale), device=output.device, dtype=torch.float32)
+                weights = torch.zeros(1, 1, int(h * scale), int(w * scale), device=output.device, dtype=torch.float32)
+
+            out_h, out_w = output.shape[-2:]
+            for i, (y, x) in enumerate(batch):
+                key = (y > 0, y + tile_h < h, x > 0, x + tile_w < w)
+                mask = masks.get(key)
+                if mask is None:
+                    ramp_y = feather_ramp(out_h, round(tile_overlap * scale), key[0], key[1], output.device)
+                    ramp_x = feather_ramp(out_w, round(tile_overlap * scale), key[2], key[3], output.device)
+                    mask = masks[key] = torch.outer(ramp_y, ramp_x)
+
+                out_y, out_x = round(y * scale), round(x * scale)
+                region = (..., slice(out_y, out_y + out_h), slice(out_x, out_x + out_w))
+                result[region].add_(output[i * b:(i + 1) * b].float() * mask)
+                weights[region].add_(mask)
+
+            done += len(batch)
+            pbar.update(len(batch))
+
+    return result.div_(weights)
+
+
+def tiled_upscale_batched(
+    img: torch.Tensor,
+    model,
+    *,
+    tile_size: int,
+    tile_overlap: int,
+    scale: int | None = None,
+    desc="Tiled upscale",
+) -> torch.Tensor | None:
+    """
+    Upscales a BCHW tensor with the model tile by tile, running as many tiles through the model at once as fit into
+    upscaler_tile_batch_mb. The scale is taken from the first upscaled tile unless given, in which case the model's
+    output must match it. Returns None if the job is interrupted or skipped.
+    """
+
+    return process_tiles(
+        img,
+        model,
+        tile_size=tile_size,
+        tile_overlap=tile_overlap,
+        scale=scale,
+        batch_budget=shared.opts.upscaler_tile_batch_mb * 1024 * 1024,
+        should_stop=lambda: shared.state.interrupted or shared.state.skipped,
+        desc=desc,
+    )
 
 
 def upscale_2(
@@ -172,19 +239,26 @@ def upscale_2(
     desc: str,
 ):
     """
-    Convenience wrapper around `tiled_upscale_2` that handles PIL images.
+    Convenience wrapper around `tiled_upscale_batched` that handles PIL images.
     """
     param = torch_utils.get_param(model)
-    tensor = pil_image_to_torch_bgr(img).to(dtype=param.dtype).unsqueeze(0)  # add batch dimension
+    tensor = pil_image_to_torch_bgr(img).to(device=param.device, dtype=param.dtype).unsqueeze(0)  # add batch dimension
 
     with torch.no_grad():
-        output = tiled_upscale_2(
-            tensor,
-            model,
-            tile_size=tile_size,
-            tile_overlap=tile_overlap,
-            scale=scale,
-            desc=desc,
-            device=param.device,
-        )
+        if tile_size <= 0:
+            logger.debug("Upscaling %s without tiling", tensor.shape)
+            output = model(tensor)
+        else:
+            output = tiled_upscale_batched(
+                tensor,
+                model,
+                tile_size=tile_size,
+                tile_overlap=tile_overlap,
+                scale=scale,
+                desc=desc,
+            )
+
+        if output is None:
+            return img
+
     return torch_bgr_to_pil_image(output)
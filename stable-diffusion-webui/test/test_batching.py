@@ -0,0 +1,53 @@
+import threading
+import time
+import types
+
+import pytest
+
+from modules import batching, fair_queue
+
+
+class FullQueueLock:
+    """queue_lock that rejects everyone, as FairQueueLock does when queue_max_depth is reached"""
+
+    def __enter__(self):
+        raise fair_queue.QueueFullError(1)
+
+    def __exit__(self, *args):
+        return False
+
+
+@pytest.fixture
+def opts(monkeypatch):
+    opts = types.SimpleNamespace(api_batching_window=300, api_batching_max_size=4)
+    monkeypatch.setattr(batching, 'shared', types.SimpleNamespace(opts=opts))
+    return opts
+
+
+def test_queue_full_fails_leader_and_followers(opts):
+    scheduler = batching.BatchingScheduler(FullQueueLock())
+    leader = batching.BatchRequest(None, {'prompt': "a"})
+    follower = batching.BatchRequest(None, {'prompt': "b"})
+    errors = {}
+
+    def submit(name, request):
+        try:
+            scheduler.submit('key', request, lambda args, requests: pytest.fail("must not run without the queue"))
+        except Exception as e:
+            errors[name] = e
+
+    leader_thread = threading.Thread(target=submit, args=('leader', leader))
+    leader_thread.start()
+    while 'key' not in scheduler.open_groups:
+        time.sleep(0.01)
+
+    follower_thread = threading.Thread(target=submit, args=('follower', follower))
+    follower_thread.start()
+
+    leader_thread.join(5)
+    follower_thread.join(5)
+
+    assert not leader_thread.is_alive() and not follower_thread.is_alive()
+    assert isinstance(errors['leader'], fair_queue.QueueFullError)
+    assert isinstance(errors['follower'], fair_queue.QueueFullError)
+    assert scheduler.open_groups == {}
@@ -0,0 +1,36 @@
+import pytest
+import safetensors
+import safetensors.torch
+import torch
+
+from modules import extras
+
+
+def save(filename, tensors, metadata):
+    plan = {name: torch.empty(tensor.shape, dtype=tensor.dtype, device="meta") for name, tensor in tensors.items()}
+    extras.save_safetensors_streaming(str(filename), plan, lambda name: tensors[name], metadata=metadata)
+
+
+def test_streaming_save_round_trip(tmp_path):
+    filename = tmp_path / "model.safetensors"
+    tensors = {"a": torch.arange(6, dtype=torch.float16).reshape(2, 3), "b": torch.ones(4, dtype=torch.float32)}
+
+    save(filename, tensors, {"format": "pt", "sd_merge_models": '{"x": 1}'})
+
+    loaded = safetensors.torch.load_file(filename)
+    assert loaded.keys() == tensors.keys()
+    for name, tensor in tensors.items():
+        assert torch.equal(loaded[name], tensor)
+
+    with safetensors.safe_open(filename, framework="pt") as file:
+        assert file.metadata() == {"format": "pt", "sd_merge_models": '{"x": 1}'}
+
+
+@pytest.mark.parametrize("metadata", [{"modelspec": {"title": "x"}}, {"steps": 1}])
+def test_streaming_save_rejects_non_string_metadata(tmp_path, metadata):
+    filename = tmp_path / "model.safetensors"
+
+    with pytest.raises(TypeError):
+        save(filename, {"a": torch.ones(1)}, metadata)
+
+    assert not filename.exists()
@@ -0,0 +1,68 @@
+import doctest
+import itertools
+import os
+import time
+
+import pytest
+
+from modules import prompt_parser
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_schedule_examples(cached):
+    """the examples in the docstring, parsed once with empty caches and once more reusing what the first run cached"""
+
+    if not cached:
+        prompt_parser.parse_prompt_schedule.cache_clear()
+        prompt_parser.get_prompt_schedule.cache_clear()
+
+    finder = doctest.DocTestFinder()
+    runner = doctest.DocTestRunner(optionflags=doctest.NORMALIZE_WHITESPACE)
+    for test in finder.find(prompt_parser.get_learned_conditioning_prompt_schedules, globs=vars(prompt_parser)):
+        runner.run(test)
+
+    assert runner.failures == 0
+
+
+def test_callers_get_their_own_lists():
+    prompt_parser.get_prompt_schedule.cache_clear()
+    first = prompt_parser.get_learned_conditioning_prompt_schedules(["a [b:c:0.5] d"], 20)
+
+    first[0][0][1] = "changed"
+
+    assert prompt_parser.get_learned_conditioning_prompt_schedules(["a [b:c:0.5] d"], 20) == [[[10, "a b d"], [20, "a c d"]]]
+
+
+def test_alternation_transforms_once_per_option():
+    prompt_parser.get_prompt_schedule.cache_clear()
+    schedule = prompt_parser.get_learned_conditioning_prompt_schedules(["[a|b] [c:d:5]"], 150)[0]
+
+    assert len(schedule) == 150
+    assert schedule[0] == [1, "a c"]
+    assert schedule[5] == [6, "b d"]
+    assert schedule[149] == [150, "b d"]
+
+
+@pytest.mark.skipif(not os.environ.get("PROMPT_PARSER_BENCHMARK"), reason="set PROMPT_PARSER_BENCHMARK=1 to run the benchmark")
+def test_prompt_grid_benchmark():
+    """a prompt matrix/XYZ-like grid of a thousand prompts, parsed for several jobs in a row; run with -s to see timings"""
+
+    subjects = ["a cat", "a dog", "[a fox|a wolf]", "a [bird:plane:0.4]", "(a robot:1.1)"]
+    styles = ["oil painting", "[watercolor:ink:10]", "photo, 35mm", "[sketch|lineart]", "pixel art"]
+    details = [f"detail {i}" for i in range(40)]
+    prompts = [", ".join(x) for x in itertools.product(subjects, styles, details)]
+    assert len(prompts) == 1000
+
+    prompt_parser.parse_prompt_schedule.cache_clear()
+    prompt_parser.get_prompt_schedule.cache_clear()
+
+    started = time.perf_counter()
+    first = prompt_parser.get_learned_conditioning_prompt_schedules(prompts, 30)
+    cold = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(5):
+        assert prompt_parser.get_learned_conditioning_prompt_schedules(prompts, 30) == first
+    warm = (time.perf_counter() - started) / 5
+
+    print(f"1000 prompts: {cold * 1000:.1f} ms first job, {warm * 1000:.1f} ms per later job")